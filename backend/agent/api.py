@@ -2,22 +2,26 @@ from fastapi import APIRouter, HTTPException, Depends, Request, Body, File, Uplo
 from fastapi.responses import StreamingResponse
 import asyncio
 import json
+import re
 from datetime import datetime, timezone
 import uuid
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, Tuple
 from pydantic import BaseModel
 import os
 
 from agentpress.thread_manager import ThreadManager
 from services.supabase import DBConnection
 from services import redis
+from services import run_stream
+from services import run_admission
+from services.pubsub import agent_run_pubsub
 from utils.auth_utils import get_current_user_id_from_jwt, get_user_id_from_stream_auth, verify_thread_access
 from utils.logger import logger
 from services.billing import check_billing_status, can_use_model
 from utils.config import config
 from sandbox.sandbox import create_sandbox, get_or_start_sandbox
 from services.llm import make_llm_api_call
-from run_agent_background import run_agent_background, _cleanup_redis_response_list, update_agent_run_status
+from run_agent_background import get_run_actor, _cleanup_redis_response_list, update_agent_run_status
 from utils.constants import MODEL_NAME_ALIASES
 
 # Initialize shared resources
@@ -28,6 +32,12 @@ instance_id = None # Global instance ID for this backend instance
 # TTL for Redis response lists (24 hours)
 REDIS_RESPONSE_LIST_TTL = 3600 * 24
 
+# Maximum number of entries read per XREAD when streaming from a Redis Stream
+STREAM_READ_COUNT = 200
+
+# Format of a Redis Stream entry ID, as sent in SSE ids
+STREAM_ID_PATTERN = re.compile(r"^\d+-\d+$")
+
 
 class AgentStartRequest(BaseModel):
     model_name: Optional[str] = None  # Will be set from config.MODEL_TO_USE in the endpoint
@@ -40,6 +50,8 @@ class AgentStartRequest(BaseModel):
 class InitiateAgentResponse(BaseModel):
     thread_id: str
     agent_run_id: Optional[str] = None
+    status: Optional[str] = None  # "running", or "queued" when the run waits behind others
+    queue: Optional[Dict[str, Any]] = None
 
 class AgentCreateRequest(BaseModel):
     name: str
@@ -133,43 +145,37 @@ async def cleanup():
     # Use the instance_id to find and clean up this instance's keys
     try:
         if instance_id: # Ensure instance_id is set
-            running_keys = await redis.keys("active_run:{instance_id}:*")
-            logger.info(f"Found {len(running_keys)} running agent runs for instance {instance_id} to clean up")
-
-            for key in running_keys:
-                # Key format: active_run:{instance_id}:{agent_run_id}
-                parts = key.split(":")
-                if len(parts) == 3:
-                    agent_run_id = parts[2]
-                    await stop_agent_run(agent_run_id, error_message="Instance {instance_id} shutting down")
-                else:
-                    logger.warning("Unexpected key format found: {key}")
+            running_run_ids = await run_stream.get_instance_runs(instance_id)
+            logger.info(f"Found {len(running_run_ids)} running agent runs for instance {instance_id} to clean up")
+
+            for agent_run_id in running_run_ids:
+                await stop_agent_run(agent_run_id, error_message=f"Instance {instance_id} shutting down")
         else:
             logger.warning("Instance ID not set, cannot clean up instance-specific agent runs.")
 
     except Exception as e:
-        logger.error("Failed to clean up running agent runs: {str(e)}")
+        logger.error(f"Failed to clean up running agent runs: {str(e)}")
 
-    # Close Redis connection
+    # Close the shared Pub/Sub subscription and the Redis connection
+    await agent_run_pubsub.close()
     await redis.close()
     logger.info("Completed cleanup of agent API resources")
 
 async def stop_agent_run(agent_run_id: str, error_message: Optional[str] = None):
-    """Update database and publish stop signal to Redis."""
-    logger.info("Stopping agent run: {agent_run_id}")
+    """Update database, free the run's concurrency slot and publish stop signal to Redis."""
+    logger.info(f"Stopping agent run: {agent_run_id}")
     client = await db.client
     final_status = "failed" if error_message else "stopped"
 
-    # Attempt to fetch final responses from Redis (with size limit)
-    response_list_key = "agent_run:{agent_run_id}:responses"
+    # Attempt to fetch final responses from Redis (with size limit), unless the worker
+    # checkpoints them to the database itself
     all_responses = []
-    try:
-        all_responses_json = await redis.lrange_chunked(response_list_key, 0, -1, max_size_mb=8.0)
-        all_responses = [json.loads(r) for r in all_responses_json]
-        logger.info("Fetched {len(all_responses)} responses from Redis for DB update on stop/fail: {agent_run_id}")
-    except Exception as e:
-        logger.error("Failed to fetch responses from Redis for {agent_run_id} during stop/fail: {e}")
-        # Try fetching from DB as a fallback? Or proceed without responses? Proceeding without for now.
+    if not config.AGENT_RUN_CHECKPOINT_ENABLED:
+        try:
+            all_responses = await run_stream.read_all_responses(agent_run_id, max_size_mb=8.0)
+            logger.info(f"Fetched {len(all_responses)} responses from Redis for DB update on stop/fail: {agent_run_id}")
+        except Exception as e:
+            logger.error(f"Failed to fetch responses from Redis for {agent_run_id} during stop/fail: {e}")
 
     # Update the agent run status in the database
     update_success = await update_agent_run_status(
@@ -177,40 +183,47 @@ async def stop_agent_run(agent_run_id: str, error_message: Optional[str] = None)
     )
 
     if not update_success:
-        logger.error("Failed to update database status for stopped/failed run {agent_run_id}")
+        logger.error(f"Failed to update database status for stopped/failed run {agent_run_id}")
+
+    # The worker frees the slot when it stops; do it here too in case it is gone
+    if config.ACCOUNT_MAX_CONCURRENT_RUNS > 0:
+        try:
+            run_result = await client.table('agent_runs').select('thread_id').eq('id', agent_run_id).maybe_single().execute()
+            if run_result and run_result.data:
+                thread_result = await client.table('threads').select('account_id').eq('thread_id', run_result.data['thread_id']).maybe_single().execute()
+                if thread_result and thread_result.data:
+                    await run_admission.release_run_slot(thread_result.data['account_id'], agent_run_id)
+        except Exception as e:
+            logger.warning(f"Failed to release the concurrency slot of agent run {agent_run_id}: {str(e)}")
 
     # Send STOP signal to the global control channel
-    global_control_channel = "agent_run:{agent_run_id}:control"
+    global_control_channel = run_stream.control_channel(agent_run_id)
     try:
-        await redis.publish(global_control_channel, "STOP")
-        logger.debug("Published STOP signal to global channel {global_control_channel}")
+        await run_stream.publish_control(agent_run_id, "STOP")
+        logger.debug(f"Published STOP signal to global channel {global_control_channel}")
     except Exception as e:
         logger.error("Failed to publish STOP signal to global channel {global_control_channel}: {str(e)}")
 
     # Find all instances handling this agent run and send STOP to instance-specific channels
     try:
-        instance_keys = await redis.keys("active_run:*:{agent_run_id}")
-        logger.debug(f"Found {len(instance_keys)} active instance keys for agent run {agent_run_id}")
-
-        for key in instance_keys:
-            # Key format: active_run:{instance_id}:{agent_run_id}
-            parts = key.split(":")
-            if len(parts) == 3:
-                instance_id_from_key = parts[1]
-                instance_control_channel = "agent_run:{agent_run_id}:control:{instance_id_from_key}"
-                try:
-                    await redis.publish(instance_control_channel, "STOP")
-                    logger.debug("Published STOP signal to instance channel {instance_control_channel}")
-                except Exception as e:
-                    logger.warning("Failed to publish STOP signal to instance channel {instance_control_channel}: {str(e)}")
-            else:
-                 logger.warning("Unexpected key format found: {key}")
+        run_instance_ids = await run_stream.get_run_instances(agent_run_id)
+        logger.debug(f"Found {len(run_instance_ids)} active instances for agent run {agent_run_id}")
+
+        for run_instance_id in run_instance_ids:
+            instance_control_channel = run_stream.instance_control_channel(agent_run_id, run_instance_id)
+            try:
+                await run_stream.publish_control(agent_run_id, "STOP", instance_id=run_instance_id)
+                logger.debug(f"Published STOP signal to instance channel {instance_control_channel}")
+            except Exception as e:
+                logger.warning(f"Failed to publish STOP signal to instance channel {instance_control_channel}: {str(e)}")
+            # The worker removes its registration when it stops; do it here too in case it is gone
+            await run_stream.unregister_active_run(run_instance_id, agent_run_id)
 
         # Clean up the response list immediately on stop/fail
         await _cleanup_redis_response_list(agent_run_id)
 
     except Exception as e:
-        logger.error("Failed to find or signal active instances for {agent_run_id}: {str(e)}")
+        logger.error(f"Failed to find or signal active instances for {agent_run_id}: {str(e)}")
 
     logger.info("Successfully initiated stop process for agent run: {agent_run_id}")
 
@@ -337,13 +350,92 @@ Transform this basic information into a comprehensive, effective system prompt t
         # Return the original prompt if enhancement fails
         return user_system_prompt
 
+async def _admit_agent_run(account_id: str, agent_run_id: str) -> Tuple[str, Dict[str, Any]]:
+    """Choose the queue of a new run from the account's tier and apply admission control.
+
+    Args:
+        account_id: Account starting the run
+        agent_run_id: ID the run will be created with
+
+    Returns:
+        The queue to send the run to and its current backlog (see run_admission.get_queue_stats)
+
+    Raises:
+        HTTPException: 503 if the queue is full, 429 if the account is at its concurrency cap
+    """
+    tier_name = await run_admission.get_account_tier(account_id)
+    queue_name = run_admission.queue_for_tier(tier_name)
+
+    stats = {"queue": queue_name, "depth": 0, "oldest_wait_seconds": 0.0}
+    try:
+        stats = await run_admission.get_queue_stats(queue_name)
+    except Exception as e:
+        logger.warning(f"Failed to read the backlog of queue {queue_name}: {str(e)}")
+    if run_admission.queue_is_full(stats):
+        logger.warning(f"Rejecting agent run for account {account_id}: queue {queue_name} is full ({stats['depth']} waiting)")
+        raise HTTPException(status_code=503, detail={
+            "message": "Too many agent runs are waiting to start. Please try again shortly.",
+            "queue": stats
+        })
+
+    if config.ACCOUNT_MAX_CONCURRENT_RUNS > 0:
+        try:
+            slot = await run_admission.acquire_run_slot(account_id, agent_run_id)
+        except Exception as e:
+            logger.warning(f"Failed to check the concurrency cap of account {account_id}, admitting the run: {str(e)}")
+        else:
+            if not slot["admitted"]:
+                raise HTTPException(status_code=429, detail={
+                    "message": f"You already have {slot['running']} agent runs in progress (limit: {slot['limit']}). Stop one or wait for it to finish.",
+                    "running": slot["running"],
+                    "limit": slot["limit"]
+                })
+
+    logger.debug(f"Admitted agent run {agent_run_id} for account {account_id} (tier: {tier_name}, queue: {queue_name}, waiting: {stats['depth']})")
+    return queue_name, stats
+
+def _queue_status(stats: Dict[str, Any]) -> Dict[str, Any]:
+    """Queue fields added to the response for a newly started run.
+
+    The run's own status stays 'running' (as stored on agent_runs); "queued" tells
+    the client whether other runs were waiting ahead of it, "queue" has the backlog.
+    """
+    return {"queued": stats["depth"] > 0, "queue": stats}
+
+async def _abandon_agent_run(client, account_id: str, agent_run_id: str, instance_id: str, error: str) -> None:
+    """Undo the start of a run that could not be sent to a worker: free its slot and mark it failed."""
+    await run_admission.release_run_slot(account_id, agent_run_id)
+    try:
+        await update_agent_run_status(client, agent_run_id, "failed", error=error)
+    except Exception as e:
+        logger.error(f"Failed to mark agent run {agent_run_id} as failed: {str(e)}")
+    try:
+        await run_stream.unregister_active_run(instance_id, agent_run_id)
+    except Exception as e:
+        logger.warning(f"Failed to unregister agent run {agent_run_id}: {str(e)}")
+
+@router.get("/agent-runs/queues")
+async def get_agent_run_queues(user_id: str = Depends(get_current_user_id_from_jwt)):
+    """Get the backlog (depth and wait of the oldest run) of the agent run queues."""
+    try:
+        return {"queues": await run_admission.get_all_queue_stats()}
+    except Exception as e:
+        logger.error(f"Failed to read agent run queue stats: {str(e)}")
+        raise HTTPException(status_code=500, detail="Failed to read queue stats")
+
 @router.post("/thread/{thread_id}/agent/start")
 async def start_agent(
     thread_id: str,
     body: AgentStartRequest = Body(...),
     user_id: str = Depends(get_current_user_id_from_jwt)
 ):
-    """Start an agent for a specific thread in the background."""
+    """Start an agent for a specific thread in the background.
+
+    Returns agent_run_id and status ('running', as before), plus "queued" (whether
+    runs were waiting in the run's queue when it was sent) and "queue" (that
+    queue's backlog). Responds 429 at the account's concurrency cap and 503 when
+    the queue is full.
+    """
     global instance_id # Ensure instance_id is accessible
     if not instance_id:
         raise HTTPException(status_code=500, detail="Agent API not initialized with instance ID")
@@ -425,7 +517,7 @@ async def start_agent(
 
     active_run_id = await check_for_active_project_agent_run(client, project_id)
     if active_run_id:
-        logger.info("Stopping existing agent run {active_run_id} for project {project_id}")
+        logger.info(f"Stopping existing agent run {active_run_id} for project {project_id}")
         await stop_agent_run(active_run_id)
 
     try:
@@ -446,33 +538,44 @@ async def start_agent(
         logger.error("Failed to start sandbox for project {project_id}: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Failed to initialize sandbox: {str(e)}")
 
-    agent_run = await client.table('agent_runs').insert({
-        "thread_id": thread_id, "status": "running",
-        "started_at": datetime.now(timezone.utc).isoformat()
-    }).execute()
-    agent_run_id = agent_run.data[0]['id']
-    logger.info("Created new agent run: {agent_run_id}")
+    agent_run_id = str(uuid.uuid4())
+    queue_name, queue_stats = await _admit_agent_run(account_id, agent_run_id)
+
+    try:
+        await client.table('agent_runs').insert({
+            "id": agent_run_id, "thread_id": thread_id, "status": "running",
+            "started_at": datetime.now(timezone.utc).isoformat()
+        }).execute()
+    except Exception:
+        await run_admission.release_run_slot(account_id, agent_run_id)
+        raise
+    logger.info(f"Created new agent run: {agent_run_id}")
 
     # Register this run in Redis with TTL using instance ID
-    instance_key = "active_run:{instance_id}:{agent_run_id}"
     try:
-        await redis.set(instance_key, "running", ex=redis.REDIS_KEY_TTL)
+        await run_stream.register_active_run(instance_id, agent_run_id)
     except Exception as e:
-        logger.warning(f"Failed to register agent run in Redis ({instance_key}): {str(e)}")
-
-    # Run the agent in the background
-    run_agent_background.send(
-        agent_run_id=agent_run_id, thread_id=thread_id, instance_id=instance_id,
-        project_id=project_id,
-        model_name=model_name,  # Already resolved above
-        enable_thinking=body.enable_thinking, reasoning_effort=body.reasoning_effort,
-        stream=body.stream, enable_context_manager=body.enable_context_manager,
-        agent_config=agent_config,  # Pass agent configuration
-        is_agent_builder=is_agent_builder,
-        target_agent_id=target_agent_id
-    )
+        logger.warning(f"Failed to register agent run {agent_run_id} in Redis: {str(e)}")
+
+    # Run the agent in the background, on the queue of the account's tier
+    try:
+        get_run_actor(queue_name).send(
+            agent_run_id=agent_run_id, thread_id=thread_id, instance_id=instance_id,
+            project_id=project_id,
+            model_name=model_name,  # Already resolved above
+            enable_thinking=body.enable_thinking, reasoning_effort=body.reasoning_effort,
+            stream=body.stream, enable_context_manager=body.enable_context_manager,
+            agent_config=agent_config,  # Pass agent configuration
+            is_agent_builder=is_agent_builder,
+            target_agent_id=target_agent_id,
+            account_id=account_id
+        )
+    except Exception as e:
+        logger.error(f"Failed to queue agent run {agent_run_id}: {str(e)}")
+        await _abandon_agent_run(client, account_id, agent_run_id, instance_id, f"Failed to queue the run: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Failed to start agent run: {str(e)}")
 
-    return {"agent_run_id": agent_run_id, "status": "running"}
+    return {"agent_run_id": agent_run_id, "status": "running", **_queue_status(queue_stats)}
 
 @router.post("/agent-run/{agent_run_id}/stop")
 async def stop_agent(agent_run_id: str, user_id: str = Depends(get_current_user_id_from_jwt)):
@@ -491,6 +594,13 @@ async def get_agent_runs(thread_id: str, user_id: str = Depends(get_current_user
     await verify_thread_access(client, thread_id, user_id)
     agent_runs = await client.table('agent_runs').select('*').eq("thread_id", thread_id).order('created_at', desc=True).execute()
     logger.debug(f"Found {len(agent_runs.data)} agent runs for thread: {thread_id}")
+    # Runs whose worker checkpoints responses have them in agent_run_response_batches
+    checkpointed_ids = [run['id'] for run in agent_runs.data if not run.get('responses')]
+    if checkpointed_ids:
+        checkpointed = await get_checkpointed_responses(client, checkpointed_ids)
+        for run in agent_runs.data:
+            if run['id'] in checkpointed:
+                run['responses'] = checkpointed[run['id']]
     return {"agent_runs": agent_runs.data}
 
 @router.get("/agent-run/{agent_run_id}")
@@ -499,16 +609,42 @@ async def get_agent_run(agent_run_id: str, user_id: str = Depends(get_current_us
     logger.info(f"Fetching agent run details: {agent_run_id}")
     client = await db.client
     agent_run_data = await get_agent_run_with_access_check(client, agent_run_id, user_id)
-    # Note: Responses are not included here by default, they are in the stream or DB
+    responses = agent_run_data.get('responses') or []
+    if not responses:
+        responses = (await get_checkpointed_responses(client, [agent_run_id])).get(agent_run_id, [])
     return {
         "id": agent_run_data['id'],
         "threadId": agent_run_data['thread_id'],
         "status": agent_run_data['status'],
         "startedAt": agent_run_data['started_at'],
         "completedAt": agent_run_data['completed_at'],
+        "responses": responses,
         "error": agent_run_data['error']
     }
 
+async def get_checkpointed_responses(client, agent_run_ids: List[str]) -> Dict[str, List[dict]]:
+    """Assemble the responses of agent runs from their batches in agent_run_response_batches.
+
+    Args:
+        client: Database client
+        agent_run_ids: IDs of the agent runs
+
+    Returns:
+        Agent run ID -> responses in order, for the runs that have any
+    """
+    responses: Dict[str, List[dict]] = {}
+    page_size = 1000
+    offset = 0
+    while True:
+        result = await client.table('agent_run_response_batches').select('agent_run_id, responses').in_(
+            'agent_run_id', agent_run_ids
+        ).order('agent_run_id').order('batch_index').range(offset, offset + page_size - 1).execute()
+        for batch in result.data or []:
+            responses.setdefault(batch['agent_run_id'], []).extend(batch['responses'] or [])
+        if not result.data or len(result.data) < page_size:
+            return responses
+        offset += page_size
+
 @router.get("/thread/{thread_id}/agent", response_model=ThreadAgentResponse)
 async def get_thread_agent(thread_id: str, user_id: str = Depends(get_current_user_id_from_jwt)):
     """Get the agent details for a specific thread."""
@@ -592,201 +728,181 @@ async def get_thread_agent(thread_id: str, user_id: str = Depends(get_current_us
 async def stream_agent_run(
     agent_run_id: str,
     token: Optional[str] = None,
+    since: Optional[str] = None,
     request: Request = None
 ):
-    """Stream the responses of an agent run using Redis Lists and Pub/Sub."""
-    logger.info("Starting stream for agent run: {agent_run_id}")
+    """Stream the responses of an agent run from Redis (a list with Pub/Sub, or a Redis Stream).
+
+    Every stored response is sent with an SSE id (its list index, or its stream entry
+    ID). A reconnecting client gets only the responses after the ID in its
+    Last-Event-ID header or the `since` query parameter; without one, all stored
+    responses are replayed.
+    """
+    logger.info(f"Starting stream for agent run: {agent_run_id}")
     client = await db.client
 
     user_id = await get_user_id_from_stream_auth(request, token)
     agent_run_data = await get_agent_run_with_access_check(client, agent_run_id, user_id)
 
-    response_list_key = "agent_run:{agent_run_id}:responses"
-    response_channel = "agent_run:{agent_run_id}:new_response"
-    control_channel = "agent_run:{agent_run_id}:control" # Global control channel
-
-    async def stream_generator():
-        logger.debug("Streaming responses for {agent_run_id} using Redis list {response_list_key} and channel {response_channel}")
-        last_processed_index = -1
-        pubsub_response = None
-        pubsub_control = None
-        listener_task = None
-        terminate_stream = False
-        initial_yield_complete = False
-
-        try:
-            # 1. Fetch and yield initial responses from Redis list (with size limit)
-            initial_responses_json = await redis.lrange_latest(response_list_key, max_count=200, max_size_mb=8.0)
-            initial_responses = []
-            if initial_responses_json:
-                initial_responses = [json.loads(r) for r in initial_responses_json]
-                logger.debug("Sending {len(initial_responses)} initial responses for {agent_run_id}")
-                for response in initial_responses:
-                    yield "data: {json.dumps(response)}\n\n"
-                last_processed_index = len(initial_responses) - 1
-            initial_yield_complete = True
-
-            # 2. Check run status *after* yielding initial data
-            run_status = await client.table('agent_runs').select('status').eq("id", agent_run_id).maybe_single().execute()
-            current_status = run_status.data.get('status') if run_status.data else None
-
-            if current_status != 'running':
-                logger.info("Agent run {agent_run_id} is not running (status: {current_status}). Ending stream.")
-                yield "data: {json.dumps({'type': 'status', 'status': 'completed'})}\n\n"
-                return
-
-            # 3. Set up Pub/Sub listeners for new responses and control signals
-            pubsub_response = await redis.create_pubsub()
-            await pubsub_response.subscribe(response_channel)
-            logger.debug("Subscribed to response channel: {response_channel}")
-
-            pubsub_control = await redis.create_pubsub()
-            await pubsub_control.subscribe(control_channel)
-            logger.debug("Subscribed to control channel: {control_channel}")
-
-            # Queue to communicate between listeners and the main generator loop
-            message_queue = asyncio.Queue()
-
-            async def listen_messages():
-                response_reader = pubsub_response.listen()
-                control_reader = pubsub_control.listen()
-                response_task = asyncio.create_task(response_reader.__anext__())
-                control_task = asyncio.create_task(control_reader.__anext__())
-                tasks = [response_task, control_task]
-
-                while not terminate_stream:
-                    if not tasks:
-                        logger.warning("No active listener tasks for {agent_run_id}, stopping listener")
-                        break
+    last_event_id = (request.headers.get("last-event-id") if request else None) or since
 
-                    try:
-                        done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
-                        for task in done:
-                            try:
-                                message = task.result()
-                                if message and isinstance(message, dict) and message.get("type") == "message":
-                                    channel = message.get("channel")
-                                    data = message.get("data")
-                                    if isinstance(data, bytes): data = data.decode('utf-8')
-
-                                    if channel == response_channel and data == "new":
-                                        await message_queue.put({"type": "new_response"})
-                                    elif channel == control_channel and data in ["STOP", "END_STREAM", "ERROR"]:
-                                        logger.info(f"Received control signal '{data}' for {agent_run_id}")
-                                        await message_queue.put({"type": "control", "data": data})
-                                        return # Stop listening on control signal
-
-                            except StopAsyncIteration:
-                                logger.warning(f"Listener {task} stopped.")
-                                await message_queue.put({"type": "error", "data": "Listener stopped unexpectedly"})
-                                return
-                            except Exception as e:
-                                logger.error(f"Error in listener for {agent_run_id}: {e}")
-                                await message_queue.put({"type": "error", "data": "Listener failed"})
-                                return
-                            finally:
-                                # Reschedule the completed listener task
-                                if task == response_task:
-                                    response_task = asyncio.create_task(response_reader.__anext__())
-                                elif task == control_task:
-                                    control_task = asyncio.create_task(control_reader.__anext__())
-
-                        # Rebuild tasks list to prevent it from becoming empty
-                        tasks = [response_task, control_task]
-
-                        # Cancel pending tasks from the wait operation
-                        for p_task in pending:
-                            p_task.cancel()
-
-                    except Exception as wait_error:
-                        logger.error(f"Error in asyncio.wait for {agent_run_id}: {wait_error}")
-                        await message_queue.put({"type": "error", "data": "Wait operation failed: {wait_error}"})
-                        break
-
-                # Cancel remaining listener tasks on exit
-                for task in [response_task, control_task]:
-                    if task and not task.done():
-                        task.cancel()
-
-            listener_task = asyncio.create_task(listen_messages())
-
-            # 4. Main loop to process messages from the queue
-            while not terminate_stream:
-                try:
-                    queue_item = await message_queue.get()
-
-                    if queue_item["type"] == "new_response":
-                        # Fetch new responses from Redis list starting after the last processed index
-                        new_start_index = last_processed_index + 1
-                        new_responses_json = await redis.lrange(response_list_key, new_start_index, -1)
-
-                        if new_responses_json:
-                            new_responses = [json.loads(r) for r in new_responses_json]
-                            num_new = len(new_responses)
-                            # logger.debug("Received {num_new} new responses for {agent_run_id} (index {new_start_index} onwards)")
-                            for response in new_responses:
-                                yield "data: {json.dumps(response)}\n\n"
-                                # Check if this response signals completion
-                                if response.get('type') == 'status' and response.get('status') in ['completed', 'failed', 'stopped']:
-                                    logger.info("Detected run completion via status message in stream: {response.get('status')}")
-                                    terminate_stream = True
-                                    break # Stop processing further new responses
-                            last_processed_index += num_new
-                        if terminate_stream: break
-
-                    elif queue_item["type"] == "control":
-                        control_signal = queue_item["data"]
-                        terminate_stream = True # Stop the stream on any control signal
-                        yield "data: {json.dumps({'type': 'status', 'status': control_signal})}\n\n"
-                        break
-
-                    elif queue_item["type"] == "error":
-                        logger.error("Listener error for {agent_run_id}: {queue_item['data']}")
-                        terminate_stream = True
-                        yield "data: {json.dumps({'type': 'status', 'status': 'error'})}\n\n"
-                        break
-
-                except asyncio.CancelledError:
-                     logger.info("Stream generator main loop cancelled for {agent_run_id}")
-                     terminate_stream = True
-                     break
-                except Exception as loop_err:
-                    logger.error("Error in stream generator main loop for {agent_run_id}: {loop_err}", exc_info=True)
-                    terminate_stream = True
-                    yield "data: {json.dumps({'type': 'status', 'status': 'error', 'message': f'Stream failed: {loop_err}'})}\n\n"
-                    break
+    if run_stream.use_streams():
+        resume_id = last_event_id if last_event_id and STREAM_ID_PATTERN.match(last_event_id) else run_stream.STREAM_START_ID
+        stream_generator = _stream_from_redis_stream(client, agent_run_id, resume_id)
+    else:
+        resume_index = int(last_event_id) if last_event_id and last_event_id.isdigit() else -1
+        stream_generator = _stream_from_list(client, agent_run_id, resume_index)
 
-        except Exception as e:
-            logger.error("Error setting up stream for agent run {agent_run_id}: {e}", exc_info=True)
-            # Only yield error if initial yield didn't happen
-            if not initial_yield_complete:
-                 yield "data: {json.dumps({'type': 'status', 'status': 'error', 'message': f'Failed to start stream: {e}'})}\n\n"
-        finally:
-            terminate_stream = True
-            # Graceful shutdown order: unsubscribe → close → cancel
-            if pubsub_response: await pubsub_response.unsubscribe(response_channel)
-            if pubsub_control: await pubsub_control.unsubscribe(control_channel)
-            if pubsub_response: await pubsub_response.close()
-            if pubsub_control: await pubsub_control.close()
-
-            if listener_task:
-                listener_task.cancel()
-                try:
-                    await listener_task  # Reap inner tasks & swallow their errors
-                except asyncio.CancelledError:
-                    pass
-                except Exception as e:
-                    logger.debug("listener_task ended with: {e}")
-            # Wait briefly for tasks to cancel
-            await asyncio.sleep(0.1)
-            logger.debug("Streaming cleanup complete for agent run: {agent_run_id}")
-
-    return StreamingResponse(stream_generator(), media_type="text/event-stream", headers={
+    return StreamingResponse(stream_generator, media_type="text/event-stream", headers={
         "Cache-Control": "no-cache, no-transform", "Connection": "keep-alive",
         "X-Accel-Buffering": "no", "Content-Type": "text/event-stream",
         "Access-Control-Allow-Origin": "*"
     })
 
+async def _get_agent_run_status(client, agent_run_id: str) -> Optional[str]:
+    run_status = await client.table('agent_runs').select('status').eq("id", agent_run_id).maybe_single().execute()
+    return run_status.data.get('status') if run_status.data else None
+
+def _sse_frame(data: str, event_id: Optional[Any] = None) -> str:
+    """Format an SSE frame; stored responses carry their position as the event id."""
+    if event_id is None:
+        return f"data: {data}\n\n"
+    return f"id: {event_id}\ndata: {data}\n\n"
+
+async def _stream_from_redis_stream(client, agent_run_id: str, last_id: str = run_stream.STREAM_START_ID):
+    """Yield SSE frames for an agent run from its Redis Stream, reading on from the entry after last_id."""
+    caught_up = False
+
+    try:
+        while True:
+            # Replay without blocking until caught up, then block for new entries
+            entries = await run_stream.read_stream_entries(
+                agent_run_id, last_id, count=STREAM_READ_COUNT,
+                block_ms=config.AGENT_STREAM_BLOCK_MS if caught_up else None
+            )
+
+            if not entries:
+                # Nothing new: end the stream if the run is no longer running (e.g. the worker died)
+                current_status = await _get_agent_run_status(client, agent_run_id)
+                if current_status != 'running':
+                    logger.info(f"Agent run {agent_run_id} is not running (status: {current_status}). Ending stream.")
+                    yield f"data: {json.dumps({'type': 'status', 'status': 'completed'})}\n\n"
+                    return
+                caught_up = True
+                continue
+
+            for entry_id, fields in entries:
+                last_id = entry_id
+                control_signal = fields.get(run_stream.STREAM_CONTROL_FIELD)
+                if control_signal:
+                    yield f"data: {json.dumps({'type': 'status', 'status': control_signal})}\n\n"
+                    return
+
+                data = fields.get(run_stream.STREAM_DATA_FIELD)
+                if data is None:
+                    continue
+                yield _sse_frame(data, entry_id)
+
+                if '"type": "status"' in data:
+                    response = json.loads(data)
+                    if response.get('type') == 'status' and response.get('status') in ['completed', 'failed', 'stopped']:
+                        logger.info(f"Detected run completion via status message in stream: {response.get('status')}")
+                        return
+
+    except asyncio.CancelledError:
+        logger.info(f"Stream reader cancelled for {agent_run_id}")
+    except Exception as e:
+        logger.error(f"Error streaming agent run {agent_run_id} from Redis Stream: {e}", exc_info=True)
+        yield f"data: {json.dumps({'type': 'status', 'status': 'error', 'message': f'Stream failed: {e}'})}\n\n"
+
+def _rewind_after_truncation(notification, last_processed_index: int) -> int:
+    """Move a list consumer's index back if a resumed run truncated the list (see run_stream.truncate_responses)."""
+    if isinstance(notification, str) and notification.startswith(run_stream.TRUNCATED_NOTIFICATION_PREFIX):
+        length = int(notification[len(run_stream.TRUNCATED_NOTIFICATION_PREFIX):])
+        return min(last_processed_index, length - 1)
+    return last_processed_index
+
+async def _stream_from_list(client, agent_run_id: str, last_processed_index: int = -1):
+    """Yield SSE frames for an agent run from its Redis list, starting after last_processed_index.
+
+    New items and control signals are announced through the process-wide Pub/Sub
+    multiplexer, so a stream holds no Redis connection of its own.
+    """
+    response_list_key = run_stream.response_list_key(agent_run_id)
+    response_channel = run_stream.response_channel(agent_run_id)
+    control_channel = run_stream.control_channel(agent_run_id) # Global control channel
+
+    logger.debug(f"Streaming responses for {agent_run_id} using Redis list {response_list_key} and channel {response_channel}")
+    notifications = None
+    initial_yield_complete = False
+
+    try:
+        # 1. Subscribe before reading the list so no notification is missed in between
+        notifications = await agent_run_pubsub.subscribe(response_channel, control_channel)
+
+        # 2. Replay the responses the client has not seen yet (with size limit)
+        initial_responses_json = await redis.lrange_chunked(response_list_key, last_processed_index + 1, -1, max_size_mb=8.0)
+        if initial_responses_json:
+            logger.debug(f"Sending {len(initial_responses_json)} initial responses for {agent_run_id} from index {last_processed_index + 1}")
+            for response_json in initial_responses_json:
+                last_processed_index += 1
+                yield _sse_frame(response_json, last_processed_index)
+        initial_yield_complete = True
+
+        # 3. Check run status *after* yielding initial data
+        current_status = await _get_agent_run_status(client, agent_run_id)
+        if current_status != 'running':
+            logger.info(f"Agent run {agent_run_id} is not running (status: {current_status}). Ending stream.")
+            yield f"data: {json.dumps({'type': 'status', 'status': 'completed'})}\n\n"
+            return
+
+        # 4. Main loop: fetch new items on each notification until the run ends
+        while True:
+            channel, data = await notifications.get()
+
+            if channel == control_channel:
+                if data in run_stream.CONTROL_SIGNALS:
+                    logger.info(f"Received control signal '{data}' for {agent_run_id}")
+                    yield f"data: {json.dumps({'type': 'status', 'status': data})}\n\n"
+                    return
+                continue
+
+            # A "new" notification, or a reconnect of the shared subscriber (messages may
+            # have been missed); either way read everything after the last processed index.
+            # Further queued "new" notifications are covered by this read.
+            last_processed_index = _rewind_after_truncation(data, last_processed_index)
+            while not notifications.empty():
+                queued_channel, queued_data = notifications.get_nowait()
+                if queued_channel == control_channel and queued_data in run_stream.CONTROL_SIGNALS:
+                    # Deliver the control signal after the remaining responses
+                    notifications.put_nowait((queued_channel, queued_data))
+                    break
+                last_processed_index = _rewind_after_truncation(queued_data, last_processed_index)
+
+            new_responses_json = await redis.lrange(response_list_key, last_processed_index + 1, -1)
+            for response_json in new_responses_json:
+                last_processed_index += 1
+                yield _sse_frame(response_json, last_processed_index)
+                # Check if this response signals completion
+                if '"type": "status"' in response_json:
+                    response = json.loads(response_json)
+                    if response.get('type') == 'status' and response.get('status') in ['completed', 'failed', 'stopped']:
+                        logger.info(f"Detected run completion via status message in stream: {response.get('status')}")
+                        return
+
+    except asyncio.CancelledError:
+        logger.info(f"Stream generator cancelled for {agent_run_id}")
+    except Exception as e:
+        logger.error(f"Error streaming agent run {agent_run_id}: {e}", exc_info=True)
+        if initial_yield_complete:
+            yield f"data: {json.dumps({'type': 'status', 'status': 'error', 'message': f'Stream failed: {e}'})}\n\n"
+        else:
+            yield f"data: {json.dumps({'type': 'status', 'status': 'error', 'message': f'Failed to start stream: {e}'})}\n\n"
+    finally:
+        if notifications is not None:
+            await agent_run_pubsub.unsubscribe(notifications, response_channel, control_channel)
+        logger.debug(f"Streaming cleanup complete for agent run: {agent_run_id}")
+
 async def generate_and_update_project_name(project_id: str, prompt: str):
     """Generates a project name using an LLM and updates the database."""
     logger.info("Starting background task to generate name for project: {project_id}")
@@ -843,7 +959,10 @@ async def initiate_agent_with_files(
     target_agent_id: Optional[str] = Form(None),
     user_id: str = Depends(get_current_user_id_from_jwt)
 ):
-    """Initiate a new agent session with optional file attachments."""
+    """Initiate a new agent session with optional file attachments.
+
+    Returns thread_id and agent_run_id, plus "queued" and "queue" as for start_agent.
+    """
     global instance_id # Ensure instance_id is accessible
     if not instance_id:
         raise HTTPException(status_code=500, detail="Agent API not initialized with instance ID")
@@ -892,6 +1011,10 @@ async def initiate_agent_with_files(
     # if not can_run:
     #     raise HTTPException(status_code=402, detail={"message": message, "subscription": subscription})
 
+    # Admit the run before creating anything, so a rejected run leaves nothing behind
+    agent_run_id = str(uuid.uuid4())
+    queue_name, queue_stats = await _admit_agent_run(account_id, agent_run_id)
+
     try:
         # 1. Create Project
         placeholder_name = f"{prompt[:30]}..." if len(prompt) > 30 else prompt
@@ -1026,19 +1149,17 @@ async def initiate_agent_with_files(
         }).execute()
 
         # 6. Start Agent Run
-        agent_run = await client.table('agent_runs').insert({
-            "thread_id": thread_id, "status": "running",
+        await client.table('agent_runs').insert({
+            "id": agent_run_id, "thread_id": thread_id, "status": "running",
             "started_at": datetime.now(timezone.utc).isoformat()
         }).execute()
-        agent_run_id = agent_run.data[0]['id']
-        logger.info("Created new agent run: {agent_run_id}")
+        logger.info(f"Created new agent run: {agent_run_id}")
 
         # Register run in Redis
-        instance_key = "active_run:{instance_id}:{agent_run_id}"
         try:
-            await redis.set(instance_key, "running", ex=redis.REDIS_KEY_TTL)
+            await run_stream.register_active_run(instance_id, agent_run_id)
         except Exception as e:
-            logger.warning("Failed to register agent run in Redis ({instance_key}): {str(e)}")
+            logger.warning(f"Failed to register agent run {agent_run_id} in Redis: {str(e)}")
 
         # Run agent in background with retry logic
         max_retries = 3
@@ -1055,7 +1176,7 @@ async def initiate_agent_with_files(
 
         for attempt in range(max_retries):
             try:
-                run_agent_background.send(
+                get_run_actor(queue_name).send(
                     agent_run_id=agent_run_id, thread_id=thread_id, instance_id=instance_id,
                     project_id=project_id,
                     model_name=model_name,  # Already resolved above
@@ -1063,7 +1184,8 @@ async def initiate_agent_with_files(
                     stream=stream, enable_context_manager=enable_context_manager,
                     agent_config=agent_config,  # Pass agent configuration
                     is_agent_builder=is_agent_builder,
-                    target_agent_id=target_agent_id
+                    target_agent_id=target_agent_id,
+                    account_id=account_id
                 )
                 logger.info("Successfully queued background task for agent run {agent_run_id}")
                 break
@@ -1072,18 +1194,20 @@ async def initiate_agent_with_files(
                 logger.warning("Attempt {attempt + 1}/{max_retries} failed to queue background task: {str(send_error)}")
 
                 if attempt == max_retries - 1:
-                    # Last attempt failed, raise the error
+                    # Last attempt failed: the run will never start
                     logger.error(f"Failed to queue background task after {max_retries} attempts: {str(send_error)}")
+                    await _abandon_agent_run(client, account_id, agent_run_id, instance_id, f"Failed to queue the run: {str(send_error)}")
                     raise send_error
                 else:
                     # Wait before retrying
                     await asyncio.sleep(retry_delay)
                     retry_delay *= 2  # Exponential backoff
 
-        return {"thread_id": thread_id, "agent_run_id": agent_run_id}
+        return {"thread_id": thread_id, "agent_run_id": agent_run_id, **_queue_status(queue_stats)}
 
     except Exception as e:
-        logger.error("Error in agent initiation: {str(e)}\n{traceback.format_exc()}")
+        await run_admission.release_run_slot(account_id, agent_run_id)
+        logger.error(f"Error in agent initiation: {str(e)}\n{traceback.format_exc()}")
         # TODO: Clean up created project/thread if initiation fails mid-way
         raise HTTPException(status_code=500, detail="Failed to initiate agent session: {str(e)}")
 
@@ -1804,9 +1928,10 @@ async def debug_redis_size(agent_run_id: str):
         if list_length == 0:
             return {"agent_run_id": agent_run_id, "list_length": 0, "estimated_size_mb": 0}
 
-        # Sample a few responses to estimate size
+        # Sample a few responses to estimate size, as stored (compressed values are not decoded)
         sample_size = min(10, list_length)
-        sample_responses = await redis.lrange(response_list_key, 0, sample_size - 1)
+        redis_client = await redis.get_client()
+        sample_responses = await redis_client.lrange(response_list_key, 0, sample_size - 1)
 
         if sample_responses:
             total_sample_size = sum(len(item.encode('utf-8')) for item in sample_responses)
@@ -1822,6 +1947,7 @@ async def debug_redis_size(agent_run_id: str):
             "list_length": list_length,
             "estimated_size_mb": round(estimated_size_mb, 2),
             "avg_response_size_bytes": round(avg_response_size, 0),
+            "compressed_in_sample": sum(1 for item in sample_responses if redis.is_compressed(item)),
             "upstash_limit_mb": 10,
             "approaching_limit": estimated_size_mb > 8.0
         }
@@ -0,0 +1,242 @@
+"""
+System prompt assembly for agent runs.
+
+Assembled system messages are cached per process, keyed by a hash of
+everything that affects their content (prompt family of the model, the
+agent's custom system prompt, enabled tools and the MCP tool schemas), with
+LRU eviction. Repeated runs of the same agent get a byte-identical system
+message, which also keeps the provider prompt-cache prefix stable.
+"""
+
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Tuple
+
+from agent.agent_builder_prompt import get_agent_builder_prompt
+from agent.gemini_prompt import get_gemini_system_prompt
+from agent.prompt import get_system_prompt
+from agent.tools.mcp_tool_wrapper import MCPToolWrapper
+from agentpress.tool import SchemaType
+from utils.logger import logger
+
+# Maximum number of assembled system messages kept per process
+SYSTEM_PROMPT_CACHE_SIZE = 64
+
+_system_prompt_cache: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+_system_prompt_cache_lock = threading.Lock()
+
+
+@lru_cache(maxsize=1)
+def _get_sample_response() -> str:
+    """Read the sample assistant response appended for non-Anthropic models."""
+    sample_response_path = os.path.join(os.path.dirname(__file__), 'sample_responses/1.txt')
+    with open(sample_response_path, 'r') as file:
+        return file.read()
+
+
+def get_prompt_family(model_name: str) -> str:
+    """Return the default-prompt variant used for a model."""
+    model = model_name.lower()
+    if "gemini-2.5-flash" in model:
+        return "gemini"
+    if "anthropic" in model:
+        return "anthropic"
+    return "default"
+
+
+def _get_mcp_tool_listing(mcp_wrapper_instance: Optional[MCPToolWrapper]) -> Tuple[List[Dict[str, Any]], bool]:
+    """Return the MCP tools to list in the system prompt, in registration order.
+
+    Returns:
+        The tools listed, and False if listing them failed part way (the tools
+        listed before the error are kept)
+    """
+    if not mcp_wrapper_instance or not mcp_wrapper_instance._initialized:
+        return [], True
+
+    tools = []
+    try:
+        for method_name, schema_list in mcp_wrapper_instance.get_schemas().items():
+            if method_name == 'call_mcp_tool':
+                continue  # Skip the fallback method
+            for schema in schema_list:
+                if schema.schema_type == SchemaType.OPENAPI:
+                    func_info = schema.schema.get('function', {})
+                    tools.append({
+                        'name': method_name,
+                        'description': func_info.get('description', 'No description available'),
+                        'parameters': list(func_info.get('parameters', {}).get('properties', {}).keys()),
+                    })
+    except Exception as e:
+        logger.error(f"Error listing MCP tools: {e}")
+        return tools, False
+    return tools, True
+
+
+def _get_mcp_server_names(agent_config: dict) -> List[str]:
+    """Return the names of the MCP servers configured for an agent."""
+    names = []
+    for mcp in (agent_config.get('configured_mcps') or []) + (agent_config.get('custom_mcps') or []):
+        if isinstance(mcp, dict):
+            name = mcp.get('name') or mcp.get('qualifiedName')
+            if name:
+                names.append(name)
+    return names
+
+
+def _build_mcp_info(
+    mcp_tools: List[Dict[str, Any]],
+    listing_complete: bool = True,
+    server_names: Optional[List[str]] = None
+) -> str:
+    """Build the MCP section appended to the system prompt.
+
+    If the tool listing failed, the section is kept with the tools that could be
+    listed, an error note and the configured servers.
+    """
+    mcp_info = "\n\n--- MCP Tools Available ---\n"
+    mcp_info += "You have access to external MCP (Model Context Protocol) server tools.\n"
+    mcp_info += "MCP tools can be called directly using their native function names in the standard function calling format:\n"
+    mcp_info += '<function_calls>\n'
+    mcp_info += '<invoke name="{tool_name}">\n'
+    mcp_info += '<parameter name="param1">value1</parameter>\n'
+    mcp_info += '<parameter name="param2">value2</parameter>\n'
+    mcp_info += '</invoke>\n'
+    mcp_info += '</function_calls>\n\n'
+
+    # List available MCP tools
+    mcp_info += "Available MCP tools:\n"
+    for tool in mcp_tools:
+        mcp_info += f"- **{tool['name']}**: {tool['description']}\n"
+        # Show parameter info
+        if tool['parameters']:
+            mcp_info += f"  Parameters: {', '.join(tool['parameters'])}\n"
+    if not listing_complete:
+        mcp_info += "- Error loading MCP tool list\n"
+        if server_names:
+            mcp_info += f"Configured MCP servers: {', '.join(server_names)}\n"
+
+    # Add critical instructions for using search results
+    mcp_info += "\n🚨 CRITICAL MCP TOOL RESULT INSTRUCTIONS 🚨\n"
+    mcp_info += "When you use ANY MCP (Model Context Protocol) tools:\n"
+    mcp_info += "1. ALWAYS read and use the EXACT results returned by the MCP tool\n"
+    mcp_info += "2. For search tools: ONLY cite URLs, sources, and information from the actual search results\n"
+    mcp_info += "3. For any tool: Base your response entirely on the tool's output - do NOT add external information\n"
+    mcp_info += "4. DO NOT fabricate, invent, hallucinate, or make up any sources, URLs, or data\n"
+    mcp_info += "5. If you need more information, call the MCP tool again with different parameters\n"
+    mcp_info += "6. When writing reports/summaries: Reference ONLY the data from MCP tool results\n"
+    mcp_info += "7. If the MCP tool doesn't return enough information, explicitly state this limitation\n"
+    mcp_info += "8. Always double-check that every fact, URL, and reference comes from the MCP tool output\n"
+    mcp_info += "\nIMPORTANT: MCP tool results are your PRIMARY and ONLY source of truth for external data!\n"
+    mcp_info += "NEVER supplement MCP results with your training data or make assumptions beyond what the tools provide.\n"
+    return mcp_info
+
+
+def _assemble_system_content(
+    prompt_family: str,
+    custom_system_prompt: Optional[str],
+    is_agent_builder: bool,
+    include_mcp_info: bool,
+    mcp_tools: List[Dict[str, Any]],
+    mcp_listing_complete: bool = True,
+    mcp_server_names: Optional[List[str]] = None
+) -> str:
+    """Assemble the system prompt text."""
+    if custom_system_prompt:
+        # Completely replace the default system prompt with the custom one
+        # This prevents confusion and tool hallucination
+        system_content = custom_system_prompt
+    elif is_agent_builder:
+        system_content = get_agent_builder_prompt()
+    else:
+        if prompt_family == "gemini":
+            system_content = get_gemini_system_prompt()
+        else:
+            # Use the original prompt - the LLM can only use tools that are registered
+            system_content = get_system_prompt()
+
+        # Add sample response for non-anthropic models
+        if prompt_family != "anthropic":
+            system_content = system_content + "\n\n <sample_assistant_response>" + _get_sample_response() + "</sample_assistant_response>"
+
+    if include_mcp_info:
+        system_content += _build_mcp_info(mcp_tools, mcp_listing_complete, mcp_server_names)
+
+    return system_content
+
+
+def build_system_message(
+    model_name: str,
+    agent_config: Optional[dict] = None,
+    is_agent_builder: bool = False,
+    mcp_wrapper_instance: Optional[MCPToolWrapper] = None
+) -> Dict[str, Any]:
+    """Return the system message for an agent run, reusing a cached assembly when possible.
+
+    Args:
+        model_name: Model the run uses
+        agent_config: Custom agent configuration, if any
+        is_agent_builder: Whether this is an agent builder session
+        mcp_wrapper_instance: Initialized MCP tool wrapper, if the agent has MCPs
+
+    Returns:
+        A new system message dict; its content is identical for identical inputs.
+    """
+    custom_system_prompt = None
+    enabled_tools = None
+    has_mcps = False
+    if agent_config:
+        if agent_config.get('system_prompt'):
+            custom_system_prompt = agent_config['system_prompt'].strip()
+        enabled_tools = agent_config.get('agentpress_tools')
+        has_mcps = bool(agent_config.get('configured_mcps') or agent_config.get('custom_mcps'))
+
+    mcp_tools: List[Dict[str, Any]] = []
+    mcp_listing_complete = True
+    include_mcp_info = has_mcps and mcp_wrapper_instance is not None and mcp_wrapper_instance._initialized
+    if include_mcp_info:
+        mcp_tools, mcp_listing_complete = _get_mcp_tool_listing(mcp_wrapper_instance)
+
+    prompt_family = get_prompt_family(model_name)
+    if not mcp_listing_complete:
+        # A degraded prompt is built for this run only; the next run retries the listing
+        system_content = _assemble_system_content(
+            prompt_family, custom_system_prompt, is_agent_builder, include_mcp_info, mcp_tools,
+            mcp_listing_complete=False, mcp_server_names=_get_mcp_server_names(agent_config)
+        )
+        return {"role": "system", "content": system_content}
+
+    key_material = json.dumps({
+        'prompt_family': prompt_family,
+        'system_prompt': custom_system_prompt,
+        'is_agent_builder': bool(is_agent_builder),
+        'enabled_tools': enabled_tools,
+        'include_mcp_info': include_mcp_info,
+        'mcp_tools': mcp_tools,
+    }, sort_keys=True, default=str)
+    cache_key = hashlib.sha256(key_material.encode('utf-8')).hexdigest()
+
+    with _system_prompt_cache_lock:
+        cached = _system_prompt_cache.get(cache_key)
+        if cached is not None:
+            _system_prompt_cache.move_to_end(cache_key)
+            logger.debug(f"Reusing cached system prompt {cache_key[:12]}")
+            return dict(cached)
+
+    system_content = _assemble_system_content(
+        prompt_family, custom_system_prompt, is_agent_builder, include_mcp_info, mcp_tools
+    )
+    system_message = {"role": "system", "content": system_content}
+
+    with _system_prompt_cache_lock:
+        _system_prompt_cache[cache_key] = system_message
+        _system_prompt_cache.move_to_end(cache_key)
+        while len(_system_prompt_cache) > SYSTEM_PROMPT_CACHE_SIZE:
+            _system_prompt_cache.popitem(last=False)
+
+    logger.debug(f"Assembled system prompt {cache_key[:12]} ({len(system_content)} chars)")
+    return dict(system_message)
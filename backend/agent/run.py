@@ -1,7 +1,7 @@
 import os
 import json
 from uuid import uuid4
-from typing import Optional
+from typing import Any, Awaitable, Callable, Dict, Optional
 
 # from agent.tools.message_tool import MessageTool
 from agent.tools.message_tool import MessageTool
@@ -11,7 +11,6 @@ from agent.tools.web_search_tool import SandboxWebSearchTool
 from dotenv import load_dotenv
 from utils.config import config
 
-from agent.agent_builder_prompt import get_agent_builder_prompt
 from agentpress.thread_manager import ThreadManager
 from agentpress.response_processor import ProcessorConfig
 from agent.tools.sb_shell_tool import SandboxShellTool
@@ -19,7 +18,7 @@ from agent.tools.sb_files_tool import SandboxFilesTool
 from agent.tools.sb_browser_tool import SandboxBrowserTool
 from agent.tools.data_providers_tool import DataProvidersTool
 from agent.tools.expand_msg_tool import ExpandMessageTool
-from agent.prompt import get_system_prompt
+from agent.prompt_builder import build_system_message
 from utils.logger import logger
 from utils.auth_utils import get_account_id_from_thread
 from services.billing import check_billing_status
@@ -34,12 +33,14 @@ except ImportError:
         # Fallback - make StatefulTraceClient optional
         StatefulTraceClient = None
 from services.langfuse import langfuse
-from agent.gemini_prompt import get_gemini_system_prompt
 from agent.tools.mcp_tool_wrapper import MCPToolWrapper
 from agentpress.tool import SchemaType
 
 load_dotenv()
 
+# Length of the longest closing tag that ends a run ('</web-browser-takeover>')
+STOP_TAG_MAX_LEN = len('</web-browser-takeover>')
+
 async def run_agent(
     thread_id: str,
     project_id: str,
@@ -54,9 +55,22 @@ async def run_agent(
     agent_config: Optional[dict] = None,
     trace: Optional["StatefulTraceClient"] = None,
     is_agent_builder: Optional[bool] = False,
-    target_agent_id: Optional[str] = None
+    target_agent_id: Optional[str] = None,
+    checkpoint: Optional[Dict[str, Any]] = None,
+    on_checkpoint: Optional[Callable[[Dict[str, Any]], Awaitable[None]]] = None
 ):
-    """Run the development agent with specified configuration."""
+    """Run the development agent with specified configuration.
+
+    Args:
+        checkpoint: Progress of an earlier execution of this run to resume from
+                    (iteration_count, auto_continue_count); the rest of the state
+                    is rebuilt from the thread's messages
+        on_checkpoint: Called after every completed tool cycle (each auto-continue of
+                       run_thread and the end of each iteration) with the run's progress:
+                       iteration_count (completed iterations), auto_continue_count
+                       (auto-continues of the iteration in progress), last_message_id
+                       and last_message_created_at
+    """
     logger.info("🚀 Starting agent with model: {model_name}")
     if agent_config:
         logger.info("Using custom agent: {agent_config.get('name', 'Unknown')}")
@@ -197,103 +211,41 @@ async def run_agent(
                     logger.error("Failed to initialize MCP tools: {e}")
                     # Continue without MCP tools if initialization fails
 
-    # Prepare system prompt
-    # First, get the default system prompt
-    if "gemini-2.5-flash" in model_name.lower():
-        default_system_content = get_gemini_system_prompt()
-    else:
-        # Use the original prompt - the LLM can only use tools that are registered
-        default_system_content = get_system_prompt()
-
-    # Add sample response for non-anthropic models
-    if "anthropic" not in model_name.lower():
-        sample_response_path = os.path.join(os.path.dirname(__file__), 'sample_responses/1.txt')
-        with open(sample_response_path, 'r') as file:
-            sample_response = file.read()
-        default_system_content = default_system_content + "\n\n <sample_assistant_response>" + sample_response + "</sample_assistant_response>"
-
-    # Handle custom agent system prompt
+    # Prepare system prompt (assembled once per agent configuration and reused across runs)
     if agent_config and agent_config.get('system_prompt'):
-        custom_system_prompt = agent_config['system_prompt'].strip()
-
-        # Completely replace the default system prompt with the custom one
-        # This prevents confusion and tool hallucination
-        system_content = custom_system_prompt
-        logger.info("Using ONLY custom agent system prompt for: {agent_config.get('name', 'Unknown')}")
+        logger.info(f"Using ONLY custom agent system prompt for: {agent_config.get('name', 'Unknown')}")
     elif is_agent_builder:
-        system_content = get_agent_builder_prompt()
         logger.info("Using agent builder system prompt")
     else:
-        # Use just the default system prompt
-        system_content = default_system_content
         logger.info("Using default system prompt only")
-
-    # Add MCP tool information to system prompt if MCP tools are configured
-    if agent_config and (agent_config.get('configured_mcps') or agent_config.get('custom_mcps')) and mcp_wrapper_instance and mcp_wrapper_instance._initialized:
-        mcp_info = "\n\n--- MCP Tools Available ---\n"
-        mcp_info += "You have access to external MCP (Model Context Protocol) server tools.\n"
-        mcp_info += "MCP tools can be called directly using their native function names in the standard function calling format:\n"
-        mcp_info += '<function_calls>\n'
-        mcp_info += '<invoke name="{tool_name}">\n'
-        mcp_info += '<parameter name="param1">value1</parameter>\n'
-        mcp_info += '<parameter name="param2">value2</parameter>\n'
-        mcp_info += '</invoke>\n'
-        mcp_info += '</function_calls>\n\n'
-
-        # List available MCP tools
-        mcp_info += "Available MCP tools:\n"
-        try:
-            # Get the actual registered schemas from the wrapper
-            registered_schemas = mcp_wrapper_instance.get_schemas()
-            for method_name, schema_list in registered_schemas.items():
-                if method_name == 'call_mcp_tool':
-                    continue  # Skip the fallback method
-
-                # Get the schema info
-                for schema in schema_list:
-                    if schema.schema_type == SchemaType.OPENAPI:
-                        func_info = schema.schema.get('function', {})
-                        description = func_info.get('description', 'No description available')
-                        # Extract server name from description if available
-                        server_match = description.find('(MCP Server: ')
-                        if server_match != -1:
-                            server_end = description.find(')', server_match)
-                            server_info = description[server_match:server_end+1]
-                        else:
-                            server_info = ''
-
-                        mcp_info += f"- **{method_name}**: {description}\n"
-
-                        # Show parameter info
-                        params = func_info.get('parameters', {})
-                        props = params.get('properties', {})
-                        if props:
-                            mcp_info += "  Parameters: {', '.join(props.keys())}\n"
-
-        except Exception as e:
-            logger.error("Error listing MCP tools: {e}")
-            mcp_info += "- Error loading MCP tool list\n"
-
-        # Add critical instructions for using search results
-        mcp_info += "\n🚨 CRITICAL MCP TOOL RESULT INSTRUCTIONS 🚨\n"
-        mcp_info += "When you use ANY MCP (Model Context Protocol) tools:\n"
-        mcp_info += "1. ALWAYS read and use the EXACT results returned by the MCP tool\n"
-        mcp_info += "2. For search tools: ONLY cite URLs, sources, and information from the actual search results\n"
-        mcp_info += "3. For any tool: Base your response entirely on the tool's output - do NOT add external information\n"
-        mcp_info += "4. DO NOT fabricate, invent, hallucinate, or make up any sources, URLs, or data\n"
-        mcp_info += "5. If you need more information, call the MCP tool again with different parameters\n"
-        mcp_info += "6. When writing reports/summaries: Reference ONLY the data from MCP tool results\n"
-        mcp_info += "7. If the MCP tool doesn't return enough information, explicitly state this limitation\n"
-        mcp_info += "8. Always double-check that every fact, URL, and reference comes from the MCP tool output\n"
-        mcp_info += "\nIMPORTANT: MCP tool results are your PRIMARY and ONLY source of truth for external data!\n"
-        mcp_info += "NEVER supplement MCP results with your training data or make assumptions beyond what the tools provide.\n"
-
-        system_content += mcp_info
-
-    system_message = { "role": "system", "content": system_content }
-
-    iteration_count = 0
+    system_message = build_system_message(
+        model_name=model_name,
+        agent_config=agent_config,
+        is_agent_builder=is_agent_builder,
+        mcp_wrapper_instance=mcp_wrapper_instance
+    )
+
+    checkpoint = checkpoint or {}
+    iteration_count = checkpoint.get('iteration_count', 0)
+    resumed_auto_continues = checkpoint.get('auto_continue_count', 0)
+    last_message_id = checkpoint.get('last_message_id')
+    last_message_created_at = checkpoint.get('last_message_created_at')
     continue_execution = True
+    if iteration_count or resumed_auto_continues:
+        logger.info(f"Resuming agent run on thread {thread_id} after iteration {iteration_count} ({resumed_auto_continues} auto-continues)")
+
+    async def save_progress(completed_iterations: int, auto_continue_count: int):
+        if on_checkpoint:
+            await on_checkpoint({
+                "iteration_count": completed_iterations,
+                "auto_continue_count": auto_continue_count,
+                "last_message_id": last_message_id,
+                "last_message_created_at": last_message_created_at,
+            })
+
+    async def save_auto_continue_progress(auto_continue_count: int):
+        # The tool results of the cycle are persisted; the iteration itself is still in progress
+        await save_progress(iteration_count - 1, auto_continue_count)
 
     latest_user_message = await client.table('messages').select('*').eq('thread_id', thread_id).eq('type', 'user').order('created_at', desc=True).limit(1).execute()
     if latest_user_message.data and len(latest_user_message.data) > 0:
@@ -303,6 +255,9 @@ async def run_agent(
 
     while continue_execution and iteration_count < max_iterations:
         iteration_count += 1
+        # Only the first iteration of a resumed run continues an interrupted auto-continue chain
+        thread_manager.auto_continue_count = resumed_auto_continues
+        resumed_auto_continues = 0
         logger.info("🔄 Running iteration {iteration_count} of {max_iterations}...")
 
         # Billing check on each iteration - still needed within the iterations
@@ -399,7 +354,7 @@ async def run_agent(
                 else:
                     logger.warning("Image context found for '{file_path}' but missing base64 or mime_type.")
 
-                await client.table('messages').delete().eq('message_id', latest_image_context_msg.data[0]["message_id"]).execute()
+                await thread_manager.delete_message(thread_id, latest_image_context_msg.data[0]["message_id"])
             except Exception as e:
                 logger.error("Error parsing image context: {e}")
                 if trace:
@@ -440,6 +395,7 @@ async def run_agent(
                     xml_adding_strategy="user_message"
                 ),
                 native_max_auto_continues=native_max_auto_continues,
+                on_auto_continue=save_auto_continue_progress if on_checkpoint else None,
                 include_xml_examples=True,
                 enable_thinking=enable_thinking,
                 reasoning_effort=reasoning_effort,
@@ -461,7 +417,6 @@ async def run_agent(
             # Process the response
             error_detected = False
             try:
-                full_response = ""
                 async for chunk in response:
                     # If we receive an error chunk, we should stop after this iteration
                     if isinstance(chunk, dict) and chunk.get('type') == 'status' and chunk.get('status') == 'error':
@@ -511,14 +466,16 @@ async def run_agent(
 
                             # The actual text content is nested within
                             assistant_text = assistant_content_json.get('content', '')
-                            full_response += assistant_text
                             if isinstance(assistant_text, str):
-                                if '</ask>' in assistant_text or '</complete>' in assistant_text or '</web-browser-takeover>' in assistant_text:
-                                   if '</ask>' in assistant_text:
+                                # The processor has already buffered this chunk; look at it plus enough of
+                                # the previous text to catch tags split across chunks
+                                recent_text = thread_manager.response_processor.content_tail(len(assistant_text) + STOP_TAG_MAX_LEN - 1)
+                                if '</ask>' in recent_text or '</complete>' in recent_text or '</web-browser-takeover>' in recent_text:
+                                   if '</ask>' in recent_text:
                                        xml_tool = 'ask'
-                                   elif '</complete>' in assistant_text:
+                                   elif '</complete>' in recent_text:
                                        xml_tool = 'complete'
-                                   elif '</web-browser-takeover>' in assistant_text:
+                                   elif '</web-browser-takeover>' in recent_text:
                                        xml_tool = 'web-browser-takeover'
 
                                    last_tool_call = xml_tool
@@ -535,6 +492,11 @@ async def run_agent(
                             if trace:
                                 trace.event(name="error_processing_assistant_chunk", level="ERROR", status_message=("Error processing assistant chunk: {e}"))
 
+                    # Remember the last persisted message; streamed deltas have no ID
+                    if chunk.get('type') in ('assistant', 'tool') and chunk.get('message_id'):
+                        last_message_id = chunk['message_id']
+                        last_message_created_at = chunk.get('created_at')
+
                     yield chunk
 
                 # Check if we should stop based on the last tool call or error
@@ -543,7 +505,7 @@ async def run_agent(
                     if trace:
                         trace.event(name="stopping_due_to_error_detected_in_response", level="DEFAULT", status_message=("Stopping due to error detected in response"))
                     if generation:
-                        generation.end(output=full_response, status_message="error_detected", level="ERROR")
+                        generation.end(output=full_response.getvalue(), status_message="error_detected", level="ERROR")
                     break
 
                 if agent_should_terminate or last_tool_call in ['ask', 'complete', 'web-browser-takeover']:
@@ -551,9 +513,12 @@ async def run_agent(
                     if trace:
                         trace.event(name="agent_decided_to_stop_with_tool", level="DEFAULT", status_message=("Agent decided to stop with tool: {last_tool_call}"))
                     if generation:
-                        generation.end(output=full_response, status_message="agent_stopped")
+                        generation.end(output=full_response.getvalue(), status_message="agent_stopped")
                     continue_execution = False
 
+                if continue_execution:
+                    await save_progress(iteration_count, 0)
+
             except Exception as e:
                 # Just log the error and re-raise to stop all iterations
                 error_msg = "Error during response streaming: {str(e)}"
@@ -561,7 +526,7 @@ async def run_agent(
                 if trace:
                     trace.event(name="error_during_response_streaming", level="ERROR", status_message=("Error during response streaming: {str(e)}"))
                 if generation:
-                    generation.end(output=full_response, status_message=error_msg, level="ERROR")
+                    generation.end(output=full_response.getvalue(), status_message=error_msg, level="ERROR")
                 yield {
                     "type": "status",
                     "status": "error",
@@ -584,7 +549,19 @@ async def run_agent(
             # Stop execution immediately on any error
             break
         if generation:
-            generation.end(output=full_response)
+            generation.end(output=full_response.getvalue())
+
+    # Report prompt-cache effectiveness for this run
+    cache_usage = thread_manager.response_processor.prompt_cache_usage
+    if cache_usage["llm_calls"]:
+        hit_rate = thread_manager.response_processor.get_prompt_cache_hit_rate()
+        logger.info(
+            f"Prompt cache for thread {thread_id}: {cache_usage['cache_read_input_tokens']} tokens read, "
+            f"{cache_usage['cache_creation_input_tokens']} written, {cache_usage['prompt_tokens']} prompt tokens "
+            f"over {cache_usage['llm_calls']} calls ({hit_rate * 100:.1f}% hit rate)"
+        )
+        if trace:
+            trace.update(metadata={"prompt_cache_usage": cache_usage, "prompt_cache_hit_rate": hit_rate})
 
     # langfuse.flush() # Flush Langfuse events at the end of the run - temporarily disabled
 
@@ -1,3 +1,4 @@
+import asyncio
 import traceback
 import json
 
@@ -46,7 +47,7 @@ class SandboxBrowserTool(SandboxToolsBase):
             logger.debug("\033[95mExecuting curl command:\033[0m")
             logger.debug("{curl_cmd}")
 
-            response = self.sandbox.process.exec(curl_cmd, timeout=30)
+            response = await asyncio.to_thread(self.sandbox.process.exec, curl_cmd, timeout=30)
 
             if response.exit_code == 0:
                 try:
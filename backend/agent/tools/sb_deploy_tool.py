@@ -1,3 +1,4 @@
+import asyncio
 import os
 from dotenv import load_dotenv
 from agentpress.tool import ToolResult, openapi_schema, xml_schema
@@ -87,7 +88,7 @@ class SandboxDeployTool(SandboxToolsBase):
 
             # Verify the directory exists
             try:
-                dir_info = self.sandbox.fs.get_file_info(full_path)
+                dir_info = await asyncio.to_thread(self.sandbox.fs.get_file_info, full_path)
                 if not dir_info.is_dir:
                     return self.fail_response("'{directory_path}' is not a directory")
             except Exception as e:
@@ -107,7 +108,7 @@ class SandboxDeployTool(SandboxToolsBase):
                     npx wrangler pages deploy {full_path} --project-name {project_name}))'''
 
                 # Execute the command directly using the sandbox's process.exec method
-                response = self.sandbox.process.exec(f"/bin/sh -c \"{deploy_cmd}\"",
+                response = await asyncio.to_thread(self.sandbox.process.exec, f"/bin/sh -c \"{deploy_cmd}\"",
                                  timeout=300)
 
                 print(f"Deployment command output: {response.result}")
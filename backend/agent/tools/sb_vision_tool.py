@@ -1,3 +1,4 @@
+import asyncio
 import os
 import base64
 import mimetypes
@@ -142,7 +143,7 @@ class SandboxVisionTool(SandboxToolsBase):
 
             # Check if file exists and get info
             try:
-                file_info = self.sandbox.fs.get_file_info(full_path)
+                file_info = await asyncio.to_thread(self.sandbox.fs.get_file_info, full_path)
                 if file_info.is_dir:
                     return self.fail_response("Path '{cleaned_path}' is a directory, not an image file.")
             except Exception as e:
@@ -154,7 +155,7 @@ class SandboxVisionTool(SandboxToolsBase):
 
             # Read image file content
             try:
-                image_bytes = self.sandbox.fs.download_file(full_path)
+                image_bytes = await asyncio.to_thread(self.sandbox.fs.download_file, full_path)
             except Exception as e:
                 return self.fail_response("Could not read image file: {cleaned_path}")
 
@@ -5,18 +5,26 @@ This module handles token counting and thread summarization to prevent
 reaching the context window limitations of LLM models.
 """
 
+import asyncio
 import json
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Tuple
 
 from litellm import token_counter, completion_cost
 from services.supabase import DBConnection
 from services.llm import make_llm_api_call
 from utils.logger import logger
+from utils.config import config
+from agentpress.tokenizer import count_tokens
 
 # Constants for token management
 DEFAULT_TOKEN_THRESHOLD = 120000  # 80k tokens threshold for summarization
 SUMMARY_TARGET_TOKENS = 10000    # Target ~10k tokens for the summary message
 RESERVE_TOKENS = 5000            # Reserve tokens for new messages
+SUMMARY_KEEP_RECENT_MESSAGES = 6 # Most recent messages kept verbatim after a summary
+
+# Summary message metadata marking the last message covered by the summary
+SUMMARIZED_UNTIL_KEY = "summarized_until"
+SUMMARIZED_UNTIL_MESSAGE_ID_KEY = "summarized_until_message_id"
 
 class ContextManager:
     """Manages thread context including token counting and summarization."""
@@ -29,43 +37,114 @@ class ContextManager:
         """
         self.db = DBConnection()
         self.token_threshold = token_threshold
+        # In-flight background summarization tasks by thread_id
+        self._summary_tasks: Dict[str, asyncio.Task] = {}
+
+    @property
+    def summary_trigger_tokens(self) -> int:
+        """Token count at which a background summary is started ahead of the threshold."""
+        return int(self.token_threshold * config.CONTEXT_SUMMARY_TRIGGER_PERCENT / 100)
+
+    async def get_thread_token_count(self, thread_id: str, model: Optional[str] = None) -> int:
+        """Get the current token count for a thread.
 
-    async def get_thread_token_count(self, thread_id: str) -> int:
-        """Get the current token count for a thread using LiteLLM.
+        The count is estimated and only computed exactly with the model's
+        tokenizer when the estimate is near the token threshold.
 
         Args:
             thread_id: ID of the thread to analyze
+            model: Model whose tokenizer is used (defaults to MODEL_TO_USE)
 
         Returns:
             The total token count for relevant messages in the thread
         """
-        logger.debug("Getting token count for thread {thread_id}")
+        logger.debug(f"Getting token count for thread {thread_id}")
 
         try:
             # Get messages for the thread
             messages = await self.get_messages_for_summarization(thread_id)
 
             if not messages:
-                logger.debug("No messages found for thread {thread_id}")
+                logger.debug(f"No messages found for thread {thread_id}")
                 return 0
 
-            # Use litellm's token_counter for accurate model-specific counting
-            # This is much more accurate than the SQL-based estimation
-            token_count = token_counter(model="gpt-4", messages=messages)
+            token_count = count_tokens(messages, model or config.MODEL_TO_USE, limit=self.token_threshold)
 
-            logger.info("Thread {thread_id} has {token_count} tokens (calculated with litellm)")
+            logger.info(f"Thread {thread_id} has {token_count} tokens")
             return token_count
 
         except Exception as e:
-            logger.error("Error getting token count: {str(e)}")
+            logger.error(f"Error getting token count: {str(e)}")
             return 0
 
+    async def _get_rows_since_last_summary(
+        self,
+        thread_id: str
+    ) -> Tuple[Optional[Dict[str, Any]], List[Dict[str, Any]]]:
+        """Get the latest summary row and the LLM message rows it does not cover.
+
+        The boundary is the last message covered by the summary, stored in the
+        summary's metadata. Summaries written before the boundary was recorded
+        fall back to the summary's own created_at.
+
+        Args:
+            thread_id: ID of the thread to read
+
+        Returns:
+            Tuple of (latest summary row or None, message rows after its boundary)
+        """
+        client = await self.db.client
+
+        summary_result = await client.table('messages').select('message_id, content, metadata, created_at') \
+            .eq('thread_id', thread_id) \
+            .eq('type', 'summary') \
+            .eq('is_llm_message', True) \
+            .order('created_at', desc=True) \
+            .limit(1) \
+            .execute()
+
+        query = client.table('messages').select('message_id, type, content, created_at') \
+            .eq('thread_id', thread_id) \
+            .eq('is_llm_message', True) \
+            .neq('type', 'summary')
+
+        summary_row = summary_result.data[0] if summary_result.data else None
+        if summary_row:
+            metadata = summary_row.get('metadata') or {}
+            boundary = metadata.get(SUMMARIZED_UNTIL_KEY) or summary_row['created_at']
+            logger.debug(f"Found last summary for thread {thread_id} covering messages until {boundary}")
+            query = query.gt('created_at', boundary)
+        else:
+            logger.debug(f"No previous summary found for thread {thread_id}, getting all messages")
+
+        messages_result = await query.order('created_at').execute()
+        return summary_row, messages_result.data or []
+
+    @staticmethod
+    def _row_to_message(row: Dict[str, Any]) -> Dict[str, Any]:
+        """Convert a messages row into an LLM message dict."""
+        content = row['content']
+        if isinstance(content, str):
+            try:
+                content = json.loads(content)
+            except json.JSONDecodeError:
+                pass  # Keep as string if not valid JSON
+
+        # Ensure we have the proper format for the LLM
+        if not isinstance(content, dict) or 'role' not in content:
+            # Convert message type to role if needed
+            role = row.get('type')
+            if role in ('assistant', 'user', 'system', 'tool'):
+                content = {'role': role, 'content': content}
+
+        return content
+
     async def get_messages_for_summarization(self, thread_id: str) -> List[Dict[str, Any]]:
         """Get all LLM messages from the thread that need to be summarized.
 
-        This gets messages after the most recent summary or all messages if
-        no summary exists. Unlike get_llm_messages, this includes ALL messages
-        since the last summary, even if we're generating a new summary.
+        This gets the messages after the boundary of the most recent summary, or
+        all messages if no summary exists. The previous summary itself is not
+        included.
 
         Args:
             thread_id: ID of the thread to get messages from
@@ -73,70 +152,16 @@ class ContextManager:
         Returns:
             List of message objects to summarize
         """
-        logger.debug("Getting messages for summarization for thread {thread_id}")
-        client = await self.db.client
+        logger.debug(f"Getting messages for summarization for thread {thread_id}")
 
         try:
-            # Find the most recent summary message
-            summary_result = await client.table('messages').select('created_at') \
-                .eq('thread_id', thread_id) \
-                .eq('type', 'summary') \
-                .eq('is_llm_message', True) \
-                .order('created_at', desc=True) \
-                .limit(1) \
-                .execute()
-
-            # Get messages after the most recent summary or all messages if no summary
-            if summary_result.data and len(summary_result.data) > 0:
-                last_summary_time = summary_result.data[0]['created_at']
-                logger.debug("Found last summary at {last_summary_time}")
-
-                # Get all messages after the summary, but NOT including the summary itself
-                messages_result = await client.table('messages').select('*') \
-                    .eq('thread_id', thread_id) \
-                    .eq('is_llm_message', True) \
-                    .gt('created_at', last_summary_time) \
-                    .order('created_at') \
-                    .execute()
-            else:
-                logger.debug("No previous summary found, getting all messages")
-                # Get all messages
-                messages_result = await client.table('messages').select('*') \
-                    .eq('thread_id', thread_id) \
-                    .eq('is_llm_message', True) \
-                    .order('created_at') \
-                    .execute()
-
-            # Parse the message content if needed
-            messages = []
-            for msg in messages_result.data:
-                # Skip existing summary messages - we don't want to summarize summaries
-                if msg.get('type') == 'summary':
-                    logger.debug(f"Skipping summary message from {msg.get('created_at')}")
-                    continue
-
-                # Parse content if it's a string
-                content = msg['content']
-                if isinstance(content, str):
-                    try:
-                        content = json.loads(content)
-                    except json.JSONDecodeError:
-                        pass  # Keep as string if not valid JSON
-
-                # Ensure we have the proper format for the LLM
-                if 'role' not in content and 'type' in msg:
-                    # Convert message type to role if needed
-                    role = msg['type']
-                    if role == 'assistant' or role == 'user' or role == 'system' or role == 'tool':
-                        content = {'role': role, 'content': content}
-
-                messages.append(content)
-
-            logger.info("Got {len(messages)} messages to summarize for thread {thread_id}")
+            _, rows = await self._get_rows_since_last_summary(thread_id)
+            messages = [self._row_to_message(row) for row in rows]
+            logger.info(f"Got {len(messages)} messages to summarize for thread {thread_id}")
             return messages
 
         except Exception as e:
-            logger.error("Error getting messages for summarization: {str(e)}", exc_info=True)
+            logger.error(f"Error getting messages for summarization: {str(e)}", exc_info=True)
             return []
 
     async def create_summary(
@@ -164,7 +189,7 @@ class ContextManager:
         # Create system message with summarization instructions
         system_message = {
             "role": "system",
-            "content": """You are a specialized summarization assistant. Your task is to create a concise but comprehensive summary of the conversation history.
+            "content": f"""You are a specialized summarization assistant. Your task is to create a concise but comprehensive summary of the conversation history.
 
 The summary should:
 1. Preserve all key information including decisions, conclusions, and important context
@@ -180,7 +205,7 @@ VERY IMPORTANT: This summary will replace older parts of the conversation in the
 THE CONVERSATION HISTORY TO SUMMARIZE IS AS FOLLOWS:
 ===============================================================
 ==================== CONVERSATION HISTORY ====================
-{messages}
+{json.dumps(messages, ensure_ascii=False, default=str)}
 ==================== END OF CONVERSATION HISTORY ====================
 ===============================================================
 """
@@ -203,12 +228,12 @@ THE CONVERSATION HISTORY TO SUMMARIZE IS AS FOLLOWS:
                 try:
                     token_count = token_counter(model=model, messages=[{"role": "user", "content": summary_content}])
                     cost = completion_cost(model=model, prompt="", completion=summary_content)
-                    logger.info("Summary generated with {token_count} tokens at cost ${cost:.6f}")
+                    logger.info(f"Summary generated with {token_count} tokens at cost ${cost:.6f}")
                 except Exception as e:
-                    logger.error("Error calculating token usage: {str(e)}")
+                    logger.error(f"Error calculating token usage: {str(e)}")
 
                 # Format the summary message with clear beginning and end markers
-                formatted_summary = """
+                formatted_summary = f"""
 ======== CONVERSATION HISTORY SUMMARY ========
 
 {summary_content}
@@ -230,9 +255,124 @@ The above is a summary of the conversation history. The conversation continues b
                 return None
 
         except Exception as e:
-            logger.error("Error creating summary: {str(e)}", exc_info=True)
+            logger.error(f"Error creating summary: {str(e)}", exc_info=True)
             return None
 
+    async def summarize_thread(
+        self,
+        thread_id: str,
+        add_message_callback,
+        model: str = "gpt-4o-mini",
+        token_count: Optional[int] = None
+    ) -> bool:
+        """Summarize the messages not covered by the latest summary and store the result.
+
+        The previous summary (if any) is fed back in so the new summary carries
+        its information forward. The most recent messages are left out of the
+        summary and stay verbatim in the prompt; the boundary never separates a
+        tool result from the assistant message that requested it.
+
+        Args:
+            thread_id: ID of the thread to summarize
+            add_message_callback: Callback to add the summary message to the thread
+            model: LLM model to use for summarization
+            token_count: Token count of the thread, recorded in the summary metadata
+
+        Returns:
+            True if a summary message was added, False otherwise
+        """
+        previous_summary, rows = await self._get_rows_since_last_summary(thread_id)
+
+        # Keep the most recent messages verbatim; don't start the kept tail on a tool result
+        cut = len(rows) - SUMMARY_KEEP_RECENT_MESSAGES
+        while cut > 0 and self._row_to_message(rows[cut]).get('role') == 'tool':
+            cut -= 1
+        rows_to_summarize = rows[:max(cut, 0)]
+
+        # If there are too few messages, don't summarize
+        if len(rows_to_summarize) < 3:
+            logger.info(f"Thread {thread_id} has too few messages ({len(rows_to_summarize)}) to summarize")
+            return False
+
+        messages = [self._row_to_message(row) for row in rows_to_summarize]
+        if previous_summary:
+            messages.insert(0, self._row_to_message(previous_summary))
+
+        summary = await self.create_summary(thread_id, messages, model)
+        if not summary:
+            logger.error(f"Failed to create summary for thread {thread_id}")
+            return False
+
+        boundary_row = rows_to_summarize[-1]
+        await add_message_callback(
+            thread_id=thread_id,
+            type="summary",
+            content=summary,
+            is_llm_message=True,
+            metadata={
+                "token_count": token_count,
+                SUMMARIZED_UNTIL_KEY: boundary_row['created_at'],
+                SUMMARIZED_UNTIL_MESSAGE_ID_KEY: boundary_row['message_id'],
+            }
+        )
+
+        logger.info(f"Successfully added summary to thread {thread_id} covering {len(rows_to_summarize)} messages")
+        return True
+
+    def maybe_start_background_summary(
+        self,
+        thread_id: str,
+        token_count: int,
+        add_message_callback,
+        model: str = "gpt-4o-mini"
+    ) -> bool:
+        """Start summarizing a thread in the background once it nears the token threshold.
+
+        Summarization runs ahead of the threshold so the summary is ready for a
+        later LLM turn instead of blocking the current one. At most one pass per
+        thread runs at a time.
+
+        Args:
+            thread_id: ID of the thread to check
+            token_count: Current prompt token count of the thread
+            add_message_callback: Callback to add the summary message to the thread
+            model: LLM model to use for summarization
+
+        Returns:
+            True if a background summarization task was started, False otherwise
+        """
+        if not config.CONTEXT_BACKGROUND_SUMMARIZATION or token_count < self.summary_trigger_tokens:
+            return False
+
+        task = self._summary_tasks.get(thread_id)
+        if task is not None and not task.done():
+            logger.debug(f"Background summarization already running for thread {thread_id}")
+            return False
+
+        logger.info(f"Thread {thread_id} reached {token_count}/{self.token_threshold} tokens, starting background summarization")
+        self._summary_tasks[thread_id] = asyncio.create_task(
+            self._summarize_in_background(thread_id, token_count, add_message_callback, model)
+        )
+        return True
+
+    async def _summarize_in_background(
+        self,
+        thread_id: str,
+        token_count: int,
+        add_message_callback,
+        model: str
+    ) -> None:
+        """Run summarize_thread as a background task, logging instead of raising."""
+        try:
+            await self.summarize_thread(thread_id, add_message_callback, model, token_count)
+        except asyncio.CancelledError:
+            logger.info(f"Background summarization cancelled for thread {thread_id}")
+            raise
+        except Exception as e:
+            logger.error(f"Error in background summarization for thread {thread_id}: {str(e)}", exc_info=True)
+        finally:
+            self._summary_tasks.pop(thread_id, None)
+
     async def check_and_summarize_if_needed(
         self,
         thread_id: str,
@@ -253,46 +393,21 @@ The above is a summary of the conversation history. The conversation continues b
         """
         try:
             # Get token count using LiteLLM (accurate model-specific counting)
-            token_count = await self.get_thread_token_count(thread_id)
+            token_count = await self.get_thread_token_count(thread_id, model)
 
             # If token count is below threshold and not forcing, no summarization needed
             if token_count < self.token_threshold and not force:
-                logger.debug("Thread {thread_id} has {token_count} tokens, below threshold {self.token_threshold}")
+                logger.debug(f"Thread {thread_id} has {token_count} tokens, below threshold {self.token_threshold}")
                 return False
 
             # Log reason for summarization
             if force:
-                logger.info("Forced summarization of thread {thread_id} with {token_count} tokens")
+                logger.info(f"Forced summarization of thread {thread_id} with {token_count} tokens")
             else:
-                logger.info("Thread {thread_id} exceeds token threshold ({token_count} >= {self.token_threshold}), summarizing...")
-
-            # Get messages to summarize
-            messages = await self.get_messages_for_summarization(thread_id)
+                logger.info(f"Thread {thread_id} exceeds token threshold ({token_count} >= {self.token_threshold}), summarizing...")
 
-            # If there are too few messages, don't summarize
-            if len(messages) < 3:
-                logger.info("Thread {thread_id} has too few messages ({len(messages)}) to summarize")
-                return False
-
-            # Create summary
-            summary = await self.create_summary(thread_id, messages, model)
-
-            if summary:
-                # Add summary message to thread
-                await add_message_callback(
-                    thread_id=thread_id,
-                    type="summary",
-                    content=summary,
-                    is_llm_message=True,
-                    metadata={"token_count": token_count}
-                )
-
-                logger.info("Successfully added summary to thread {thread_id}")
-                return True
-            else:
-                logger.error("Failed to create summary for thread {thread_id}")
-                return False
+            return await self.summarize_thread(thread_id, add_message_callback, model, token_count)
 
         except Exception as e:
-            logger.error("Error in check_and_summarize_if_needed: {str(e)}", exc_info=True)
+            logger.error(f"Error in check_and_summarize_if_needed: {str(e)}", exc_info=True)
             return False
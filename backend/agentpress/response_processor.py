@@ -19,6 +19,9 @@ from utils.logger import logger
 from agentpress.tool import ToolResult
 from agentpress.tool_registry import ToolRegistry
 from agentpress.xml_tool_parser import XMLToolParser
+from agentpress.xml_stream_parser import StreamingXMLChunkParser, extract_xml_chunks
+from agentpress.utils.compaction import COMPACT_METADATA_KEY, build_compact_metadata
+from agentpress.utils.chunk_buffer import ChunkBuffer
 try:
     from langfuse.client import StatefulTraceClient
 except ImportError:
@@ -40,6 +43,9 @@ XmlAddingStrategy = Literal["user_message", "assistant_message", "inline_edit"]
 # Type alias for tool execution strategy
 ToolExecutionStrategy = Literal["sequential", "parallel"]
 
+# Prompt-cache token counts reported by Anthropic in the response usage
+PROMPT_CACHE_USAGE_FIELDS = ("cache_read_input_tokens", "cache_creation_input_tokens")
+
 @dataclass
 class ToolExecutionContext:
     """Context for a tool execution including call details, result, and display info."""
@@ -111,6 +117,51 @@ class ResponseProcessor:
         self.xml_parser = XMLToolParser(strict_mode=False)
         self.is_agent_builder = is_agent_builder
         self.target_agent_id = target_agent_id
+        # Prompt-cache usage summed over all LLM calls of this processor (one agent run)
+        self.prompt_cache_usage = {"llm_calls": 0, "prompt_tokens": 0, "cache_read_input_tokens": 0, "cache_creation_input_tokens": 0}
+        # Assistant content of the response being streamed (see content_tail)
+        self._content_buffer: Optional[ChunkBuffer] = None
+
+    def _record_prompt_cache_usage(self, usage: Any) -> None:
+        """Add the prompt and prompt-cache token counts of one LLM call to the run totals."""
+        if not usage:
+            return
+
+        def _get(field: str) -> int:
+            value = usage.get(field) if isinstance(usage, dict) else getattr(usage, field, None)
+            return value if isinstance(value, int) else 0
+
+        cache_read = _get("cache_read_input_tokens")
+        cache_creation = _get("cache_creation_input_tokens")
+        self.prompt_cache_usage["llm_calls"] += 1
+        self.prompt_cache_usage["prompt_tokens"] += _get("prompt_tokens")
+        self.prompt_cache_usage["cache_read_input_tokens"] += cache_read
+        self.prompt_cache_usage["cache_creation_input_tokens"] += cache_creation
+        logger.debug(f"Prompt cache: read={cache_read}, created={cache_creation}, prompt={_get('prompt_tokens')}")
+
+    def content_tail(self, max_chars: int) -> str:
+        """Return the end of the assistant content streamed so far in the current response.
+
+        Reads the processor's chunk buffer without joining it, so consumers that only
+        check the end of the stream (e.g. for stop tags) don't keep their own copy of
+        the response. The content includes any reasoning text, as in the saved message.
+
+        Args:
+            max_chars: Maximum number of characters to return
+
+        Returns:
+            Up to max_chars characters, or an empty string before the first response
+        """
+        if self._content_buffer is None:
+            return ""
+        return self._content_buffer.tail(max_chars)
+
+    def get_prompt_cache_hit_rate(self) -> float:
+        """Fraction of prompt tokens served from the prompt cache so far in this run."""
+        prompt_tokens = self.prompt_cache_usage["prompt_tokens"]
+        if prompt_tokens <= 0:
+            return 0.0
+        return self.prompt_cache_usage["cache_read_input_tokens"] / prompt_tokens
 
     async def _yield_message(self, message_obj: Optional[Dict[str, Any]]) -> Dict[str, Any]:
         """Helper to yield a message with proper formatting.
@@ -140,9 +191,10 @@ class ResponseProcessor:
         Yields:
             Complete message objects matching the DB schema, except for content chunks.
         """
-        accumulated_content = ""
+        content_buffer = ChunkBuffer() # Joined once into accumulated_content after the stream ends
+        self._content_buffer = content_buffer
         tool_calls_buffer = {}
-        current_xml_content = ""
+        xml_stream_parser = StreamingXMLChunkParser(self.tool_registry.xml_tools.keys())
         xml_chunks_buffer = []
         pending_tool_executions = []
         yielded_tool_indices = set() # Stores indices of tools whose *status* has been yielded
@@ -213,6 +265,9 @@ class ResponseProcessor:
                         streaming_metadata["usage"]["completion_tokens"] = chunk.usage.completion_tokens
                     if hasattr(chunk.usage, 'total_tokens') and chunk.usage.total_tokens is not None:
                         streaming_metadata["usage"]["total_tokens"] = chunk.usage.total_tokens
+                    for cache_field in PROMPT_CACHE_USAGE_FIELDS:
+                        if getattr(chunk.usage, cache_field, None) is not None:
+                            streaming_metadata["usage"][cache_field] = getattr(chunk.usage, cache_field)
 
                 if hasattr(chunk, 'choices') and chunk.choices and hasattr(chunk.choices[0], 'finish_reason') and chunk.choices[0].finish_reason:
                     finish_reason = chunk.choices[0].finish_reason
@@ -228,14 +283,13 @@ class ResponseProcessor:
                             has_printed_thinking_prefix = True
                         # print(delta.reasoning_content, end='', flush=True)
                         # Append reasoning to main content to be saved in the final message
-                        accumulated_content += delta.reasoning_content
+                        content_buffer.append(delta.reasoning_content)
 
                     # Process content chunk
                     if delta and hasattr(delta, 'content') and delta.content:
                         chunk_content = delta.content
                         # print(chunk_content, end='', flush=True)
-                        accumulated_content += chunk_content
-                        current_xml_content += chunk_content
+                        content_buffer.append(chunk_content)
 
                         if not (config.max_xml_tool_calls > 0 and xml_tool_call_count >= config.max_xml_tool_calls):
                             # Yield ONLY content chunk (don't save)
@@ -256,9 +310,8 @@ class ResponseProcessor:
 
                         # --- Process XML Tool Calls (if enabled and limit not reached) ---
                         if config.xml_tool_calling and not (config.max_xml_tool_calls > 0 and xml_tool_call_count >= config.max_xml_tool_calls):
-                            xml_chunks = self._extract_xml_chunks(current_xml_content)
-                            for xml_chunk in xml_chunks:
-                                current_xml_content = current_xml_content.replace(xml_chunk, "", 1)
+                            # Only the new delta is scanned; chunks are returned once their closing tag arrives
+                            for xml_chunk in xml_stream_parser.feed(chunk_content):
                                 xml_chunks_buffer.append(xml_chunk)
                                 result = self._parse_xml_tool_call(xml_chunk)
                                 if result:
@@ -361,6 +414,7 @@ class ResponseProcessor:
             # print() # Add a final newline after the streaming loop finishes
 
             # --- After Streaming Loop ---
+            accumulated_content = content_buffer.getvalue()
 
             if (
                 streaming_metadata["usage"]["total_tokens"] == 0
@@ -389,6 +443,8 @@ class ResponseProcessor:
                 )
 
 
+            self._record_prompt_cache_usage(streaming_metadata["usage"])
+
             # Wait for pending tool executions from streaming phase
             tool_results_buffer = [] # Stores (tool_call, result, tool_index, context)
             if pending_tool_executions:
@@ -544,9 +600,6 @@ class ResponseProcessor:
                  # Gather XML tool calls from buffer (up to limit)
                 parsed_xml_data = []
                 if config.xml_tool_calling:
-                    # Reparse remaining content just in case (should be empty if processed correctly)
-                    xml_chunks = self._extract_xml_chunks(current_xml_content)
-                    xml_chunks_buffer.extend(xml_chunks)
                     # Process only chunks not already handled in the stream loop
                     remaining_limit = config.max_xml_tool_calls - xml_tool_call_count if config.max_xml_tool_calls > 0 else len(xml_chunks_buffer)
                     xml_chunks_to_process = xml_chunks_buffer[:remaining_limit] # Ensure limit is respected
@@ -865,6 +918,7 @@ class ResponseProcessor:
                      logger.info("Non-streaming finish_reason: {finish_reason}")
                      if self.trace:
                          self.trace.event(name="non_streaming_finish_reason", level="DEFAULT", status_message=("Non-streaming finish_reason: {finish_reason}"))
+                 self._record_prompt_cache_usage(getattr(llm_response, 'usage', None))
                  response_message = llm_response.choices[0].message if hasattr(llm_response.choices[0], 'message') else None
                  if response_message:
                      if hasattr(response_message, 'content') and response_message.content:
@@ -1100,93 +1154,14 @@ class ResponseProcessor:
             return None
 
     def _extract_xml_chunks(self, content: str) -> List[str]:
-        """Extract complete XML chunks using start and end pattern matching."""
+        """Extract complete XML chunks (<function_calls> blocks and registered legacy tags) from content."""
         chunks = []
-        pos = 0
 
         try:
-            # First, look for new format <function_calls> blocks
-            start_pattern = '<function_calls>'
-            end_pattern = '</function_calls>'
-
-            while pos < len(content):
-                # Find the next function_calls block
-                start_pos = content.find(start_pattern, pos)
-                if start_pos == -1:
-                    break
-
-                # Find the matching end tag
-                end_pos = content.find(end_pattern, start_pos)
-                if end_pos == -1:
-                    break
-
-                # Extract the complete block including tags
-                chunk_end = end_pos + len(end_pattern)
-                chunk = content[start_pos:chunk_end]
-                chunks.append(chunk)
-
-                # Move position past this chunk
-                pos = chunk_end
-
-            # If no new format found, fall back to old format for backwards compatibility
-            if not chunks:
-                pos = 0
-                while pos < len(content):
-                    # Find the next tool tag
-                    next_tag_start = -1
-                    current_tag = None
-
-                    # Find the earliest occurrence of any registered tag
-                    for tag_name in self.tool_registry.xml_tools.keys():
-                        start_pattern = '<{tag_name}'
-                        tag_pos = content.find(start_pattern, pos)
-
-                        if tag_pos != -1 and (next_tag_start == -1 or tag_pos < next_tag_start):
-                            next_tag_start = tag_pos
-                            current_tag = tag_name
-
-                    if next_tag_start == -1 or not current_tag:
-                        break
-
-                    # Find the matching end tag
-                    end_pattern = '</{current_tag}>'
-                    tag_stack = []
-                    chunk_start = next_tag_start
-                    current_pos = next_tag_start
-
-                    while current_pos < len(content):
-                        # Look for next start or end tag of the same type
-                        next_start = content.find(f'<{current_tag}', current_pos + 1)
-                        next_end = content.find(end_pattern, current_pos)
-
-                        if next_end == -1:  # No closing tag found
-                            break
-
-                        if next_start != -1 and next_start < next_end:
-                            # Found nested start tag
-                            tag_stack.append(next_start)
-                            current_pos = next_start + 1
-                        else:
-                            # Found end tag
-                            if not tag_stack:  # This is our matching end tag
-                                chunk_end = next_end + len(end_pattern)
-                                chunk = content[chunk_start:chunk_end]
-                                chunks.append(chunk)
-                                pos = chunk_end
-                                break
-                            else:
-                                # Pop nested tag
-                                tag_stack.pop()
-                                current_pos = next_end + 1
-
-                    if current_pos >= len(content):  # Reached end without finding closing tag
-                        break
-
-                    pos = max(pos + 1, current_pos)
-
+            chunks = extract_xml_chunks(content, self.tool_registry.xml_tools.keys())
         except Exception as e:
-            logger.error("Error extracting XML chunks: {e}")
-            logger.error("Content was: {content}")
+            logger.error(f"Error extracting XML chunks: {e}")
+            logger.error(f"Content was: {content}")
             if self.trace:
                 self.trace.event(name="error_extracting_xml_chunks", level="ERROR", status_message=(f"Error extracting XML chunks: {e}"), metadata={"content": content})
 
@@ -1622,13 +1597,7 @@ class ResponseProcessor:
 
                 # Add as a tool message to the conversation history
                 # This makes the result visible to the LLM in the next turn
-                message_obj = await self.add_message(
-                    thread_id=thread_id,
-                    type="tool",  # Special type for tool responses
-                    content=tool_message,
-                    is_llm_message=True,
-                    metadata=metadata
-                )
+                message_obj = await self._add_tool_result_message(thread_id, tool_message, metadata)
                 return message_obj # Return the full message object
 
             # Check if this is an MCP tool (function_name starts with "call_mcp_tool")
@@ -1668,13 +1637,7 @@ class ResponseProcessor:
                 if self.trace:
                     self.trace.event(name="adding_mcp_tool_result_simplified", level="DEFAULT", status_message="Adding MCP tool result with simplified format for LLM visibility")
 
-                message_obj = await self.add_message(
-                    thread_id=thread_id,
-                    type="tool",
-                    content=simple_message,
-                    is_llm_message=True,
-                    metadata=metadata
-                )
+                message_obj = await self._add_tool_result_message(thread_id, simple_message, metadata)
                 return message_obj
 
             # For XML and other non-native tools, use the new structured format
@@ -1690,13 +1653,7 @@ class ResponseProcessor:
                 "role": result_role,
                 "content":  json.dumps(structured_result)
             }
-            message_obj = await self.add_message(
-                thread_id=thread_id,
-                type="tool",
-                content=result_message,
-                is_llm_message=True,
-                metadata=metadata
-            )
+            message_obj = await self._add_tool_result_message(thread_id, result_message, metadata)
             return message_obj # Return the full message object
         except Exception as e:
             logger.error("Error adding tool result: {str(e)}", exc_info=True)
@@ -1722,6 +1679,38 @@ class ResponseProcessor:
                     self.trace.event(name="failed_even_with_fallback_message", level="ERROR", status_message=(f"Failed even with fallback message: {str(e2)}"), metadata={"tool_call": tool_call, "result": result, "strategy": strategy, "assistant_message_id": assistant_message_id, "parsing_details": parsing_details})
                 return None # Return None on error
 
+    async def _add_tool_result_message(
+        self,
+        thread_id: str,
+        message: Dict[str, Any],
+        metadata: Dict[str, Any]
+    ) -> Optional[Dict[str, Any]]:
+        """Store a tool result message, with a precomputed compact form if it is large.
+
+        The message_id is generated here so the compact form can point the LLM to
+        the expand-message tool for the full result.
+
+        Args:
+            thread_id: ID of the conversation thread
+            message: LLM message holding the tool result
+            metadata: Message metadata
+
+        Returns:
+            The stored message object
+        """
+        message_id = str(uuid.uuid4())
+        compact = build_compact_metadata(message, message_id)
+        if compact:
+            metadata = {**metadata, COMPACT_METADATA_KEY: compact}
+        return await self.add_message(
+            thread_id=thread_id,
+            type="tool",
+            content=message,
+            is_llm_message=True,
+            metadata=metadata,
+            message_id=message_id
+        )
+
     def _create_structured_tool_result(self, tool_call: Dict[str, Any], result: ToolResult, parsing_details: Optional[Dict[str, Any]] = None):
         """Create a structured tool result format that's tool-agnostic and provides rich information.
 
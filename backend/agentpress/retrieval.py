@@ -0,0 +1,121 @@
+"""
+Local retrieval over old tool results for AgentPress threads.
+
+When a thread grows large, older tool results are replaced by their compact
+form in the prompt and the model has to call expand-message to see them
+again. In retrieval mode, ThreadManager keeps an in-process BM25 index per
+thread over tool result passages, built incrementally as tool results are
+stored, and adds the passages most relevant to the latest turn to the prompt
+within a token budget. Everything runs locally; no embedding service is used.
+"""
+
+import math
+import re
+from collections import Counter
+from dataclasses import dataclass
+from typing import Dict, Iterable, List, Optional, Set
+
+# Passages are cut on line boundaries to roughly this many characters
+PASSAGE_CHARS = 1200
+
+# BM25 parameters
+BM25_K1 = 1.5
+BM25_B = 0.75
+
+_TERM_PATTERN = re.compile(r"[a-z0-9_]{2,}")
+
+
+def tokenize(text: str) -> List[str]:
+    """Split text into lowercase index terms."""
+    return _TERM_PATTERN.findall(text.lower())
+
+
+def split_passages(text: str, passage_chars: int = PASSAGE_CHARS) -> List[str]:
+    """Split text into passages of about passage_chars characters, preferring line boundaries."""
+    passages = []
+    current = []
+    current_len = 0
+    for line in text.splitlines(keepends=True):
+        while len(line) > passage_chars:
+            if current:
+                passages.append("".join(current))
+                current, current_len = [], 0
+            passages.append(line[:passage_chars])
+            line = line[passage_chars:]
+        if current_len + len(line) > passage_chars and current:
+            passages.append("".join(current))
+            current, current_len = [], 0
+        current.append(line)
+        current_len += len(line)
+    if current:
+        passages.append("".join(current))
+    return [passage for passage in passages if passage.strip()]
+
+
+@dataclass
+class Passage:
+    """A passage of a stored tool result."""
+    message_id: str
+    text: str
+    length: int
+
+
+class ToolResultIndex:
+    """Incremental BM25 index over the tool result passages of one thread."""
+
+    def __init__(self):
+        self.passages: List[Passage] = []
+        self._postings: Dict[str, Dict[int, int]] = {}
+        self._total_length = 0
+        self._message_ids: Set[str] = set()
+
+    def __len__(self) -> int:
+        return len(self.passages)
+
+    def __contains__(self, message_id: str) -> bool:
+        return message_id in self._message_ids
+
+    def add(self, message_id: str, text: str) -> None:
+        """Index the passages of a tool result. Adding the same message twice is a no-op."""
+        if message_id in self._message_ids or not text:
+            return
+        self._message_ids.add(message_id)
+        for passage_text in split_passages(text):
+            terms = tokenize(passage_text)
+            if not terms:
+                continue
+            index = len(self.passages)
+            self.passages.append(Passage(message_id=message_id, text=passage_text, length=len(terms)))
+            self._total_length += len(terms)
+            for term, frequency in Counter(terms).items():
+                self._postings.setdefault(term, {})[index] = frequency
+
+    def search(self, query: str, limit: int = 10, message_ids: Optional[Iterable[str]] = None) -> List[Passage]:
+        """Return the passages most relevant to a query, best first.
+
+        Args:
+            query: Free text to match
+            limit: Maximum number of passages to return
+            message_ids: Only return passages of these messages, if given
+        """
+        if not self.passages:
+            return []
+        allowed = set(message_ids) if message_ids is not None else None
+        passage_count = len(self.passages)
+        average_length = self._total_length / passage_count
+
+        scores: Dict[int, float] = {}
+        for term in set(tokenize(query)):
+            postings = self._postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (passage_count - len(postings) + 0.5) / (len(postings) + 0.5))
+            for index, frequency in postings.items():
+                passage = self.passages[index]
+                if allowed is not None and passage.message_id not in allowed:
+                    continue
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * passage.length / average_length)
+                scores[index] = scores.get(index, 0.0) + idf * frequency * (BM25_K1 + 1) / (frequency + norm)
+
+        ranked = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:limit]
+        return [self.passages[index] for index, _ in ranked]
@@ -10,18 +10,35 @@ This module provides comprehensive conversation management, including:
 - Context summarization to manage token limits
 """
 
+import asyncio
 import json
-from typing import List, Dict, Any, Optional, Type, Union, AsyncGenerator, Literal
+import uuid
+from typing import List, Dict, Any, Optional, Tuple, Type, Union, AsyncGenerator, Literal, Callable, Awaitable
 from services.llm import make_llm_api_call
 from agentpress.tool import Tool
 from agentpress.tool_registry import ToolRegistry
-from agentpress.context_manager import ContextManager
+from agentpress.context_manager import ContextManager, SUMMARIZED_UNTIL_MESSAGE_ID_KEY
+from agentpress.tokenizer import (
+    MessageTokenCache,
+    TOKEN_COUNTS_METADATA_KEY,
+    token_counts_for_metadata,
+    tokenizer_key,
+    tokenizer_registry,
+)
+from agentpress.retrieval import ToolResultIndex
+from agentpress.utils.compaction import (
+    COMPACT_METADATA_KEY,
+    COMPACT_MIN_TOKENS,
+    cap_latest_tool_content,
+    compact_tool_content,
+)
 from agentpress.response_processor import (
     ResponseProcessor,
     ProcessorConfig
 )
 from services.supabase import DBConnection
 from utils.logger import logger
+from utils.config import config
 try:
     from langfuse.client import StatefulGenerationClient, StatefulTraceClient
 except ImportError:
@@ -37,6 +54,9 @@ import datetime
 # Type alias for tool choice
 ToolChoice = Literal["auto", "required", "none"]
 
+# Non-LLM message types that are written behind in batches rather than inserted synchronously
+WRITE_BEHIND_MESSAGE_TYPES = frozenset({"status", "assistant_response_end"})
+
 class ThreadManager:
     """Manages conversation threads with LLM models and tool execution.
 
@@ -68,6 +88,24 @@ class ThreadManager:
             target_agent_id=self.target_agent_id
         )
         self.context_manager = ContextManager()
+        # Automatic continuations of the current run_thread chain; the next run_thread call starts
+        # from this count, so a resumed agent run keeps the budget its interrupted chain had left
+        self.auto_continue_count = 0
+        # Per-thread cache of LLM messages:
+        # thread_id -> {'messages', 'message_ids' (id -> index), 'last_created_at', 'summary', 'summary_indexes',
+        #               'tool_message_ids', 'compact' (id -> compact form of a large tool result),
+        #               'retrieval_index' (ToolResultIndex when retrieval mode is enabled)}
+        self._message_cache: Dict[str, Dict[str, Any]] = {}
+        # Memoized per-message token counts (message_id -> {tokenizer_key: count})
+        self.token_cache = MessageTokenCache()
+        # Model of the current run; used to store token counts with new LLM messages
+        self._token_model: Optional[str] = None
+        # Status messages waiting for a batched insert (write-behind)
+        self._pending_message_rows: List[Dict[str, Any]] = []
+        self._message_flush_task: Optional[asyncio.Task] = None
+        self._message_flush_batches: set = set()
+        self._message_flush_lock = asyncio.Lock()
+        self._message_flush_failures = 0  # Consecutive failed flushes of the queue
 
     def add_tool(self, tool_class: Type[Tool], function_names: Optional[List[str]] = None, **kwargs):
         """Add a tool to the ThreadManager."""
@@ -79,7 +117,8 @@ class ThreadManager:
         type: str,
         content: Union[Dict[str, Any], List[Any], str],
         is_llm_message: bool = False,
-        metadata: Optional[Dict[str, Any]] = None
+        metadata: Optional[Dict[str, Any]] = None,
+        message_id: Optional[str] = None
     ):
         """Add a message to the thread in the database.
 
@@ -92,76 +131,476 @@ class ThreadManager:
                             Defaults to False (user message).
             metadata: Optional dictionary for additional message metadata.
                       Defaults to None, stored as an empty JSONB object if None.
+            message_id: Optional ID for the message. Generated by the database if None.
+
+        Non-LLM status messages are written behind when MESSAGE_WRITE_BEHIND_ENABLED is
+        set: they get a client-side message_id, are returned immediately and are
+        inserted in batches. LLM messages are always inserted synchronously, after any
+        pending status messages (including a batch being flushed concurrently) so
+        insertion order is preserved; only rows whose flush failed are inserted later.
         """
         logger.debug(f"Adding message of type '{type}' to thread {thread_id}")
         client = await self.db.client
 
+        metadata = metadata or {}
+        token_counts = None
+        if is_llm_message and self._token_model:
+            # Count once at write time so later prompts can sum stored counts; tokenizing a
+            # large message is CPU-bound, so it runs off the event loop
+            metadata, token_counts = await asyncio.to_thread(
+                self._add_token_counts, content, metadata, self._token_model
+            )
+
         # Prepare data for insertion
         data_to_insert = {
             'thread_id': thread_id,
             'type': type,
             'content': content,
             'is_llm_message': is_llm_message,
-            'metadata': metadata or {},
+            'metadata': metadata,
         }
+        if message_id:
+            data_to_insert['message_id'] = message_id
+
+        if config.MESSAGE_WRITE_BEHIND_ENABLED and not is_llm_message and type in WRITE_BEHIND_MESSAGE_TYPES:
+            return self._queue_message_row(data_to_insert)
 
         try:
-            # Add returning='representation' to get the inserted row data including the id
-            result = await client.table('messages').insert(data_to_insert, returning='representation').execute()
-            logger.info("Successfully added message to thread {thread_id}")
+            # Holding the flush lock orders this insert after every queued row, including a
+            # batch another task is inserting right now (the queue is already empty then)
+            async with self._message_flush_lock:
+                await self._flush_pending_messages_locked()
+                # Add returning='representation' to get the inserted row data including the id
+                result = await client.table('messages').insert(data_to_insert, returning='representation').execute()
+            logger.info(f"Successfully added message to thread {thread_id}")
 
             if result.data and len(result.data) > 0 and isinstance(result.data[0], dict) and 'message_id' in result.data[0]:
+                if is_llm_message:
+                    self.token_cache.seed(result.data[0]['message_id'], token_counts)
+                    self._append_to_message_cache(thread_id, result.data[0])
                 return result.data[0]
             else:
-                logger.error("Insert operation failed or did not return expected data structure for thread {thread_id}. Result data: {result.data}")
+                logger.error(f"Insert operation failed or did not return expected data structure for thread {thread_id}. Result data: {result.data}")
                 return None
         except Exception as e:
-            logger.error("Failed to add message to thread {thread_id}: {str(e)}", exc_info=True)
+            logger.error(f"Failed to add message to thread {thread_id}: {str(e)}", exc_info=True)
             raise
 
+    @staticmethod
+    def _add_token_counts(content: Any, metadata: Dict[str, Any], model: str) -> Tuple[Dict[str, Any], Optional[Dict[str, int]]]:
+        """Add the token counts of a message (and of its compact form) to its metadata.
+
+        Returns:
+            The new metadata and the message's token counts (None if they could not be computed)
+        """
+        token_counts = token_counts_for_metadata(content, model)
+        if token_counts:
+            metadata = {**metadata, TOKEN_COUNTS_METADATA_KEY: token_counts}
+        compact = metadata.get(COMPACT_METADATA_KEY)
+        if isinstance(compact, dict) and isinstance(content, dict) and 'token_counts' not in compact:
+            compact_counts = token_counts_for_metadata({**content, 'content': compact['content']}, model)
+            if compact_counts:
+                metadata = {**metadata, COMPACT_METADATA_KEY: {**compact, 'token_counts': compact_counts}}
+        return metadata, token_counts
+
+    def _queue_message_row(self, data_to_insert: Dict[str, Any]) -> Dict[str, Any]:
+        """Queue a message row for a batched insert and return it as if it had been inserted.
+
+        The database assigns created_at when the batch is inserted (per row, in queue
+        order), so messages of different workers are ordered by one clock. The
+        returned row carries a provisional local timestamp for display only.
+        """
+        row = {**data_to_insert, 'message_id': data_to_insert.get('message_id') or str(uuid.uuid4())}
+        self._pending_message_rows.append(row)
+
+        if len(self._pending_message_rows) >= config.MESSAGE_WRITE_BEHIND_MAX_BATCH:
+            flush_task = asyncio.create_task(self.flush_pending_messages())
+            self._message_flush_batches.add(flush_task)
+            flush_task.add_done_callback(self._message_flush_batches.discard)
+        elif self._message_flush_task is None or self._message_flush_task.done():
+            self._message_flush_task = asyncio.create_task(self._flush_messages_periodically())
+        now = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        return {**row, 'created_at': now, 'updated_at': now}
+
+    async def _flush_messages_periodically(self) -> None:
+        """Flush queued messages every interval until the queue is empty."""
+        interval = config.MESSAGE_WRITE_BEHIND_INTERVAL_MS / 1000
+        try:
+            while True:
+                await asyncio.sleep(interval)
+                await self.flush_pending_messages()
+                if not self._pending_message_rows:
+                    break
+        except asyncio.CancelledError:
+            pass
+
+    async def flush_pending_messages(self) -> None:
+        """Insert all queued status messages in one request.
+
+        Rows that fail to insert are put back at the front of the queue and retried
+        on the next flush. After MESSAGE_WRITE_BEHIND_MAX_RETRIES failed flushes in a
+        row the batch is split to isolate the rows that cannot be inserted, which
+        are logged and dropped so they do not block the rest.
+        """
+        async with self._message_flush_lock:
+            await self._flush_pending_messages_locked()
+
+    async def _flush_pending_messages_locked(self) -> None:
+        """Body of flush_pending_messages; the caller holds _message_flush_lock."""
+        if self._message_flush_task and self._message_flush_task is not asyncio.current_task():
+            self._message_flush_task.cancel()
+            self._message_flush_task = None
+        if not self._pending_message_rows:
+            return
+
+        rows = self._pending_message_rows
+        self._pending_message_rows = []
+        client = await self.db.client
+        if self._message_flush_failures >= config.MESSAGE_WRITE_BEHIND_MAX_RETRIES:
+            self._message_flush_failures = 0
+            failed_rows = await self._insert_message_rows_split(client, rows)
+            for row in failed_rows:
+                logger.error(f"Dropping queued message {row['message_id']} of type '{row['type']}' in thread {row['thread_id']}: it cannot be inserted")
+            logger.debug(f"Flushed {len(rows) - len(failed_rows)} queued messages after splitting the batch")
+            return
+
+        try:
+            await client.table('messages').insert(rows, returning='minimal').execute()
+            self._message_flush_failures = 0
+            logger.debug(f"Flushed {len(rows)} queued messages")
+        except Exception as e:
+            self._message_flush_failures += 1
+            logger.error(f"Failed to flush {len(rows)} queued messages (attempt {self._message_flush_failures}): {str(e)}", exc_info=True)
+            self._pending_message_rows = rows + self._pending_message_rows
+
+    async def _insert_message_rows_split(self, client, rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Insert rows, halving batches that fail until the failing rows are isolated.
+
+        Returns:
+            The rows that failed to insert on their own
+        """
+        try:
+            await client.table('messages').insert(rows, returning='minimal').execute()
+            return []
+        except Exception as e:
+            if len(rows) == 1:
+                logger.warning(f"Failed to insert queued message {rows[0]['message_id']}: {str(e)}")
+                return rows
+        middle = len(rows) // 2
+        return await self._insert_message_rows_split(client, rows[:middle]) + \
+            await self._insert_message_rows_split(client, rows[middle:])
+
+    async def _flush_messages_on_exit(self, generator: AsyncGenerator) -> AsyncGenerator:
+        """Pass a response generator through, flushing queued messages when it finishes."""
+        try:
+            async for item in generator:
+                yield item
+        finally:
+            await self.flush_pending_messages()
+
+    @staticmethod
+    def _parse_message_row(item: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        """Parse a messages row into an LLM message dict tagged with its message_id."""
+        content = item['content']
+        if isinstance(content, str):
+            try:
+                content = json.loads(content)
+            except json.JSONDecodeError:
+                logger.error(f"Failed to parse message: {item['content']}")
+                return None
+        elif isinstance(content, dict):
+            # Don't tag the caller's row object (add_message returns it to the response processor)
+            content = dict(content)
+        else:
+            logger.error(f"Unexpected message content type for {item['message_id']}: {type(content)}")
+            return None
+        content['message_id'] = item['message_id']
+        return content
+
+    @staticmethod
+    def _copy_message(message: Dict[str, Any]) -> Dict[str, Any]:
+        """Copy a cached message so prompt preparation can modify it in place.
+
+        Content blocks are copied one level deep because prepare_params adds
+        cache_control to text blocks of list content.
+        """
+        copied = dict(message)
+        content = copied.get('content')
+        if isinstance(content, list):
+            copied['content'] = [dict(block) if isinstance(block, dict) else block for block in content]
+        return copied
+
+    def _add_row_to_cache(self, cache: Dict[str, Any], row: Dict[str, Any]) -> bool:
+        """Add a messages row to a thread cache, tracking the latest summary boundary.
+
+        Returns:
+            True if the row was added, False if it was already cached or unparsable.
+        """
+        message_id = row['message_id']
+        if message_id in cache['message_ids']:
+            return False
+        parsed = self._parse_message_row(row)
+        if parsed is None:
+            return False
+
+        index = len(cache['messages'])
+        cache['messages'].append(parsed)
+        cache['message_ids'][message_id] = index
+        if row.get('created_at'):
+            cache['last_created_at'] = max(cache['last_created_at'] or row['created_at'], row['created_at'])
+
+        if row.get('type') == 'summary':
+            # Messages up to the boundary are replaced by the summary in the prompt. Summaries
+            # without a recorded boundary cover everything before themselves.
+            until_id = row.get(SUMMARIZED_UNTIL_MESSAGE_ID_KEY) or (row.get('metadata') or {}).get(SUMMARIZED_UNTIL_MESSAGE_ID_KEY)
+            until_index = cache['message_ids'].get(until_id, index) if until_id else index
+            cache['summary'] = {'index': index, 'start': until_index + 1}
+            cache['summary_indexes'].add(index)
+        elif row.get('type') == 'tool':
+            cache['tool_message_ids'].add(message_id)
+            compact = row.get(COMPACT_METADATA_KEY) or (row.get('metadata') or {}).get(COMPACT_METADATA_KEY)
+            if isinstance(compact, dict) and compact.get('content'):
+                cache['compact'][message_id] = compact
+            if cache['retrieval_index'] is not None and isinstance(parsed.get('content'), str):
+                cache['retrieval_index'].add(message_id, parsed['content'])
+        return True
+
+    def is_tool_result(self, thread_id: str, message: Dict[str, Any]) -> bool:
+        """Check whether a prompt message is a stored tool result."""
+        cache = self._message_cache.get(thread_id)
+        return cache is not None and message.get('message_id') in cache['tool_message_ids']
+
+    def get_compact_message(self, thread_id: str, message: Dict[str, Any], model: str) -> Optional[Dict[str, Any]]:
+        """Return the compact form of a stored tool result message and its token count.
+
+        The compact form is normally written with the message; tool results stored
+        before that (or too short in characters to get one at write time) get one
+        built here once and cached.
+
+        Args:
+            thread_id: The ID of the thread the message belongs to.
+            message: Prompt message tagged with its message_id.
+            model: Model whose tokenizer is used for the token count.
+
+        Returns:
+            Dict with 'message' (the compact message) and 'token_count', or None if
+            the message has no compact form.
+        """
+        cache = self._message_cache.get(thread_id)
+        message_id = message.get('message_id')
+        if cache is None or message_id not in cache['tool_message_ids']:
+            return None
+
+        compact = cache['compact'].get(message_id)
+        if compact is None:
+            if not isinstance(message.get('content'), str):
+                return None
+            compact = {'content': compact_tool_content(message['content'], message_id)}
+            cache['compact'][message_id] = compact
+
+        compact_message = {**message, 'content': compact['content']}
+        token_counts = compact.setdefault('token_counts', {})
+        key = tokenizer_key(model)
+        if key not in token_counts:
+            # Counted without the message_id so the count is memoized by content
+            token_counts[key] = self.token_cache.count({k: v for k, v in compact_message.items() if k != 'message_id'}, model)
+        return {'message': compact_message, 'token_count': token_counts[key]}
+
+    def _append_to_message_cache(self, thread_id: str, row: Dict[str, Any]) -> None:
+        """Append a freshly inserted LLM message to the thread's cache, if loaded."""
+        cache = self._message_cache.get(thread_id)
+        if cache is not None:
+            self._add_row_to_cache(cache, row)
+
+    def _cached_prompt_messages(self, cache: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """Return copies of the cached messages that belong in the prompt.
+
+        When the thread has a summary, it replaces every message up to its
+        boundary; older summaries are dropped.
+        """
+        messages = cache['messages']
+        summary = cache['summary']
+        if summary is None:
+            return [self._copy_message(message) for message in messages]
+
+        prompt_messages = [self._copy_message(messages[summary['index']])]
+        for index in range(summary['start'], len(messages)):
+            if index not in cache['summary_indexes']:
+                prompt_messages.append(self._copy_message(messages[index]))
+        return prompt_messages
+
+    def invalidate_message_cache(self, thread_id: Optional[str] = None) -> None:
+        """Drop cached messages for a thread (or all threads) so the next load is a full fetch."""
+        if thread_id is None:
+            self._message_cache.clear()
+        else:
+            self._message_cache.pop(thread_id, None)
+
+    @staticmethod
+    def _message_text(message: Dict[str, Any]) -> str:
+        """Return the text of a message's content."""
+        content = message.get('content')
+        if isinstance(content, str):
+            return content
+        if isinstance(content, list):
+            return " ".join(block.get('text', '') for block in content if isinstance(block, dict) and block.get('type') == 'text')
+        return ""
+
+    @staticmethod
+    def _append_message_text(message: Dict[str, Any], text: str) -> Dict[str, Any]:
+        """Return a copy of a prompt message with text appended to its content."""
+        merged = dict(message)
+        content = merged.get('content')
+        if isinstance(content, list):
+            merged['content'] = content + [{"type": "text", "text": text}]
+        elif content:
+            merged['content'] = f"{content}\n\n{text}"
+        else:
+            merged['content'] = text
+        return merged
+
+    def build_retrieval_message(
+        self,
+        thread_id: str,
+        prompt_messages: List[Dict[str, Any]],
+        compacted_message_ids: List[str],
+        model: str,
+        token_budget: int
+    ) -> Optional[Dict[str, Any]]:
+        """Build a message with the compacted tool result passages most relevant to the latest turn.
+
+        The query is the latest user and assistant messages of the prompt. Passages
+        are taken best first until the token budget (estimated) is used up.
+
+        Args:
+            thread_id: The ID of the thread.
+            prompt_messages: Messages of the prompt being assembled.
+            compacted_message_ids: Tool results that were replaced by their compact form.
+            model: Model whose tokenizer is used for the budget.
+            token_budget: Maximum tokens of passages to include.
+
+        Returns:
+            A message with the passages (run_thread merges its content into the temporary
+            message), or None if nothing relevant was found.
+        """
+        cache = self._message_cache.get(thread_id)
+        index = cache['retrieval_index'] if cache is not None else None
+        if index is None or not compacted_message_ids or not len(index):
+            return None
+
+        query_parts = []
+        for role in ('user', 'assistant'):
+            for message in reversed(prompt_messages):
+                if message.get('role') == role and not self.is_tool_result(thread_id, message):
+                    query_parts.append(self._message_text(message)[-2000:])
+                    break
+        query = " ".join(query_parts)
+        if not query.strip():
+            return None
+
+        tokenizer = tokenizer_registry.get(model)
+        excerpts = []
+        used_tokens = 0
+        for passage in index.search(query, limit=20, message_ids=compacted_message_ids):
+            excerpt = f"<tool_result_excerpt message_id=\"{passage.message_id}\">\n{passage.text}\n</tool_result_excerpt>"
+            excerpt_tokens = tokenizer.estimate([{"role": "user", "content": excerpt}])
+            if used_tokens + excerpt_tokens > token_budget:
+                break
+            excerpts.append(excerpt)
+            used_tokens += excerpt_tokens
+
+        if not excerpts:
+            return None
+        logger.debug(f"Adding {len(excerpts)} retrieved tool result passages (~{used_tokens} tokens) for thread {thread_id}")
+        return {
+            "role": "user",
+            "content": "Relevant excerpts from earlier tool results that are truncated above. "
+                       "Use the expand-message tool with a message_id to see a full result.\n\n" + "\n\n".join(excerpts)
+        }
+
+    async def delete_message(self, thread_id: str, message_id: str) -> None:
+        """Delete a message from the thread and keep the message cache consistent.
+
+        Args:
+            thread_id: The ID of the thread the message belongs to.
+            message_id: The ID of the message to delete.
+        """
+        client = await self.db.client
+        await client.table('messages').delete().eq('message_id', message_id).execute()
+
+        cache = self._message_cache.get(thread_id)
+        if cache is not None and message_id in cache['message_ids']:
+            # Rebuilding indexes is not worth it for a rare path; reload on next use
+            self.invalidate_message_cache(thread_id)
+
     async def get_llm_messages(self, thread_id: str) -> List[Dict[str, Any]]:
         """Get all messages for a thread.
 
-        This method uses the SQL function which handles context truncation
-        by considering summary messages.
+        The first call for a thread loads the full history; later calls only
+        fetch rows created at or after the newest cached row and merge them by
+        message_id. Messages written through add_message are appended to the
+        cache directly. If the thread has a summary, the messages it covers are
+        replaced by the summary.
 
         Args:
             thread_id: The ID of the thread to get messages for.
 
         Returns:
-            List of message objects.
+            List of message objects. Each object is a copy and may be modified
+            by the caller without affecting the cache.
         """
         logger.debug(f"Getting messages for thread {thread_id}")
         client = await self.db.client
 
         try:
-            # result = await client.rpc('get_llm_formatted_messages', {'p_thread_id': thread_id}).execute()
-            result = await client.table('messages').select('message_id, content').eq('thread_id', thread_id).eq('is_llm_message', True).order('created_at').execute()
-
-            # Parse the returned data which might be stringified JSON
-            if not result.data:
-                return []
+            cache = self._message_cache.get(thread_id)
+            query = client.table('messages').select(
+                'message_id, type, content, created_at, '
+                f'token_counts:metadata->{TOKEN_COUNTS_METADATA_KEY}, '
+                f'{SUMMARIZED_UNTIL_MESSAGE_ID_KEY}:metadata->>{SUMMARIZED_UNTIL_MESSAGE_ID_KEY}, '
+                f'{COMPACT_METADATA_KEY}:metadata->{COMPACT_METADATA_KEY}'
+            ).eq('thread_id', thread_id).eq('is_llm_message', True)
+            if cache is not None and cache['last_created_at']:
+                # gte rather than gt: rows sharing the watermark timestamp are de-duplicated by message_id below
+                query = query.gte('created_at', cache['last_created_at'])
+            result = await query.order('created_at').execute()
+
+            if cache is None:
+                cache = {'messages': [], 'message_ids': {}, 'last_created_at': None, 'summary': None, 'summary_indexes': set(),
+                         'tool_message_ids': set(), 'compact': {},
+                         'retrieval_index': ToolResultIndex() if config.CONTEXT_RETRIEVAL_ENABLED else None}
+                self._message_cache[thread_id] = cache
+
+            new_count = 0
+            for item in result.data or []:
+                if self._add_row_to_cache(cache, item):
+                    self.token_cache.seed(item['message_id'], item.get('token_counts'))
+                    new_count += 1
+
+            logger.debug(f"Loaded {new_count} new messages for thread {thread_id} ({len(cache['messages'])} cached)")
+            return self._cached_prompt_messages(cache)
 
-            # Return properly parsed JSON objects
-            messages = []
-            for item in result.data:
-                if isinstance(item['content'], str):
-                    try:
-                        parsed_item = json.loads(item['content'])
-                        parsed_item['message_id'] = item['message_id']
-                        messages.append(parsed_item)
-                    except json.JSONDecodeError:
-                        logger.error("Failed to parse message: {item['content']}")
-                else:
-                    content = item['content']
-                    content['message_id'] = item['message_id']
-                    messages.append(content)
+        except Exception as e:
+            logger.error(f"Failed to get messages for thread {thread_id}: {str(e)}", exc_info=True)
+            # Do not keep a possibly partial cache around after a failed load
+            self.invalidate_message_cache(thread_id)
+            return []
 
-            return messages
+    async def persist_token_counts(self) -> None:
+        """Write token counts computed for messages without stored counts back to their metadata.
 
+        Older messages were stored before counts were recorded at write time; once
+        counted they are persisted in a single batched call so later runs can reuse them.
+        """
+        pending = self.token_cache.drain_pending()
+        if not pending:
+            return
+        try:
+            client = await self.db.client
+            await client.rpc('merge_message_token_counts', {'p_counts': pending}).execute()
+            logger.debug(f"Persisted token counts for {len(pending)} messages")
         except Exception as e:
-            logger.error("Failed to get messages for thread {thread_id}: {str(e)}", exc_info=True)
-            return []
+            logger.warning(f"Failed to persist token counts for {len(pending)} messages: {str(e)}")
 
     async def run_thread(
         self,
@@ -181,6 +620,7 @@ class ThreadManager:
         reasoning_effort: Optional[str] = 'low',
         enable_context_manager: bool = True,
         generation: Optional["StatefulGenerationClient"] = None,
+        on_auto_continue: Optional[Callable[[int], Awaitable[None]]] = None,
     ) -> Union[Dict[str, Any], AsyncGenerator]:
         """Run a conversation thread with LLM integration and tool execution.
 
@@ -201,6 +641,8 @@ class ThreadManager:
             enable_thinking: Whether to enable thinking before making a decision
             reasoning_effort: The effort level for reasoning
             enable_context_manager: Whether to enable automatic context summarization.
+            on_auto_continue: Called with the chain's auto-continue count after a tool cycle's
+                              results are persisted and before the next LLM call
 
         Returns:
             An async generator yielding response chunks or error dict
@@ -215,6 +657,9 @@ class ThreadManager:
         # Log model info
         logger.info("🤖 Thread {thread_id}: Using model {llm_model}")
 
+        # Token counts of messages written during this run are stored for this model
+        self._token_model = llm_model
+
         # Apply max_xml_tool_calls if specified and not already set in config
         if max_xml_tool_calls > 0 and not processor_config.max_xml_tool_calls:
             processor_config.max_xml_tool_calls = max_xml_tool_calls
@@ -266,7 +711,7 @@ Here are the XML tools available with examples:
                     logger.warning("System prompt content is of unexpected type ({type(system_content)}), cannot add XML examples.")
         # Control whether we need to auto-continue due to tool_calls finish reason
         auto_continue = True
-        auto_continue_count = 0
+        auto_continue_count = self.auto_continue_count
 
         # Define inner function to handle a single run
         async def _run_once(temp_msg=None):
@@ -279,35 +724,31 @@ Here are the XML tools available with examples:
                 messages = await self.get_llm_messages(thread_id)
 
                 # 2. Check token count before proceeding
+                # Per-message counts are memoized by message_id, so only new messages are tokenized
                 token_count = 0
                 try:
-                    from litellm import token_counter
-                    # Use the potentially modified working_system_prompt for token counting
-                    token_count = token_counter(model=llm_model, messages=[working_system_prompt] + messages)
                     token_threshold = self.context_manager.token_threshold
-                    logger.info("Thread {thread_id} token count: {token_count}/{token_threshold} ({(token_count/token_threshold)*100:.1f}%)")
-
-                    # if token_count >= token_threshold and enable_context_manager:
-                    #     logger.info("Thread token count ({token_count}) exceeds threshold ({token_threshold}), summarizing...")
-                    #     summarized = await self.context_manager.check_and_summarize_if_needed(
-                    #         thread_id=thread_id,
-                    #         add_message_callback=self.add_message,
-                    #         model=llm_model,
-                    #         force=True
-                    #     )
-                    #     if summarized:
-                    #         logger.info("Summarization complete, fetching updated messages with summary")
-                    #         messages = await self.get_llm_messages(thread_id)
-                    #         # Recount tokens after summarization, using the modified prompt
-                    #         new_token_count = token_counter(model=llm_model, messages=[working_system_prompt] + messages)
-                    #         logger.info("After summarization: token count reduced from {token_count} to {new_token_count}")
-                    #     else:
-                    #         logger.warning("Summarization failed or wasn't needed - proceeding with original messages")
-                    # elif not enable_context_manager:
-                    #     logger.info("Automatic summarization disabled. Skipping token count check and summarization.")
+                    # Estimates are enough unless the count is near the point where summarization starts
+                    summary_limit = self.context_manager.summary_trigger_tokens if enable_context_manager else token_threshold
+                    # Tokenizing new messages is CPU-bound, so it runs off the event loop
+                    token_count = sum(await asyncio.to_thread(
+                        self.token_cache.count_all, [working_system_prompt] + messages, llm_model, limit=summary_limit
+                    ))
+                    logger.info(f"Thread {thread_id} token count: {token_count}/{token_threshold} ({(token_count/token_threshold)*100:.1f}%)")
+                    await self.persist_token_counts()
+
+                    if enable_context_manager:
+                        # Summarize ahead of the threshold without blocking this turn; the
+                        # summary message replaces older messages from the next turn on
+                        self.context_manager.maybe_start_background_summary(
+                            thread_id=thread_id,
+                            token_count=token_count,
+                            add_message_callback=self.add_message,
+                            model=llm_model
+                        )
 
                 except Exception as e:
-                    logger.error("Error counting tokens or summarizing: {str(e)}")
+                    logger.error(f"Error counting tokens or summarizing: {str(e)}")
 
                 # 3. Prepare messages for LLM call + add temporary message if it exists
                 # Use the working_system_prompt which may contain the XML examples
@@ -320,8 +761,11 @@ Here are the XML tools available with examples:
                         last_user_index = i
 
                 # Insert temporary message before the last user message if it exists
+                # It changes every turn, so it is kept outside the prompt-cache prefix
+                temp_msg_index = None
                 if temp_msg and last_user_index >= 0:
                     prepared_messages.extend(messages[:last_user_index])
+                    temp_msg_index = len(prepared_messages)
                     prepared_messages.append(temp_msg)
                     prepared_messages.extend(messages[last_user_index:])
                     logger.debug("Added temporary message before the last user message")
@@ -329,6 +773,7 @@ Here are the XML tools available with examples:
                     # If no user message or no temporary message, just add all messages
                     prepared_messages.extend(messages)
                     if temp_msg:
+                        temp_msg_index = len(prepared_messages)
                         prepared_messages.append(temp_msg)
                         logger.debug("Added temporary message to the end of prepared messages")
 
@@ -339,24 +784,59 @@ Here are the XML tools available with examples:
                     logger.debug("Retrieved {len(openapi_tool_schemas) if openapi_tool_schemas else 0} OpenAPI tool schemas")
 
 
-                uncompressed_total_token_count = token_counter(model=llm_model, messages=prepared_messages)
-
-                if uncompressed_total_token_count > (llm_max_tokens or (100 * 1000)):
-                    _i = 0 # Count the number of ToolResult messages
-                    for msg in reversed(prepared_messages): # Start from the end and work backwards
-                        if "content" in msg and msg['content'] and "ToolResult" in msg['content']: # Only compress ToolResult messages
-                            _i += 1 # Count the number of ToolResult messages
-                            msg_token_count = token_counter(messages=[msg]) # Count the number of tokens in the message
-                            if msg_token_count > 5000: # If the message is too long
-                                if _i > 1: # If this is not the most recent ToolResult message
-                                    message_id = msg.get('message_id') # Get the message_id
-                                    if message_id:
-                                        msg["content"] = msg["content"][:10000] + "... (truncated)" + f"\n\nThis message is too long, use the expand-message tool with message_id \"{message_id}\" to see the full message" # Truncate the message
-                                else:
-                                    msg["content"] = msg["content"][:200000] + "\n\nThis message is too long, repeat relevant information in your response to remember it" # Truncate to 300k characters to avoid overloading the context at once, but don't truncate otherwise
-
-                compressed_total_token_count = token_counter(model=llm_model, messages=prepared_messages)
-                logger.info("token_compression: {uncompressed_total_token_count} -> {compressed_total_token_count}") # Log the token compression for debugging later
+                # Per-message counts come from the memoized cache; the total is kept up to
+                # date while compacting so the prompt is never re-counted as a whole
+                compression_limit = llm_max_tokens or (100 * 1000)
+                message_token_counts = await asyncio.to_thread(
+                    self.token_cache.count_all, prepared_messages, llm_model, limit=compression_limit
+                )
+                uncompressed_total_token_count = sum(message_token_counts)
+                compressed_total_token_count = uncompressed_total_token_count
+
+                compacted_message_ids = []
+                if uncompressed_total_token_count > compression_limit:
+                    _i = 0 # Count the number of tool result messages
+                    for idx in range(len(prepared_messages) - 1, -1, -1): # Start from the end and work backwards
+                        msg = prepared_messages[idx]
+                        if not self.is_tool_result(thread_id, msg): # Only compress tool result messages
+                            continue
+                        _i += 1
+                        msg_token_count = message_token_counts[idx]
+                        if msg_token_count <= COMPACT_MIN_TOKENS:
+                            continue
+                        if _i > 1: # Older results are swapped for their precomputed compact form
+                            compact = self.get_compact_message(thread_id, msg, llm_model)
+                            if compact:
+                                prepared_messages[idx] = compact['message']
+                                compressed_total_token_count += compact['token_count'] - msg_token_count
+                                compacted_message_ids.append(msg['message_id'])
+                        elif isinstance(msg.get('content'), str): # The most recent result is kept, but capped
+                            msg['content'] = cap_latest_tool_content(msg['content'])
+                            capped_count = self.token_cache.count({k: v for k, v in msg.items() if k != 'message_id'}, llm_model)
+                            compressed_total_token_count += capped_count - msg_token_count
+
+                # In retrieval mode, bring back the parts of compacted results relevant to the latest turn.
+                # The excerpts change every turn, so they go into the temporary message (or take its place
+                # before the last user message), outside the prompt-cache prefix; the conversation keeps
+                # ending with the real last turn. Without a user message they are appended at the end,
+                # which becomes the start of the uncached tail.
+                if config.CONTEXT_RETRIEVAL_ENABLED and compacted_message_ids:
+                    retrieval_msg = self.build_retrieval_message(
+                        thread_id, prepared_messages, compacted_message_ids, llm_model,
+                        config.CONTEXT_RETRIEVAL_TOKEN_BUDGET
+                    )
+                    if retrieval_msg and temp_msg_index is not None:
+                        replaced = prepared_messages[temp_msg_index]
+                        prepared_messages[temp_msg_index] = self._append_message_text(replaced, retrieval_msg['content'])
+                        compressed_total_token_count += self.token_cache.count(prepared_messages[temp_msg_index], llm_model) - \
+                            self.token_cache.count(replaced, llm_model)
+                    elif retrieval_msg:
+                        # The system prompt precedes the thread's messages
+                        temp_msg_index = last_user_index + 1 if last_user_index >= 0 else len(prepared_messages)
+                        prepared_messages.insert(temp_msg_index, retrieval_msg)
+                        compressed_total_token_count += self.token_cache.count(retrieval_msg, llm_model)
+
+                logger.info(f"token_compression: {uncompressed_total_token_count} -> {compressed_total_token_count}") # Log the token compression for debugging later
 
                 # 5. Make LLM API call
                 logger.debug("Making LLM API call")
@@ -384,7 +864,8 @@ Here are the XML tools available with examples:
                         tool_choice=tool_choice if processor_config.native_tool_calling else None,
                         stream=stream,
                         enable_thinking=enable_thinking,
-                        reasoning_effort=reasoning_effort
+                        reasoning_effort=reasoning_effort,
+                        uncached_from_index=temp_msg_index
                     )
                     logger.debug("Successfully received raw LLM API response stream/object")
 
@@ -427,6 +908,7 @@ Here are the XML tools available with examples:
         # Define a wrapper generator that handles auto-continue logic
         async def auto_continue_wrapper():
             nonlocal auto_continue, auto_continue_count
+            first_call = True
 
             while auto_continue and (native_max_auto_continues == 0 or auto_continue_count < native_max_auto_continues):
                 # Reset auto_continue for this iteration
@@ -435,7 +917,8 @@ Here are the XML tools available with examples:
                 # Run the thread once, passing the potentially modified system prompt
                 # Pass temp_msg only on the first iteration
                 try:
-                    response_gen = await _run_once(temporary_message if auto_continue_count == 0 else None)
+                    response_gen = await _run_once(temporary_message if first_call else None)
+                    first_call = False
 
                     # Handle error responses
                     if isinstance(response_gen, dict) and "status" in response_gen and response_gen["status"] == "error":
@@ -454,6 +937,9 @@ Here are the XML tools available with examples:
                                         logger.info("Detected finish_reason='tool_calls', auto-continuing ({auto_continue_count + 1}/{native_max_auto_continues})")
                                         auto_continue = True
                                         auto_continue_count += 1
+                                        self.auto_continue_count = auto_continue_count
+                                        if on_auto_continue:
+                                            await on_auto_continue(auto_continue_count)
                                         # Don't yield the finish chunk to avoid confusing the client
                                         continue
                                 elif chunk.get('finish_reason') == 'xml_tool_limit_reached':
@@ -499,7 +985,10 @@ Here are the XML tools available with examples:
         if native_max_auto_continues == 0:
             logger.info("Auto-continue is disabled (native_max_auto_continues=0)")
             # Pass the potentially modified system prompt and temp message
-            return await _run_once(temporary_message)
+            response_gen = await _run_once(temporary_message)
+            if isinstance(response_gen, dict):
+                return response_gen
+            return self._flush_messages_on_exit(response_gen)
 
         # Otherwise return the auto-continue wrapper generator
-        return auto_continue_wrapper()
+        return self._flush_messages_on_exit(auto_continue_wrapper())
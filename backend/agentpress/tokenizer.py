@@ -0,0 +1,287 @@
+"""
+Token counting helpers for AgentPress.
+
+Counting a 100k+ token prompt with litellm takes noticeable CPU, and the same
+history is re-counted on every LLM call of a run. This module provides:
+
+- A tokenizer registry keyed by model family, loaded lazily once per process.
+  Each family also has a fast byte-length estimator calibrated against the
+  exact counts it has seen, used for threshold checks that don't need exact
+  counts.
+- Memoized token counts per message (keyed by message_id and tokenizer family)
+  so prompt totals can be computed by summing cached values. Counts are also
+  persisted in the message metadata under ``token_counts`` so they survive
+  across runs.
+"""
+
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, Any, List, Optional, Tuple
+
+from litellm import token_counter
+from utils.logger import logger
+from utils.config import config
+
+# Metadata key holding {tokenizer_key: token_count} for a message
+TOKEN_COUNTS_METADATA_KEY = "token_counts"
+
+# Maximum number of memoized counts for messages without a message_id
+# (system prompt, temporary messages, truncated variants)
+MAX_ANONYMOUS_ENTRIES = 256
+
+
+# Fixed per-message overhead added by the estimator (role, separators)
+ESTIMATE_MESSAGE_OVERHEAD_TOKENS = 4
+
+# Weight of a new exact count when recalibrating a family's bytes-per-token ratio
+CALIBRATION_WEIGHT = 0.1
+
+# Exact counts of texts shorter than this are too noisy to calibrate with
+CALIBRATION_MIN_BYTES = 2000
+
+
+@dataclass(frozen=True)
+class TokenizerFamily:
+    """A group of models that share a tokenizer."""
+    name: str
+    patterns: Tuple[str, ...]  # Substrings of the lowercased model name
+    count_model: str           # Model litellm resolves to this family's tokenizer
+    bytes_per_token: float     # Initial estimator calibration
+
+
+# Checked in order; the first family with a matching pattern wins
+TOKENIZER_FAMILIES: Tuple[TokenizerFamily, ...] = (
+    TokenizerFamily("anthropic", ("claude", "anthropic"), "claude-3-5-sonnet-20241022", 3.5),
+    TokenizerFamily("openai-o200k", ("gpt-4o", "gpt-4.1", "gpt-4.5"), "gpt-4o", 4.0),
+    TokenizerFamily("openai-cl100k", ("gpt-4", "gpt-3.5"), "gpt-4", 4.0),
+    TokenizerFamily("gemini", ("gemini",), "gemini/gemini-1.5-pro", 4.0),
+    TokenizerFamily("deepseek", ("deepseek",), "deepseek/deepseek-chat", 3.5),
+    TokenizerFamily("qwen", ("qwen",), "openrouter/qwen/qwen3-235b-a22b", 3.5),
+)
+DEFAULT_TOKENIZER_FAMILY = TokenizerFamily("default", (), "gpt-4", 3.5)
+
+
+def resolve_tokenizer_family(model: str) -> TokenizerFamily:
+    """Return the tokenizer family for a model name (provider prefixes are allowed)."""
+    name = (model or "").lower()
+    for family in TOKENIZER_FAMILIES:
+        if any(pattern in name for pattern in family.patterns):
+            return family
+    return DEFAULT_TOKENIZER_FAMILY
+
+
+def _message_bytes(messages: List[Dict[str, Any]]) -> int:
+    """Size in bytes of the serialized messages, the estimator's input."""
+    return len(json.dumps(messages, ensure_ascii=False, default=str).encode('utf-8'))
+
+
+class Tokenizer:
+    """Exact counter and calibrated estimator for one tokenizer family."""
+
+    def __init__(self, family: TokenizerFamily):
+        self.family = family
+        self.bytes_per_token = family.bytes_per_token
+        self._lock = threading.Lock()
+        # Load the tokenizer now so the first real count doesn't pay for it
+        try:
+            token_counter(model=family.count_model, text="warm up")
+        except Exception as e:
+            logger.warning(f"Failed to load tokenizer for family {family.name}: {str(e)}")
+
+    def count(self, messages: List[Dict[str, Any]]) -> int:
+        """Count tokens exactly, recalibrating the estimator with the result."""
+        tokens = token_counter(model=self.family.count_model, messages=messages)
+        size = _message_bytes(messages)
+        if size >= CALIBRATION_MIN_BYTES and tokens > 0:
+            with self._lock:
+                self.bytes_per_token += CALIBRATION_WEIGHT * (size / tokens - self.bytes_per_token)
+        return tokens
+
+    def estimate(self, messages: List[Dict[str, Any]]) -> int:
+        """Estimate tokens from the serialized byte length."""
+        return int(_message_bytes(messages) / self.bytes_per_token) + ESTIMATE_MESSAGE_OVERHEAD_TOKENS * len(messages)
+
+
+class TokenizerRegistry:
+    """Process-wide registry of tokenizers, loaded lazily per model family."""
+
+    def __init__(self):
+        self._tokenizers: Dict[str, Tokenizer] = {}
+        self._lock = threading.Lock()
+
+    def get(self, model: str) -> Tokenizer:
+        """Return the tokenizer for a model, loading its family on first use."""
+        family = resolve_tokenizer_family(model)
+        tokenizer = self._tokenizers.get(family.name)
+        if tokenizer is None:
+            with self._lock:
+                tokenizer = self._tokenizers.get(family.name)
+                if tokenizer is None:
+                    logger.debug(f"Loading tokenizer family {family.name} for model {model}")
+                    tokenizer = Tokenizer(family)
+                    self._tokenizers[family.name] = tokenizer
+        return tokenizer
+
+
+tokenizer_registry = TokenizerRegistry()
+
+
+def tokenizer_key(model: str) -> str:
+    """Return the key under which token counts for a model are stored."""
+    return resolve_tokenizer_family(model).name
+
+
+def is_near_limit(token_count: int, limit: int) -> bool:
+    """Check whether an estimated count is close enough to a limit to need an exact count."""
+    return token_count >= limit * (100 - config.TOKEN_EXACT_COUNT_MARGIN_PERCENT) / 100
+
+
+def count_tokens(messages: List[Dict[str, Any]], model: str, limit: Optional[int] = None) -> int:
+    """Count the tokens of a list of messages.
+
+    With a limit and the estimator enabled, the fast estimate is returned unless
+    it is near (or above) the limit, in which case the messages are counted exactly.
+    """
+    tokenizer = tokenizer_registry.get(model)
+    if limit is not None and config.TOKEN_ESTIMATOR_ENABLED:
+        estimate = tokenizer.estimate(messages)
+        if not is_near_limit(estimate, limit):
+            return estimate
+    return tokenizer.count(messages)
+
+
+def count_message_tokens(message: Dict[str, Any], model: str) -> int:
+    """Count the tokens of a single LLM message exactly.
+
+    The message_id tag added by ThreadManager is not sent to providers, so it is
+    excluded from the count.
+    """
+    if 'message_id' in message:
+        message = {k: v for k, v in message.items() if k != 'message_id'}
+    return tokenizer_registry.get(model).count([message])
+
+
+def estimate_message_tokens(message: Dict[str, Any], model: str) -> int:
+    """Estimate the tokens of a single LLM message without tokenizing it."""
+    if 'message_id' in message:
+        message = {k: v for k, v in message.items() if k != 'message_id'}
+    return tokenizer_registry.get(model).estimate([message])
+
+
+def _message_digest(message: Dict[str, Any]) -> str:
+    """Stable digest of a message's content for memoizing messages without an ID."""
+    payload = json.dumps(message, sort_keys=True, default=str)
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+
+class MessageTokenCache:
+    """Memoizes per-message token counts by message_id and tokenizer.
+
+    Counts loaded from message metadata are seeded with ``seed``. Counts computed
+    here for messages that have a message_id are queued so the caller can write
+    them back to the database (see ``drain_pending``).
+
+    Prompts are counted in worker threads (``asyncio.to_thread``) while the event
+    loop seeds new counts, so the maps are guarded by a lock. Tokenizing happens
+    outside the lock.
+    """
+
+    def __init__(self):
+        self._counts: Dict[str, Dict[str, int]] = {}
+        self._anonymous: "OrderedDict[str, int]" = OrderedDict()
+        self._pending: Dict[str, Dict[str, int]] = {}
+        self._lock = threading.Lock()
+
+    def seed(self, message_id: str, counts: Optional[Dict[str, Any]]) -> None:
+        """Record token counts already stored for a message."""
+        if not counts or not isinstance(counts, dict):
+            return
+        with self._lock:
+            entry = self._counts.setdefault(message_id, {})
+            for key, value in counts.items():
+                if isinstance(value, int):
+                    entry[key] = value
+
+    def peek(self, message_id: str, model: str) -> Optional[int]:
+        """Return the memoized count for a message without computing it."""
+        key = tokenizer_key(model)
+        with self._lock:
+            return self._counts.get(message_id, {}).get(key)
+
+    def _lookup(self, message: Dict[str, Any], key: str) -> Tuple[Optional[int], Optional[str]]:
+        """Return (memoized count or None, anonymous cache key or None) for a message."""
+        message_id = message.get('message_id')
+        if message_id:
+            with self._lock:
+                return self._counts.get(message_id, {}).get(key), None
+
+        anon_key = "{}:{}".format(key, _message_digest(message))
+        with self._lock:
+            cached = self._anonymous.get(anon_key)
+            if cached is not None:
+                self._anonymous.move_to_end(anon_key)
+        return cached, anon_key
+
+    def count(self, message: Dict[str, Any], model: str) -> int:
+        """Return the exact token count of a message, computing it at most once."""
+        key = tokenizer_key(model)
+        cached, anon_key = self._lookup(message, key)
+        if cached is not None:
+            return cached
+
+        value = count_message_tokens(message, model)
+        with self._lock:
+            if anon_key is None:
+                message_id = message['message_id']
+                self._counts.setdefault(message_id, {})[key] = value
+                self._pending.setdefault(message_id, {})[key] = value
+            else:
+                self._anonymous[anon_key] = value
+                if len(self._anonymous) > MAX_ANONYMOUS_ENTRIES:
+                    self._anonymous.popitem(last=False)
+        return value
+
+    def count_all(self, messages: List[Dict[str, Any]], model: str, limit: Optional[int] = None) -> List[int]:
+        """Return per-message token counts for a prompt.
+
+        With a limit and the estimator enabled, messages without a memoized count
+        are estimated first; they are only counted exactly when the estimated
+        total is near (or above) the limit.
+        """
+        if limit is None or not config.TOKEN_ESTIMATOR_ENABLED:
+            return [self.count(message, model) for message in messages]
+
+        key = tokenizer_key(model)
+        counts: List[int] = []
+        estimated: List[int] = []
+        for index, message in enumerate(messages):
+            cached, _ = self._lookup(message, key)
+            if cached is None:
+                cached = estimate_message_tokens(message, model)
+                estimated.append(index)
+            counts.append(cached)
+
+        if estimated and is_near_limit(sum(counts), limit):
+            for index in estimated:
+                counts[index] = self.count(messages[index], model)
+        return counts
+
+    def drain_pending(self) -> Dict[str, Dict[str, int]]:
+        """Return and clear counts computed since the last drain that are not yet persisted."""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        return pending
+
+
+def token_counts_for_metadata(content: Any, model: Optional[str]) -> Optional[Dict[str, int]]:
+    """Compute the ``token_counts`` metadata entry for a message about to be stored."""
+    if not model or not isinstance(content, dict):
+        return None
+    try:
+        return {tokenizer_key(model): count_message_tokens(content, model)}
+    except Exception as e:
+        logger.warning(f"Failed to count tokens for message metadata: {str(e)}")
+        return None
@@ -0,0 +1,59 @@
+"""
+Append-only text buffer for streamed LLM output.
+
+Building a long response with += reallocates and copies the whole string on
+many appends. ChunkBuffer keeps the pieces in a list and joins them once when
+the full text is needed, and gives cheap access to the most recent text for
+checks that only look at the end of the stream.
+"""
+
+from typing import List
+
+
+class ChunkBuffer:
+    """Accumulates text chunks and joins them on demand."""
+
+    __slots__ = ("_chunks", "_length")
+
+    def __init__(self):
+        self._chunks: List[str] = []
+        self._length = 0
+
+    def __len__(self) -> int:
+        return self._length
+
+    def __bool__(self) -> bool:
+        return self._length > 0
+
+    def append(self, text: str) -> None:
+        """Add a chunk to the end of the buffer."""
+        if text:
+            self._chunks.append(text)
+            self._length += len(text)
+
+    def getvalue(self) -> str:
+        """Return the full text. The chunks are joined once and the result is kept."""
+        if len(self._chunks) > 1:
+            self._chunks[:] = ["".join(self._chunks)]
+        return self._chunks[0] if self._chunks else ""
+
+    def tail(self, max_chars: int) -> str:
+        """Return up to the last max_chars characters without joining the whole buffer.
+
+        Args:
+            max_chars: Maximum number of characters to return
+
+        Returns:
+            The end of the accumulated text
+        """
+        if max_chars <= 0:
+            return ""
+        parts = []
+        collected = 0
+        for chunk in reversed(self._chunks):
+            parts.append(chunk)
+            collected += len(chunk)
+            if collected >= max_chars:
+                break
+        parts.reverse()
+        return "".join(parts)[-max_chars:]
@@ -0,0 +1,61 @@
+"""
+Compact forms of large tool results.
+
+Large tool results are stored alongside a compact form (a head/tail excerpt plus
+a pointer to the expand-message tool) in the message metadata, so prompt
+assembly can swap it in without re-scanning or re-slicing the full content on
+every LLM call.
+"""
+
+from typing import Any, Dict, Optional
+
+# Metadata key holding {"content": str, "token_counts": {tokenizer_key: int}}
+COMPACT_METADATA_KEY = "compact"
+
+# Tool results above this many tokens are replaced by their compact form when the prompt is over budget
+COMPACT_MIN_TOKENS = 5000
+
+# Tool results longer than this are given a compact form when they are written
+COMPACT_MIN_CHARS = 20000
+
+# Excerpt kept from the start and the end of a compacted tool result
+COMPACT_HEAD_CHARS = 8000
+COMPACT_TAIL_CHARS = 2000
+
+# The most recent tool result is kept in full up to this many characters
+LATEST_RESULT_MAX_CHARS = 200000
+
+
+def compact_tool_content(content: str, message_id: str) -> str:
+    """Build the compact form of a tool result's content.
+
+    Args:
+        content: Full content of the tool result message
+        message_id: ID of the stored message, referenced by the expand-message pointer
+
+    Returns:
+        Head/tail excerpt of the content followed by an expand-message pointer
+    """
+    if len(content) > COMPACT_HEAD_CHARS + COMPACT_TAIL_CHARS:
+        omitted = len(content) - COMPACT_HEAD_CHARS - COMPACT_TAIL_CHARS
+        excerpt = (
+            content[:COMPACT_HEAD_CHARS]
+            + f"\n\n... ({omitted} characters truncated) ...\n\n"
+            + content[-COMPACT_TAIL_CHARS:]
+        )
+    else:
+        excerpt = content
+    return excerpt + f"\n\nThis message is too long, use the expand-message tool with message_id \"{message_id}\" to see the full message"
+
+
+def cap_latest_tool_content(content: str) -> str:
+    """Cap the most recent tool result so a single result cannot overload the context."""
+    return content[:LATEST_RESULT_MAX_CHARS] + "\n\nThis message is too long, repeat relevant information in your response to remember it"
+
+
+def build_compact_metadata(message: Dict[str, Any], message_id: str) -> Optional[Dict[str, Any]]:
+    """Return the compact metadata entry for a tool result message, if it is large enough to need one."""
+    content = message.get('content')
+    if not isinstance(content, str) or len(content) <= COMPACT_MIN_CHARS:
+        return None
+    return {'content': compact_tool_content(content, message_id)}
@@ -0,0 +1,315 @@
+"""
+Incremental extraction of XML tool call chunks from streamed LLM output.
+
+The streaming response processor used to append every delta to a buffer and
+re-scan the whole buffer for complete tool calls, removing matches with
+str.replace, which is quadratic in the length of the assistant message.
+StreamingXMLChunkParser is a resumable state machine instead: each delta is
+scanned once, text outside tool calls is dropped as soon as it is known not to
+start a tag, and a complete chunk is emitted as soon as its closing tag arrives.
+The scanned text of an open chunk is kept as a list of pieces and joined only
+when the chunk closes, so neither many small deltas nor one large text are
+copied more than a constant number of times.
+
+Two formats are recognized:
+
+    <function_calls>
+    <invoke name="function_name">
+    <parameter name="param_name">param_value</parameter>
+    </invoke>
+    </function_calls>
+
+and legacy tags named after registered XML tools (e.g. <create-file ...>...</create-file>).
+Parameter values are opaque: tags inside a <parameter> are not interpreted
+until its </parameter> arrives.
+"""
+
+from typing import Dict, Iterable, List, Optional
+
+FUNCTION_CALLS_TAG = "function_calls"
+INVOKE_TAG = "invoke"
+PARAMETER_TAG = "parameter"
+
+PARAMETER_CLOSE = "</parameter>"
+
+# Characters that may follow a tag name in an opening tag
+_TAG_NAME_TERMINATORS = frozenset(" \t\r\n>/")
+
+# Trie node key marking the end of a tag name
+_END = ""
+
+
+def _build_trie(names: Iterable[str]) -> Dict[str, dict]:
+    """Build a character trie over tag names."""
+    root: Dict[str, dict] = {}
+    for name in names:
+        if not name:
+            continue
+        node = root
+        for char in name:
+            node = node.setdefault(char, {})
+        node[_END] = name
+    return root
+
+
+class StreamingXMLChunkParser:
+    """Resumable parser that yields complete XML tool call chunks from a text stream.
+
+    Usage:
+        parser = StreamingXMLChunkParser(tool_registry.xml_tools.keys())
+        for delta in stream:
+            for chunk in parser.feed(delta):
+                ...
+
+    Chunks are returned verbatim, from the opening tag through its closing tag,
+    in the order they complete.
+    """
+
+    # Sentinel returned by _match_tag when the buffer ends before the tag can be decided
+    _INCOMPLETE = object()
+
+    def __init__(self, legacy_tag_names: Optional[Iterable[str]] = None):
+        """
+        Args:
+            legacy_tag_names: Registered XML tool tag names accepted as top-level legacy chunks
+        """
+        top_level = [FUNCTION_CALLS_TAG]
+        top_level.extend(name for name in (legacy_tag_names or []) if name != FUNCTION_CALLS_TAG)
+        self._top_level_trie = _build_trie(top_level)
+        self._block_trie = _build_trie([INVOKE_TAG, PARAMETER_TAG])
+        self._block_close_trie = _build_trie([INVOKE_TAG, FUNCTION_CALLS_TAG])
+
+        self._parts: List[str] = []  # Scanned text of the open chunk that precedes _buffer
+        self._buffer = ""  # Text of the current feed call, plus the unscanned tail of earlier ones
+        self._start = 0  # Position in _buffer of the open chunk's rest, or of a possible partial tag
+        self._scan = 0  # Position in _buffer where scanning resumes
+        self._tag: Optional[str] = None  # Top-level tag of the open chunk
+        self._depth = 0  # Nesting depth of the open legacy tag
+        self._in_invoke = False
+        self._in_parameter = False
+
+    @property
+    def in_chunk(self) -> bool:
+        """Whether a tool call chunk has been opened but not yet closed."""
+        return self._tag is not None
+
+    @property
+    def pending(self) -> str:
+        """Text held back because it belongs to an open chunk or may start a tag."""
+        return "".join(self._parts) + self._buffer[self._start:]
+
+    def reset(self) -> None:
+        """Discard any partial chunk."""
+        self._parts = []
+        self._buffer = ""
+        self._start = 0
+        self._scan = 0
+        self._tag = None
+        self._depth = 0
+        self._in_invoke = False
+        self._in_parameter = False
+
+    def feed(self, text: str) -> List[str]:
+        """Consume the next piece of the stream.
+
+        Args:
+            text: Newly received text
+
+        Returns:
+            Chunks completed by this text, in stream order
+        """
+        if not text:
+            return []
+        # Only the unscanned tail of earlier calls is left in the buffer (see _compact)
+        self._buffer += text
+        chunks: List[str] = []
+
+        while True:
+            if self._tag is None:
+                if not self._scan_top_level():
+                    break
+            elif self._tag == FUNCTION_CALLS_TAG:
+                chunk = self._scan_function_calls()
+                if chunk is None:
+                    break
+                chunks.append(chunk)
+            else:
+                chunk = self._scan_legacy()
+                if chunk is None:
+                    break
+                chunks.append(chunk)
+
+        self._compact()
+        return chunks
+
+    def _compact(self) -> None:
+        """Drop consumed text from the buffer, moving the scanned part of an open chunk to _parts."""
+        keep = self._start
+        if self._tag is not None:
+            if self._scan > self._start:
+                self._parts.append(self._buffer[self._start:self._scan])
+            keep = self._scan
+        if keep:
+            self._buffer = self._buffer[keep:]
+            self._scan -= keep
+            self._start = 0
+
+    def _match_tag(self, pos: int, trie: Dict[str, dict], closing: bool):
+        """Match the tag starting at self._buffer[pos] (a '<') against a trie.
+
+        Returns:
+            The matched tag name, None if the tag is not one of interest, or
+            _INCOMPLETE if more text is needed to decide.
+        """
+        buffer = self._buffer
+        end = len(buffer)
+        i = pos + 1
+        if closing:
+            if i >= end:
+                return self._INCOMPLETE
+            if buffer[i] != "/":
+                return None
+            i += 1
+
+        node = trie
+        while True:
+            if i >= end:
+                return self._INCOMPLETE
+            char = buffer[i]
+            name = node.get(_END)
+            if name is not None:
+                if closing:
+                    if char == ">":
+                        return name
+                elif char in _TAG_NAME_TERMINATORS:
+                    return name
+            node = node.get(char)
+            if node is None:
+                return None
+            i += 1
+
+    def _scan_top_level(self) -> bool:
+        """Look for the opening tag of the next chunk. Returns True if one was opened."""
+        buffer = self._buffer
+        pos = buffer.find("<", self._scan)
+        while pos != -1:
+            name = self._match_tag(pos, self._top_level_trie, closing=False)
+            if name is self._INCOMPLETE:
+                # Keep only the possible partial tag
+                self._start = self._scan = pos
+                return False
+            if name is not None:
+                self._start = pos
+                self._scan = pos + len(name) + 1
+                self._tag = name
+                self._depth = 1
+                self._in_invoke = False
+                self._in_parameter = False
+                return True
+            pos = buffer.find("<", pos + 1)
+
+        # Nothing here can start a chunk
+        self._start = self._scan = len(buffer)
+        return False
+
+    def _close_chunk(self, end: int) -> str:
+        """Emit the open chunk ending at end and continue after it."""
+        self._parts.append(self._buffer[self._start:end])
+        chunk = "".join(self._parts)
+        self._parts = []
+        self._start = self._scan = end
+        self._tag = None
+        self._depth = 0
+        self._in_invoke = False
+        self._in_parameter = False
+        return chunk
+
+    def _scan_function_calls(self) -> Optional[str]:
+        """Advance through an open <function_calls> block. Returns the block once it closes."""
+        while True:
+            buffer = self._buffer
+
+            if self._in_parameter:
+                pos = buffer.find(PARAMETER_CLOSE, self._scan)
+                if pos == -1:
+                    # The closing tag may be split across deltas
+                    self._scan = max(self._scan, len(buffer) - len(PARAMETER_CLOSE) + 1)
+                    return None
+                self._in_parameter = False
+                self._scan = pos + len(PARAMETER_CLOSE)
+                continue
+
+            pos = buffer.find("<", self._scan)
+            if pos == -1:
+                self._scan = len(buffer)
+                return None
+            if pos + 1 >= len(buffer):
+                self._scan = pos
+                return None
+
+            if buffer[pos + 1] == "/":
+                name = self._match_tag(pos, self._block_close_trie, closing=True)
+                if name is self._INCOMPLETE:
+                    self._scan = pos
+                    return None
+                if name == FUNCTION_CALLS_TAG:
+                    return self._close_chunk(pos + len(name) + 3)
+                if name == INVOKE_TAG:
+                    self._in_invoke = False
+                self._scan = pos + 1
+                continue
+
+            name = self._match_tag(pos, self._block_trie, closing=False)
+            if name is self._INCOMPLETE:
+                self._scan = pos
+                return None
+            if name == PARAMETER_TAG:
+                # Parameter values start after the end of the opening tag
+                tag_end = buffer.find(">", pos)
+                if tag_end == -1:
+                    self._scan = pos
+                    return None
+                self._in_parameter = buffer[tag_end - 1] != "/"
+                self._scan = tag_end + 1
+                continue
+            if name == INVOKE_TAG:
+                self._in_invoke = True
+            self._scan = pos + 1
+
+    def _scan_legacy(self) -> Optional[str]:
+        """Advance through an open legacy tag, honoring nested tags of the same name."""
+        tag = self._tag
+        open_prefix = "<" + tag
+        close_tag = "</" + tag + ">"
+        while True:
+            buffer = self._buffer
+            pos = buffer.find("<", self._scan)
+            if pos == -1:
+                self._scan = len(buffer)
+                return None
+            if buffer.startswith(close_tag, pos):
+                self._depth -= 1
+                if self._depth == 0:
+                    return self._close_chunk(pos + len(close_tag))
+                self._scan = pos + len(close_tag)
+                continue
+            if buffer.startswith(open_prefix, pos):
+                after = pos + len(open_prefix)
+                if after >= len(buffer):
+                    self._scan = pos
+                    return None
+                if buffer[after] in _TAG_NAME_TERMINATORS:
+                    self._depth += 1
+                self._scan = after
+                continue
+            remainder = buffer[pos:pos + len(close_tag)]
+            if len(remainder) < len(close_tag) and (close_tag.startswith(remainder) or open_prefix.startswith(remainder)):
+                # Possibly the start of a nested or closing tag
+                self._scan = pos
+                return None
+            self._scan = pos + 1
+
+
+def extract_xml_chunks(content: str, legacy_tag_names: Optional[Iterable[str]] = None) -> List[str]:
+    """Extract all complete XML tool call chunks from a complete text."""
+    return StreamingXMLChunkParser(legacy_tag_names).feed(content)
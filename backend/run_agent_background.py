@@ -1,10 +1,16 @@
 import sentry
 import asyncio
 import json
+import time
 import traceback
 from datetime import datetime, timezone
-from typing import Optional, List
+from typing import Dict, Optional, List
 from services import redis
+from services import run_stream
+from services.pubsub import CONNECTION_LOST, get_agent_run_control_pubsub
+from services import run_admission
+from services import run_checkpoint
+from services import worker_metrics
 from agent.run import run_agent
 from utils.logger import logger
 import dramatiq
@@ -12,7 +18,11 @@ from agentpress.thread_manager import ThreadManager
 from services.supabase import DBConnection
 from dramatiq.brokers.redis import RedisBroker
 import os
+import threading
+import concurrent.futures
+from dramatiq.asyncio import EventLoopThread, get_event_loop_thread
 from services.langfuse import langfuse
+from utils.config import config
 
 # Replace RabbitMQ configuration with Redis
 redis_host = os.getenv('REDIS_HOST', 'redis')
@@ -65,42 +75,227 @@ except Exception as e:
     logger.error(f"❌ Failed to initialize Dramatiq Redis broker: {e}")
     raise
 
-_initialized = False
 db = DBConnection()
 instance_id = "single"
 
 # Constants for Redis size monitoring
 MAX_REDIS_LIST_SIZE_MB = 8.0  # Conservative limit to stay under Upstash 10MB
-REDIS_SIZE_CHECK_INTERVAL = 100  # Check size every N responses
+MAX_REDIS_LIST_SIZE_BYTES = int(MAX_REDIS_LIST_SIZE_MB * 1024 * 1024)
+REDIS_TTL_REFRESH_INTERVAL = 100  # Refresh the response list TTL every N responses
 REDIS_RESPONSE_LIST_TTL = 3600 * 24  # 24 hours
 
+# Active run heartbeat
+ACTIVE_RUN_HEARTBEAT_INTERVAL = 300  # Seconds between refreshes of the active run key TTL
+
+# Seconds between samples of the queue backlog and Redis pool for the worker metrics
+METRICS_SAMPLE_INTERVAL = 15
+
+# Event loop used outside a Dramatiq worker (when the AsyncIO middleware has not started one)
+_fallback_loop_thread: Optional[EventLoopThread] = None
+_fallback_loop_lock = threading.Lock()
+_runs_on_loop = 0
+
+# Persistent event loop of each Dramatiq worker thread (runs in the default mode)
+_thread_loops = threading.local()
+
+# Runs executing as tasks on the worker's loop when AGENT_RUNS_PER_WORKER > 0
+_active_run_tasks: Dict[str, asyncio.Task] = {}
+_run_slots: Optional[asyncio.Semaphore] = None
+
+# Periodic scan for runs whose worker died (see _resume_orphaned_runs)
+_orphan_scanner: Optional[concurrent.futures.Future] = None
+
+# Periodic sampling of queue and pool metrics (see _sample_metrics_periodically)
+_metrics_sampler: Optional[concurrent.futures.Future] = None
+
 async def initialize():
-    """Initialize database connection."""
-    global _initialized
-    if not _initialized:
-        await db.initialize()
-        _initialized = True
-
-async def estimate_redis_list_size(key: str) -> float:
-    """Estimate the size of a Redis list in MB."""
+    """Initialize the running event loop's database and Redis connections."""
+    await db.initialize()
+    await redis.initialize_async()
+
+def _get_thread_loop() -> asyncio.AbstractEventLoop:
+    """Get the persistent event loop of the current worker thread.
+
+    In the default mode each Dramatiq worker thread runs its runs on its own loop,
+    so a tool blocking one loop does not stall the runs of other threads. The loop
+    lives as long as the thread, so the loop's DB and Redis clients stay warm
+    across runs.
+    """
+    loop = getattr(_thread_loops, "loop", None)
+    if loop is None or loop.is_closed():
+        loop = _thread_loops.loop = asyncio.new_event_loop()
+    return loop
+
+def _close_thread_loop() -> None:
+    """Close the current worker thread's loop and its Redis and DB clients."""
+    loop = getattr(_thread_loops, "loop", None)
+    if loop is None or loop.is_closed():
+        return
     try:
-        list_length = await redis.llen(key)
-        if list_length == 0:
-            return 0.0
-
-        # Sample a few responses to estimate total size
-        sample_size = min(10, list_length)
-        sample_responses = await redis.lrange(key, 0, sample_size - 1)
-
-        if sample_responses:
-            total_sample_size = sum(len(item.encode('utf-8')) for item in sample_responses)
-            avg_response_size = total_sample_size / len(sample_responses)
-            estimated_total_size = avg_response_size * list_length
-            return estimated_total_size / (1024 * 1024)  # Convert to MB
-        return 0.0
+        loop.run_until_complete(redis.close())
+        loop.run_until_complete(DBConnection.disconnect())
     except Exception as e:
-        logger.warning("Failed to estimate Redis list size for {key}: {e}")
-        return 0.0
+        logger.warning(f"Failed to close connections of a worker thread's event loop: {e}")
+    finally:
+        loop.close()
+
+def _get_worker_loop_thread() -> EventLoopThread:
+    """Get the event loop shared by the whole worker process.
+
+    It runs the orphan scan, the metrics sampling and, with
+    AGENT_RUNS_PER_WORKER > 0, the concurrent runs. Dramatiq's AsyncIO
+    middleware starts it when the worker boots; outside a worker one is started
+    on first use.
+    """
+    global _fallback_loop_thread
+    loop_thread = get_event_loop_thread()
+    if loop_thread is not None:
+        return loop_thread
+    with _fallback_loop_lock:
+        if _fallback_loop_thread is None:
+            _fallback_loop_thread = EventLoopThread(logger)
+            _fallback_loop_thread.daemon = True
+            _fallback_loop_thread.start(timeout=5.0)
+        return _fallback_loop_thread
+
+class WorkerResources(dramatiq.Middleware):
+    """Connects the DB and Redis clients on the worker's event loop when the worker boots,
+    so the first run does not pay for it, and starts the scan for orphaned runs and
+    the metrics sampling. On shutdown these are stopped and concurrent runs are cancelled."""
+
+    def after_worker_boot(self, broker, worker):
+        global _orphan_scanner, _metrics_sampler
+        loop_thread = _get_worker_loop_thread()
+        try:
+            loop_thread.run_coroutine(initialize())
+            logger.info("Worker resources initialized on the shared event loop")
+        except Exception as e:
+            logger.warning(f"Failed to initialize worker resources at boot, will retry on first run: {e}")
+        if config.AGENT_RUN_RESUME_ENABLED:
+            _orphan_scanner = asyncio.run_coroutine_threadsafe(_resume_orphaned_runs_periodically(), loop_thread.loop)
+        if config.WORKER_METRICS_PORT:
+            _metrics_sampler = asyncio.run_coroutine_threadsafe(_sample_metrics_periodically(), loop_thread.loop)
+
+    def before_worker_shutdown(self, broker, worker):
+        for background_task in (_orphan_scanner, _metrics_sampler):
+            if background_task is not None:
+                background_task.cancel()
+        if not _active_run_tasks:
+            return
+        try:
+            _get_worker_loop_thread().run_coroutine(_cancel_concurrent_runs())
+        except Exception as e:
+            logger.warning(f"Failed to cancel concurrent agent runs on shutdown: {e}")
+
+    def after_worker_thread_shutdown(self, broker, thread):
+        _close_thread_loop()
+
+redis_broker.add_middleware(WorkerResources())
+redis_broker.add_middleware(worker_metrics.QueueMetrics())
+
+async def _start_concurrent_run(agent_run_id: str, run_args: tuple) -> None:
+    """Wait for one of the AGENT_RUNS_PER_WORKER slots, then start the run as a task on this loop."""
+    global _run_slots
+    if _run_slots is None:
+        _run_slots = asyncio.Semaphore(config.AGENT_RUNS_PER_WORKER)
+    await _run_slots.acquire()
+    try:
+        task = asyncio.create_task(_run_in_slot(agent_run_id, run_args), name=f"agent-run-{agent_run_id}")
+    except BaseException:
+        _run_slots.release()
+        raise
+    _active_run_tasks[agent_run_id] = task
+    logger.debug(f"Started agent run {agent_run_id} as a task ({len(_active_run_tasks)}/{config.AGENT_RUNS_PER_WORKER} slots in use)")
+
+async def _run_in_slot(agent_run_id: str, run_args: tuple) -> None:
+    """Execute a concurrent run in its own Sentry scope and free its slot when it ends."""
+    try:
+        with sentry.sentry.isolation_scope():
+            await _run_agent_background_async(*run_args)
+    except asyncio.CancelledError:
+        logger.warning(f"Agent run {agent_run_id} was cancelled")
+    except Exception as e:
+        logger.error(f"Unhandled error in agent run {agent_run_id}: {e}", exc_info=True)
+    finally:
+        _active_run_tasks.pop(agent_run_id, None)
+        _run_slots.release()
+
+async def _cancel_concurrent_runs(timeout: float = 10.0) -> None:
+    """Cancel the runs executing on this loop and give them time to clean up."""
+    tasks = list(_active_run_tasks.values())
+    logger.info(f"Cancelling {len(tasks)} concurrent agent runs")
+    for task in tasks:
+        task.cancel()
+    await asyncio.wait(tasks, timeout=timeout)
+
+async def _sample_metrics_periodically() -> None:
+    """Record the agent run queues' backlog and this process's Redis pool every METRICS_SAMPLE_INTERVAL seconds."""
+    while True:
+        try:
+            await initialize()
+            worker_metrics.record_queue_stats(await run_admission.get_all_queue_stats())
+            worker_metrics.record_redis_pool_stats(redis.get_pool_stats())
+        except Exception as e:
+            logger.warning(f"Failed to sample worker metrics: {e}")
+        await asyncio.sleep(METRICS_SAMPLE_INTERVAL)
+
+async def _resume_orphaned_runs_periodically() -> None:
+    """Run _resume_orphaned_runs every AGENT_RUN_ORPHAN_SCAN_INTERVAL seconds."""
+    while True:
+        await asyncio.sleep(config.AGENT_RUN_ORPHAN_SCAN_INTERVAL)
+        try:
+            await _resume_orphaned_runs()
+        except Exception as e:
+            logger.error(f"Failed to scan for orphaned agent runs: {e}", exc_info=True)
+
+async def _resume_orphaned_runs() -> int:
+    """Re-enqueue running runs whose lease expired because their worker died.
+
+    Each orphan is claimed first so only one worker re-enqueues it; the claim is
+    kept until the resumed run starts, or dropped if its queued message was lost.
+    Runs already resumed AGENT_RUN_MAX_RESUMES times are marked failed instead.
+
+    Returns:
+        Number of runs re-enqueued
+    """
+    await initialize()
+    client = await db.client
+    result = await client.table('agent_runs').select('id, checkpoint').eq('status', 'running').not_.is_('checkpoint', 'null').execute()
+    redis_client = await redis.get_client()
+    resumed = 0
+    for run in result.data or []:
+        agent_run_id = run['id']
+        checkpoint = run['checkpoint']
+        lease_value = await redis_client.get(run_checkpoint.run_lease_key(agent_run_id))
+        if lease_value:
+            if not await run_checkpoint.is_stale_claim(lease_value):
+                continue
+            logger.warning(f"The queued resume of agent run {agent_run_id} was lost, re-enqueueing it again")
+            await run_checkpoint.release_lease(agent_run_id, lease_value)
+        claim = await run_checkpoint.claim_orphan(agent_run_id)
+        if not claim:
+            continue
+
+        resume_count = checkpoint.get('resume_count', 0)
+        if resume_count >= config.AGENT_RUN_MAX_RESUMES:
+            logger.error(f"Agent run {agent_run_id} lost its worker again after {resume_count} resumes, marking it failed")
+            await update_agent_run_status(client, agent_run_id, "failed", error=f"Worker lost after {resume_count} resumes")
+            try:
+                await run_stream.publish_control(agent_run_id, "ERROR")
+            except Exception as e:
+                logger.warning(f"Failed to publish ERROR signal for {agent_run_id}: {e}")
+            continue
+
+        params = checkpoint['params']
+        account_id = params.get('account_id')
+        queue_name = run_admission.DEFAULT_QUEUE_NAME
+        if account_id:
+            queue_name = run_admission.queue_for_tier(await run_admission.get_account_tier(account_id))
+        message = get_run_actor(queue_name).send(**params, resume=True)
+        await run_checkpoint.mark_claim_queued(agent_run_id, claim, queue_name, message.options["redis_message_id"])
+        resumed += 1
+        logger.warning(f"Re-enqueued orphaned agent run {agent_run_id} on {queue_name} (iteration {checkpoint.get('iteration_count', 0)}, resume {resume_count + 1})")
+    return resumed
 
 async def safe_redis_write(operation, *args, operation_name: str = "redis_operation"):
     """Safely execute a Redis write operation with proper error handling."""
@@ -112,74 +307,370 @@ async def safe_redis_write(operation, *args, operation_name: str = "redis_operat
         raise
 
 class RedisWriteManager:
-    """Manages Redis writes with size monitoring and error handling."""
+    """Manages Redis writes with size monitoring and error handling.
 
-    def __init__(self, response_list_key: str, response_channel: str):
+    Each response is appended to the run's list and announced on its channel in a
+    single MULTI round trip. Large responses are stored compressed, and the
+    list's size is tracked exactly from the stored bytes, so no reads are needed
+    to enforce MAX_REDIS_LIST_SIZE_MB.
+    """
+
+    def __init__(
+        self,
+        response_list_key: str,
+        response_channel: str,
+        response_stream_key: Optional[str] = None,
+        checkpointer: Optional["ResponseCheckpointer"] = None
+    ):
+        """
+        Args:
+            response_list_key: List the responses are appended to
+            response_channel: Channel notified of each new response
+            response_stream_key: If given, responses are appended to this Redis Stream instead
+                                 (no list, no notification)
+            checkpointer: If given, every response is also queued for durable storage,
+                          including responses past the Redis size limit
+        """
         self.response_list_key = response_list_key
         self.response_channel = response_channel
+        self.response_stream_key = response_stream_key
+        self.checkpointer = checkpointer
         self.response_count = 0
         self.size_exceeded = False
-        self.last_size_check = 0
-        self.estimated_current_size = 0.0
+        self.current_size_bytes = 0
+
+    @property
+    def current_size_mb(self) -> float:
+        return self.current_size_bytes / (1024 * 1024)
+
+    async def _push(self, response_json: str, operation_name: str) -> None:
+        # Refresh the list TTL on the first write and every REDIS_TTL_REFRESH_INTERVAL writes after
+        ttl = REDIS_RESPONSE_LIST_TTL if self.response_count % REDIS_TTL_REFRESH_INTERVAL == 0 else None
+        if self.response_stream_key:
+            await safe_redis_write(
+                redis.xadd, self.response_stream_key, {run_stream.STREAM_DATA_FIELD: response_json},
+                config.AGENT_STREAM_MAXLEN, ttl, operation_name=operation_name
+            )
+            return
+        await safe_redis_write(
+            redis.rpush_and_publish, self.response_list_key, response_json, self.response_channel, "new", ttl,
+            operation_name=operation_name
+        )
 
     async def write_response(self, response_json: str) -> bool:
         """Write response to Redis with size monitoring."""
+        if self.checkpointer:
+            self.checkpointer.add(response_json)
+
         if self.size_exceeded:
             logger.warning(f"Skipping Redis write due to size limit for {self.response_list_key}")
             return False
 
-        # Optimized size checking - only check every 100 responses and estimate in between
-        response_size_mb = len(response_json.encode('utf-8')) / (1024 * 1024)
-        self.estimated_current_size += response_size_mb
-
-        # Only do expensive size check periodically
-        if self.response_count % REDIS_SIZE_CHECK_INTERVAL == 0 and self.response_count > 0:
-            try:
-                actual_size = await estimate_redis_list_size(self.response_list_key)
-                if actual_size > 0:
-                    self.estimated_current_size = actual_size  # Sync our estimate with reality
-                    
-                if actual_size > MAX_REDIS_LIST_SIZE_MB:
-                    logger.warning(f"Redis list {self.response_list_key} exceeded size limit: {actual_size:.2f}MB")
-                    self.size_exceeded = True
-                    # Add a warning message to indicate truncation
-                    warning_response = {
-                        "type": "status",
-                        "status": "warning",
-                        "message": f"Response list truncated due to size limit ({actual_size:.1f}MB). Continuing with database-only storage."
-                    }
-                    try:
-                        await safe_redis_write(redis.rpush, self.response_list_key, json.dumps(warning_response), operation_name="rpush_warning")
-                        await safe_redis_write(redis.publish, self.response_channel, "new", operation_name="publish_warning")
-                    except Exception as warning_error:
-                        logger.error(f"Failed to write size warning to Redis: {warning_error}")
-                    return False
-            except Exception as size_check_error:
-                logger.warning(f"Failed to check Redis size, continuing with estimated size: {size_check_error}")
-        
-        # Fast check using estimated size between full checks
-        elif self.estimated_current_size > MAX_REDIS_LIST_SIZE_MB:
-            logger.warning(f"Estimated Redis size ({self.estimated_current_size:.2f}MB) exceeds limit, stopping writes")
+        # Encode once here so the size budget counts the compressed bytes actually stored
+        response_json = redis.encode_value(response_json)
+        response_size = len(response_json.encode('utf-8'))
+        if self.current_size_bytes + response_size > MAX_REDIS_LIST_SIZE_BYTES:
+            logger.warning(f"Redis list {self.response_list_key} would exceed size limit: {(self.current_size_bytes + response_size) / (1024 * 1024):.2f}MB")
             self.size_exceeded = True
+            # Add a warning message to indicate truncation
+            warning_response = {
+                "type": "status",
+                "status": "warning",
+                "message": f"Response list truncated due to size limit ({self.current_size_mb:.1f}MB). Continuing with database-only storage."
+            }
+            try:
+                await self._push(json.dumps(warning_response), "rpush_warning")
+            except Exception as warning_error:
+                logger.error(f"Failed to write size warning to Redis: {warning_error}")
             return False
 
-        # Write response and notification atomically with better error handling
         try:
-            await safe_redis_write(redis.rpush, self.response_list_key, response_json, operation_name="rpush_response")
-            await safe_redis_write(redis.publish, self.response_channel, "new", operation_name="publish_response")
+            await self._push(response_json, "rpush_response")
             self.response_count += 1
-            
+            self.current_size_bytes += response_size
+
             # Log progress every 50 responses
             if self.response_count % 50 == 0:
-                logger.debug(f"Redis: {self.response_count} responses written, estimated size: {self.estimated_current_size:.2f}MB")
-            
+                logger.debug(f"Redis: {self.response_count} responses written, size: {self.current_size_mb:.2f}MB")
+
             return True
         except Exception as e:
             logger.error(f"Failed to write response to Redis: {e}")
             # Don't mark as size exceeded for regular Redis errors
             return False
 
-@dramatiq.actor
+def _is_content_chunk(response: dict) -> bool:
+    """Whether a response is a streamed assistant content delta."""
+    if response.get('type') != 'assistant':
+        return False
+    metadata = response.get('metadata')
+    if isinstance(metadata, str):
+        # Content deltas carry small metadata; avoid parsing anything larger
+        return '"stream_status": "chunk"' in metadata or '"stream_status":"chunk"' in metadata
+    return isinstance(metadata, dict) and metadata.get('stream_status') == 'chunk'
+
+class StreamChunkCoalescer:
+    """Merges consecutive streamed content chunks before they are written to Redis.
+
+    Content deltas are buffered for up to window_ms (or until max_bytes of text
+    is pending) and written as a single chunk carrying the first delta's
+    sequence number. Any other response flushes the buffer and is written
+    immediately, so status and tool events keep their order and latency.
+    """
+
+    def __init__(self, redis_writer: RedisWriteManager, window_ms: int, max_bytes: int):
+        self.redis_writer = redis_writer
+        self.window = window_ms / 1000
+        self.max_bytes = max_bytes
+        self._pending: List[dict] = []
+        self._pending_texts: List[str] = []
+        self._pending_bytes = 0
+        self._lock = asyncio.Lock()
+        self._timer: Optional[asyncio.Task] = None
+        self.chunks_received = 0
+        self.chunks_written = 0
+
+    async def add(self, response: dict) -> None:
+        """Write a response, buffering it first if it is a content chunk."""
+        if self.window <= 0 or not _is_content_chunk(response):
+            async with self._lock:
+                await self._flush_locked()
+                await self.redis_writer.write_response(json.dumps(response))
+            return
+
+        try:
+            content = response.get('content')
+            text = (json.loads(content) if isinstance(content, str) else content).get('content') or ''
+        except (json.JSONDecodeError, AttributeError):
+            async with self._lock:
+                await self._flush_locked()
+                await self.redis_writer.write_response(json.dumps(response))
+            return
+
+        async with self._lock:
+            self.chunks_received += 1
+            if self._pending and self._pending[0].get('metadata') != response.get('metadata'):
+                await self._flush_locked()
+            self._pending.append(response)
+            self._pending_texts.append(text)
+            self._pending_bytes += len(text.encode('utf-8'))
+            if self._pending_bytes >= self.max_bytes:
+                await self._flush_locked()
+            elif self._timer is None:
+                self._timer = asyncio.create_task(self._flush_after_window())
+
+    async def flush(self) -> None:
+        """Write any buffered content now."""
+        async with self._lock:
+            await self._flush_locked()
+
+    def cancel(self) -> None:
+        """Stop the window timer without writing buffered content."""
+        if self._timer and not self._timer.done():
+            self._timer.cancel()
+        self._timer = None
+
+    async def close(self) -> None:
+        """Flush buffered content and stop the window timer."""
+        await self.flush()
+        self.cancel()
+        if self.chunks_received:
+            logger.debug(f"Coalesced {self.chunks_received} content chunks into {self.chunks_written} writes for {self.redis_writer.response_list_key}")
+
+    async def _flush_after_window(self) -> None:
+        try:
+            await asyncio.sleep(self.window)
+            async with self._lock:
+                self._timer = None
+                await self._flush_locked()
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logger.error(f"Error flushing coalesced chunks for {self.redis_writer.response_list_key}: {e}")
+
+    async def _flush_locked(self) -> None:
+        if self._timer and self._timer is not asyncio.current_task():
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending:
+            return
+
+        if len(self._pending) == 1:
+            merged = self._pending[0]
+        else:
+            merged = dict(self._pending[0])
+            merged['content'] = json.dumps({"role": "assistant", "content": "".join(self._pending_texts)})
+            merged['updated_at'] = self._pending[-1].get('updated_at', merged.get('updated_at'))
+
+        self._pending = []
+        self._pending_texts = []
+        self._pending_bytes = 0
+        self.chunks_written += 1
+        await self.redis_writer.write_response(json.dumps(merged))
+
+class ResponseCheckpointer:
+    """Persists the responses of an agent run to the database in batches while it runs.
+
+    Responses are appended to agent_run_response_batches every interval_ms, or as
+    soon as max_batch are queued, so a run's output survives a worker crash and
+    the end of the run no longer writes every response in one request. Batches
+    that fail to insert are retried with the next flush, a bounded number of
+    times (see flush).
+    """
+
+    def __init__(self, agent_run_id: str, interval_ms: int, max_batch: int):
+        self.agent_run_id = agent_run_id
+        self.interval = interval_ms / 1000
+        self.max_batch = max_batch
+        self.batch_index = 0
+        self.persisted_count = 0
+        self._pending: List[str] = []
+        self._failures = 0  # Consecutive failed flushes
+        self._lock = asyncio.Lock()
+        self._timer: Optional[asyncio.Task] = None
+        self._batch_tasks: set = set()
+
+    @property
+    def response_count(self) -> int:
+        """Responses persisted or waiting to be."""
+        return self.persisted_count + len(self._pending)
+
+    async def rewind(self, response_count: Optional[int]) -> None:
+        """Continue after the first response_count responses an earlier execution of the run persisted.
+
+        Responses of the tool cycle that execution was interrupted in are removed,
+        so the resumed run's responses replace them. With no response_count
+        (checkpoints without one), everything persisted is kept.
+        """
+        client = await db.client
+        if response_count is not None:
+            await client.table('agent_run_response_batches').delete().eq(
+                'agent_run_id', self.agent_run_id
+            ).gte('first_response_index', response_count).execute()
+        result = await client.table('agent_run_response_batches').select('batch_index, first_response_index, responses').eq(
+            'agent_run_id', self.agent_run_id
+        ).order('batch_index', desc=True).limit(1).execute()
+        if not result.data:
+            return
+        last_batch = result.data[0]
+        responses = last_batch['responses'] or []
+        kept = len(responses) if response_count is None else response_count - last_batch['first_response_index']
+        if kept < len(responses):
+            # The batch spans the checkpoint; drop its responses past it
+            await client.table('agent_run_response_batches').update({"responses": responses[:kept]}).eq(
+                'agent_run_id', self.agent_run_id
+            ).eq('batch_index', last_batch['batch_index']).execute()
+            responses = responses[:kept]
+        self.batch_index = last_batch['batch_index'] + 1
+        self.persisted_count = last_batch['first_response_index'] + len(responses)
+
+    def add(self, response_json: str) -> None:
+        """Queue a response (as JSON) for the next batch."""
+        self._pending.append(response_json)
+        if len(self._pending) >= self.max_batch:
+            batch_task = asyncio.create_task(self.flush())
+            self._batch_tasks.add(batch_task)
+            batch_task.add_done_callback(self._batch_tasks.discard)
+        elif self._timer is None or self._timer.done():
+            self._timer = asyncio.create_task(self._flush_periodically())
+
+    async def _flush_periodically(self) -> None:
+        try:
+            while True:
+                await asyncio.sleep(self.interval)
+                await self.flush()
+                if not self._pending:
+                    break
+        except asyncio.CancelledError:
+            pass
+
+    async def flush(self) -> bool:
+        """Insert all queued responses as one batch.
+
+        After AGENT_RUN_CHECKPOINT_MAX_RETRIES failed flushes in a row the batch is
+        split to isolate the responses that cannot be stored (e.g. text with NUL
+        characters, which JSONB rejects); those are logged and dropped, the rest
+        are stored.
+
+        Returns:
+            True if nothing is left queued
+        """
+        async with self._lock:
+            if not self._pending:
+                return True
+            responses_json = self._pending
+            self._pending = []
+            client = await db.client
+            if self._failures >= config.AGENT_RUN_CHECKPOINT_MAX_RETRIES:
+                self._failures = 0
+                dropped = await self._insert_batch_split(client, responses_json)
+                if dropped:
+                    logger.error(f"Dropped {dropped} responses of {self.agent_run_id} that cannot be checkpointed")
+                return not self._pending
+            try:
+                await self._insert_batch(client, responses_json)
+                self._failures = 0
+                return not self._pending
+            except Exception as e:
+                self._failures += 1
+                logger.error(f"Failed to checkpoint {len(responses_json)} responses for {self.agent_run_id} (attempt {self._failures}): {str(e)}")
+                self._pending = responses_json + self._pending
+                return False
+
+    async def _insert_batch(self, client, responses_json: List[str]) -> None:
+        """Insert responses as the next batch."""
+        row = {
+            "agent_run_id": self.agent_run_id,
+            "batch_index": self.batch_index,
+            "first_response_index": self.persisted_count,
+            # The responses are already serialized; parse them as one array
+            "responses": json.loads("[" + ",".join(responses_json) + "]"),
+        }
+        await client.table('agent_run_response_batches').insert(row, returning='minimal').execute()
+        self.batch_index += 1
+        self.persisted_count += len(responses_json)
+        logger.debug(f"Checkpointed {len(responses_json)} responses for {self.agent_run_id} (batch {row['batch_index']})")
+
+    async def _insert_batch_split(self, client, responses_json: List[str]) -> int:
+        """Insert responses in order, halving batches that fail until the failing responses are isolated.
+
+        Returns:
+            Number of responses dropped because they failed on their own
+        """
+        try:
+            await self._insert_batch(client, responses_json)
+            return 0
+        except Exception as e:
+            if len(responses_json) == 1:
+                logger.warning(f"Failed to checkpoint a response of {self.agent_run_id} ({responses_json[0][:200]}): {str(e)}")
+                return 1
+        middle = len(responses_json) // 2
+        return await self._insert_batch_split(client, responses_json[:middle]) + \
+            await self._insert_batch_split(client, responses_json[middle:])
+
+    async def close(self) -> bool:
+        """Stop the flush timer and persist everything still queued.
+
+        Returns:
+            True if every response was persisted
+        """
+        if self._timer and not self._timer.done():
+            self._timer.cancel()
+        self._timer = None
+        if self._batch_tasks:
+            await asyncio.gather(*self._batch_tasks, return_exceptions=True)
+        # The last attempt splits the batch if all others failed
+        for retry in range(config.AGENT_RUN_CHECKPOINT_MAX_RETRIES + 1):
+            if await self.flush():
+                return True
+            await asyncio.sleep(0.5 * (2 ** retry))
+        logger.error(f"Giving up on {len(self._pending)} unpersisted responses for {self.agent_run_id}")
+        return False
+
+@dramatiq.actor(
+    queue_name=run_admission.DEFAULT_QUEUE_NAME,
+    priority=run_admission.QUEUE_ACTOR_PRIORITIES[run_admission.DEFAULT_QUEUE_NAME]
+)
 def run_agent_background(
     agent_run_id: str,
     thread_id: str,
@@ -192,68 +683,64 @@ def run_agent_background(
     enable_context_manager: bool,
     agent_config: Optional[dict] = None,
     is_agent_builder: Optional[bool] = False,
-    target_agent_id: Optional[str] = None
+    target_agent_id: Optional[str] = None,
+    account_id: Optional[str] = None,
+    resume: bool = False
 ):
     """Run the agent in the background using Redis for state.
 
-    This is a sync function that properly manages the event loop for async operations.
-    Dramatiq's AsyncIO middleware requires sync actors.
+    The run executes on the worker thread's persistent event loop (see
+    _get_thread_loop), so the DB, Redis and LLM clients and their connection
+    pools are reused across runs instead of being rebuilt for a new loop every
+    time.
+
+    With AGENT_RUNS_PER_WORKER > 0 the actor only waits for a free slot and
+    starts the run as a task on the process's shared loop (see
+    _get_worker_loop_thread), so one worker process multiplexes up to that many
+    runs instead of one per worker thread.
+
+    With resume=True the run was re-enqueued by _resume_orphaned_runs and
+    continues from its checkpoint.
     """
-    # Simplified event loop handling - more reliable
+    run_args = (
+        agent_run_id, thread_id, instance_id, project_id, model_name,
+        enable_thinking, reasoning_effort, stream, enable_context_manager,
+        agent_config, is_agent_builder, target_agent_id, account_id, resume
+    )
+    concurrent = config.AGENT_RUNS_PER_WORKER > 0
     try:
-        # Check if we're already in an async context
-        try:
-            # Try to get the current running loop
-            loop = asyncio.get_running_loop()
-            logger.warning(f"Agent {agent_run_id}: Running in existing event loop, creating new thread")
-            
-            # Use ThreadPoolExecutor to run in a separate thread with its own event loop
-            import concurrent.futures
-            import threading
-            
-            def run_in_thread():
-                # Create a new event loop for this thread
-                new_loop = asyncio.new_event_loop()
-                asyncio.set_event_loop(new_loop)
-                try:
-                    logger.info(f"Agent {agent_run_id}: Running in new thread with dedicated event loop")
-                    return new_loop.run_until_complete(_run_agent_background_async(
-                        agent_run_id, thread_id, instance_id, project_id, model_name,
-                        enable_thinking, reasoning_effort, stream, enable_context_manager,
-                        agent_config, is_agent_builder, target_agent_id
-                    ))
-                except Exception as async_error:
-                    logger.error(f"Agent {agent_run_id}: Error in async execution: {async_error}", exc_info=True)
-                    raise
-                finally:
-                    new_loop.close()
-                    logger.debug(f"Agent {agent_run_id}: Event loop closed successfully")
-            
-            # Execute in thread pool with timeout
-            with concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"agent-{agent_run_id}") as executor:
-                future = executor.submit(run_in_thread)
-                return future.result(timeout=3600)  # 1 hour timeout
-                
-        except RuntimeError:
-            # No event loop running, we can use asyncio.run() directly
-            logger.info(f"Agent {agent_run_id}: No existing event loop, running with asyncio.run()")
-            return asyncio.run(_run_agent_background_async(
-                agent_run_id, thread_id, instance_id, project_id, model_name,
-                enable_thinking, reasoning_effort, stream, enable_context_manager,
-                agent_config, is_agent_builder, target_agent_id
-            ))
+        if concurrent:
+            return _get_worker_loop_thread().run_coroutine(_start_concurrent_run(agent_run_id, run_args))
+        return _get_thread_loop().run_until_complete(_run_agent_background_async(*run_args))
     except Exception as e:
         logger.error(f"💥 Critical error in sync actor wrapper for {agent_run_id}: {e}", exc_info=True)
         # Try to update agent status to failed if possible
+        async def mark_run_failed():
+            client = await db.client
+            await update_agent_run_status(client, agent_run_id, "failed", error=f"Worker initialization failed: {str(e)}")
         try:
-            asyncio.run(update_agent_run_status(
-                db.client, agent_run_id, "failed", 
-                error=f"Worker initialization failed: {str(e)}"
-            ))
+            if concurrent:
+                _get_worker_loop_thread().run_coroutine(mark_run_failed())
+            else:
+                _get_thread_loop().run_until_complete(mark_run_failed())
         except Exception as update_error:
             logger.error(f"Failed to update agent status after critical error: {update_error}")
         raise
 
+# The same actor on the queue of paying accounts, which workers process first
+run_agent_background_priority = dramatiq.actor(
+    run_agent_background.fn,
+    actor_name="run_agent_background_priority",
+    queue_name=run_admission.PRIORITY_QUEUE_NAME,
+    priority=run_admission.QUEUE_ACTOR_PRIORITIES[run_admission.PRIORITY_QUEUE_NAME]
+)
+
+def get_run_actor(queue_name: str):
+    """Get the agent run actor consuming a queue from run_admission.AGENT_RUN_QUEUES."""
+    if queue_name == run_admission.PRIORITY_QUEUE_NAME:
+        return run_agent_background_priority
+    return run_agent_background
+
 async def _run_agent_background_async(
     agent_run_id: str,
     thread_id: str,
@@ -266,11 +753,40 @@ async def _run_agent_background_async(
     enable_context_manager: bool,
     agent_config: Optional[dict] = None,
     is_agent_builder: Optional[bool] = False,
-    target_agent_id: Optional[str] = None
+    target_agent_id: Optional[str] = None,
+    account_id: Optional[str] = None,
+    resume: bool = False
 ):
     """Async implementation of the agent background runner."""
+    global _runs_on_loop
     await initialize()
 
+    # Only one execution of a run at a time; a re-enqueued orphan may be delivered twice
+    lease_owner = run_checkpoint.new_lease_owner()
+    lease_held = False
+    if config.AGENT_RUN_RESUME_ENABLED:
+        try:
+            lease_held = await run_checkpoint.acquire_lease(agent_run_id, lease_owner)
+        except Exception as e:
+            logger.warning(f"Failed to acquire lease of agent run {agent_run_id}, running without one: {e}")
+        else:
+            if not lease_held:
+                logger.warning(f"Agent run {agent_run_id} is already executing on another worker, skipping")
+                return
+
+    client = await db.client
+    checkpoint = None
+    final_status = "running"
+    if resume:
+        checkpoint = await run_checkpoint.load_checkpoint(client, agent_run_id)
+        if not checkpoint:
+            logger.info(f"Agent run {agent_run_id} ended before it could be resumed")
+            if lease_held:
+                await run_checkpoint.release_lease(agent_run_id, lease_owner)
+            return
+    _runs_on_loop += 1
+    logger.info(f"Agent run {agent_run_id} is run {_runs_on_loop} of this worker process (Redis pools: {redis.get_pool_stats()})")
+
     sentry.sentry.set_tag("thread_id", thread_id)
 
     logger.info("Starting background agent run: {agent_run_id} for thread: {thread_id} (Instance: {instance_id})")
@@ -278,65 +794,140 @@ async def _run_agent_background_async(
     if agent_config:
         logger.info("Using custom agent: {agent_config.get('name', 'Unknown')}")
 
-    client = await db.client
     start_time = datetime.now(timezone.utc)
     total_responses = 0
-    pubsub = None
+    control_messages = None
     stop_checker = None
+    heartbeat = None
+    consumer = None
     stop_signal_received = False
+    lease_lost = False
 
     # Define Redis keys and channels
-    response_list_key = "agent_run:{agent_run_id}:responses"
-    response_channel = "agent_run:{agent_run_id}:new_response"
-    instance_control_channel = "agent_run:{agent_run_id}:control:{instance_id}"
-    global_control_channel = "agent_run:{agent_run_id}:control"
-    instance_active_key = "active_run:{instance_id}:{agent_run_id}"
-
-    # Initialize Redis write manager
-    redis_writer = RedisWriteManager(response_list_key, response_channel)
+    response_list_key = run_stream.response_list_key(agent_run_id)
+    response_channel = run_stream.response_channel(agent_run_id)
+    instance_control_channel = run_stream.instance_control_channel(agent_run_id, instance_id)
+    global_control_channel = run_stream.control_channel(agent_run_id)
+    instance_active_key = run_stream.active_run_key(instance_id, agent_run_id)
+
+    # Initialize Redis write manager; content chunks are merged over a short window before writing
+    response_stream_key = run_stream.response_stream_key(agent_run_id) if run_stream.use_streams() else None
+    checkpointer = None
+    if config.AGENT_RUN_CHECKPOINT_ENABLED:
+        checkpointer = ResponseCheckpointer(
+            agent_run_id, config.AGENT_RUN_CHECKPOINT_INTERVAL_MS, config.AGENT_RUN_CHECKPOINT_MAX_BATCH
+        )
+    redis_writer = RedisWriteManager(response_list_key, response_channel, response_stream_key, checkpointer)
+    stream_writer = StreamChunkCoalescer(redis_writer, config.STREAM_COALESCE_WINDOW_MS, config.STREAM_COALESCE_MAX_BYTES)
 
     async def check_for_stop_signal():
+        """Wait for a STOP on the run's control channels and cancel the run's response loop."""
         nonlocal stop_signal_received
-        if not pubsub:
-            return
         try:
-            while not stop_signal_received:
-                message = await pubsub.get_message(ignore_subscribe_messages=True, timeout=0.5)
-                if message and message.get("type") == "message":
-                    data = message.get("data")
-                    if isinstance(data, bytes):
-                        data = data.decode('utf-8')
-                    if data == "STOP":
-                        logger.info("Received STOP signal for agent run {agent_run_id} (Instance: {instance_id})")
-                        stop_signal_received = True
-                        break
-
-                # Periodically refresh the active run key TTL
-                if total_responses % 50 == 0:
-                    try:
-                        await redis.expire(instance_active_key, redis.REDIS_KEY_TTL)
-                    except Exception as ttl_err:
-                        logger.warning("Failed to refresh TTL for {instance_active_key}: {ttl_err}")
-
-                await asyncio.sleep(0.1)
+            while True:
+                channel, data = await control_messages.get()
+                if channel is CONNECTION_LOST:
+                    # A STOP may have been missed while reconnecting; stop_agent_run updates the DB first
+                    status_result = await client.table('agent_runs').select('status').eq('id', agent_run_id).maybe_single().execute()
+                    if not status_result.data or status_result.data.get('status') == 'running':
+                        continue
+                    logger.info(f"Agent run {agent_run_id} was stopped while the control subscription was reconnecting")
+                elif data != "STOP":
+                    continue
+                else:
+                    logger.info(f"Received STOP signal for agent run {agent_run_id} (Instance: {instance_id})")
+                stop_signal_received = True
+                if consumer and not consumer.done():
+                    consumer.cancel()
+                return
         except asyncio.CancelledError:
-            logger.info("Stop signal checker cancelled for {agent_run_id} (Instance: {instance_id})")
+            logger.info(f"Stop signal checker cancelled for {agent_run_id} (Instance: {instance_id})")
         except Exception as e:
-            logger.error("Error in stop signal checker for {agent_run_id}: {e}", exc_info=True)
-            stop_signal_received = True
+            logger.error(f"Error in stop signal checker for {agent_run_id}: {e}", exc_info=True)
+
+    async def refresh_active_run_periodically():
+        """Keep the run's lease, its active run keys and its account slot from expiring while the run lasts.
+
+        If the lease was lost and another execution of the run has taken it over, this one is cancelled.
+        """
+        nonlocal lease_lost
+        interval = run_checkpoint.RUN_LEASE_REFRESH_INTERVAL if lease_held else ACTIVE_RUN_HEARTBEAT_INTERVAL
+        last_active_refresh = time.monotonic()
+        while True:
+            await asyncio.sleep(interval)
+            if lease_held:
+                try:
+                    if not await run_checkpoint.refresh_lease(agent_run_id, lease_owner) and \
+                            not await run_checkpoint.acquire_lease(agent_run_id, lease_owner):
+                        logger.error(f"Agent run {agent_run_id} was taken over by another worker, cancelling this execution")
+                        lease_lost = True
+                        if consumer and not consumer.done():
+                            consumer.cancel()
+                        return
+                except Exception as lease_err:
+                    logger.warning(f"Failed to refresh lease of agent run {agent_run_id}: {lease_err}")
+            if time.monotonic() - last_active_refresh < ACTIVE_RUN_HEARTBEAT_INTERVAL:
+                continue
+            last_active_refresh = time.monotonic()
+            try:
+                await run_stream.refresh_active_run(instance_id, agent_run_id)
+            except Exception as ttl_err:
+                logger.warning(f"Failed to refresh TTL for {instance_active_key}: {ttl_err}")
+            await run_admission.refresh_run_slot(account_id, agent_run_id)
+
+    async def save_progress(progress: dict):
+        """Checkpoint the run after a completed tool cycle, with the position of its responses."""
+        checkpoint.update(progress)
+        await stream_writer.flush()
+        if checkpointer:
+            await checkpointer.flush()
+            checkpoint['response_count'] = checkpointer.response_count
+        try:
+            checkpoint['response_position'] = await run_stream.get_response_position(agent_run_id)
+        except Exception as e:
+            logger.warning(f"Failed to read the response position of agent run {agent_run_id}: {e}")
+        await run_checkpoint.save_checkpoint(client, agent_run_id, checkpoint)
 
     trace = None
     cleanup_tasks = []
+    worker_metrics.agent_run_started()
 
     try:
-        # Setup Pub/Sub listener for control signals
-        pubsub = await redis.create_pubsub()
-        await pubsub.subscribe(instance_control_channel, global_control_channel)
-        logger.debug("Subscribed to control channels: {instance_control_channel}, {global_control_channel}")
+        # Listen for control signals on the event loop's shared Pub/Sub subscription
+        control_pubsub = get_agent_run_control_pubsub()
+        control_messages = await control_pubsub.subscribe(instance_control_channel, global_control_channel)
+        logger.debug(f"Subscribed to control channels: {instance_control_channel}, {global_control_channel}")
         stop_checker = asyncio.create_task(check_for_stop_signal())
 
         # Ensure active run key exists and has TTL
-        await redis.set(instance_active_key, "running", ex=redis.REDIS_KEY_TTL)
+        await run_stream.register_active_run(instance_id, agent_run_id)
+        await run_admission.refresh_run_slot(account_id, agent_run_id)
+        heartbeat = asyncio.create_task(refresh_active_run_periodically())
+
+        if lease_held:
+            if checkpoint:
+                # Redo the tool cycle the lost worker was in: drop its messages and responses
+                checkpoint['resume_count'] = checkpoint.get('resume_count', 0) + 1
+                await run_checkpoint.rollback_interrupted_cycle(client, agent_run_id, thread_id, checkpoint)
+                if checkpointer:
+                    await checkpointer.rewind(checkpoint.get('response_count'))
+                if checkpoint.get('response_position') is not None:
+                    removed = await run_stream.truncate_responses(agent_run_id, checkpoint['response_position'])
+                    logger.debug(f"Removed {removed} responses of the interrupted cycle of {agent_run_id} from Redis")
+                logger.info(f"Resuming agent run {agent_run_id} after iteration {checkpoint.get('iteration_count', 0)} (resume {checkpoint['resume_count']})")
+            else:
+                last_message = await client.table('messages').select('message_id, created_at').eq(
+                    'thread_id', thread_id
+                ).order('created_at', desc=True).limit(1).execute()
+                checkpoint = run_checkpoint.new_checkpoint({
+                    "agent_run_id": agent_run_id, "thread_id": thread_id, "instance_id": instance_id,
+                    "project_id": project_id, "model_name": model_name, "enable_thinking": enable_thinking,
+                    "reasoning_effort": reasoning_effort, "stream": stream,
+                    "enable_context_manager": enable_context_manager, "agent_config": agent_config,
+                    "is_agent_builder": is_agent_builder, "target_agent_id": target_agent_id,
+                    "account_id": account_id,
+                }, last_message.data[0] if last_message.data else None)
+            await run_checkpoint.save_checkpoint(client, agent_run_id, checkpoint)
 
         # Initialize agent generator
         agent_gen = run_agent(
@@ -347,32 +938,47 @@ async def _run_agent_background_async(
             agent_config=agent_config,
             trace=trace,
             is_agent_builder=is_agent_builder,
-            target_agent_id=target_agent_id
+            target_agent_id=target_agent_id,
+            checkpoint=checkpoint,
+            on_checkpoint=save_progress if lease_held else None
         )
 
         final_status = "running"
         error_message = None
 
-        async for response in agent_gen:
-            if stop_signal_received:
-                logger.info("Agent run {agent_run_id} stopped by signal.")
-                final_status = "stopped"
-                break
-
-            # Store response in Redis with proper error handling and size monitoring
-            response_json = json.dumps(response)
-            redis_success = await redis_writer.write_response(response_json)
-            total_responses += 1
-
-            # Check for agent-signaled completion or error
-            if response.get('type') == 'status':
-                status_val = response.get('status')
-                if status_val in ['completed', 'failed', 'stopped']:
-                    logger.info("Agent run {agent_run_id} finished via status message: {status_val}")
-                    final_status = status_val
-                    if status_val == 'failed' or status_val == 'stopped':
-                        error_message = response.get('message', "Run ended with status: {status_val}")
-                    break
+        async def consume_responses():
+            nonlocal final_status, error_message, total_responses
+            async for response in agent_gen:
+                # Store response in Redis with proper error handling and size monitoring
+                await stream_writer.add(response)
+                total_responses += 1
+
+                # Check for agent-signaled completion or error
+                if response.get('type') == 'status':
+                    status_val = response.get('status')
+                    if status_val in ['completed', 'failed', 'stopped']:
+                        logger.info(f"Agent run {agent_run_id} finished via status message: {status_val}")
+                        final_status = status_val
+                        if status_val == 'failed' or status_val == 'stopped':
+                            error_message = response.get('message', f"Run ended with status: {status_val}")
+                        break
+
+        # The response loop runs as its own task so a STOP cancels it immediately,
+        # even while it waits on the LLM or a tool
+        consumer = asyncio.create_task(consume_responses())
+        try:
+            await consumer
+        except asyncio.CancelledError:
+            if lease_lost and not asyncio.current_task().cancelling():
+                # The execution that took over the run owns its status and keys from here on
+                return
+            if not stop_signal_received or asyncio.current_task().cancelling():
+                raise
+            logger.info(f"Agent run {agent_run_id} stopped by signal.")
+            final_status = "stopped"
+
+        # Write any content still buffered by the coalescer
+        await stream_writer.close()
 
         # Handle completion
         if final_status == "running":
@@ -385,18 +991,14 @@ async def _run_agent_background_async(
             completion_json = json.dumps(completion_message)
             await redis_writer.write_response(completion_json)
 
-        # Fetch final responses from Redis for DB update (with size limit)
-        all_responses_json = await redis.lrange_chunked(response_list_key, 0, -1, max_size_mb=8.0)
-        all_responses = [json.loads(r) for r in all_responses_json]
-
-        # Update DB status
-        await update_agent_run_status(client, agent_run_id, final_status, error=error_message, responses=all_responses)
+        # Persist the remaining responses, then update the DB status
+        await _finalize_agent_run(client, agent_run_id, final_status, error_message, checkpointer)
 
         # Publish final control signal
         control_signal = "END_STREAM" if final_status == "completed" else "ERROR" if final_status == "failed" else "STOP"
         try:
-            await safe_redis_write(redis.publish, global_control_channel, control_signal, operation_name="publish_control_signal")
-            logger.debug("Published final control signal '{control_signal}' to {global_control_channel}")
+            await safe_redis_write(run_stream.publish_control, agent_run_id, control_signal, operation_name="publish_control_signal")
+            logger.debug(f"Published final control signal '{control_signal}' to {global_control_channel}")
         except Exception as e:
             logger.warning("Failed to publish final control signal {control_signal}: {str(e)}")
 
@@ -409,28 +1011,26 @@ async def _run_agent_background_async(
 
         # Push error message to Redis
         error_response = {"type": "status", "status": "error", "message": error_message}
+        try:
+            await stream_writer.close()
+        except Exception as flush_err:
+            logger.error(f"Failed to flush buffered chunks to Redis for {agent_run_id}: {flush_err}")
         try:
             error_json = json.dumps(error_response)
             await redis_writer.write_response(error_json)
         except Exception as redis_err:
             logger.error("Failed to push error response to Redis for {agent_run_id}: {redis_err}")
 
-        # Fetch final responses (including the error, with size limit)
-        all_responses = []
-        try:
-            all_responses_json = await redis.lrange_chunked(response_list_key, 0, -1, max_size_mb=8.0)
-            all_responses = [json.loads(r) for r in all_responses_json]
-        except Exception as fetch_err:
-            logger.error("Failed to fetch responses from Redis after error for {agent_run_id}: {fetch_err}")
-            all_responses = [error_response]
-
-        # Update DB status
-        await update_agent_run_status(client, agent_run_id, "failed", error="{error_message}\n{traceback_str}", responses=all_responses)
+        # Persist the remaining responses (including the error), then update the DB status
+        await _finalize_agent_run(
+            client, agent_run_id, "failed", f"{error_message}\n{traceback_str}", checkpointer,
+            fallback_responses=[error_response]
+        )
 
         # Publish ERROR signal
         try:
-            await safe_redis_write(redis.publish, global_control_channel, "ERROR", operation_name="publish_error_signal")
-            logger.debug("Published ERROR signal to {global_control_channel}")
+            await safe_redis_write(run_stream.publish_control, agent_run_id, "ERROR", operation_name="publish_error_signal")
+            logger.debug(f"Published ERROR signal to {global_control_channel}")
         except Exception as e:
             logger.warning("Failed to publish ERROR signal: {str(e)}")
 
@@ -438,13 +1038,24 @@ async def _run_agent_background_async(
         # Cleanup with proper task management
         cleanup_tasks = []
 
+        # Stop the coalescer's window timer if the run ended before it was flushed
+        stream_writer.cancel()
+
         # Cleanup stop checker task
         if stop_checker and not stop_checker.done():
             cleanup_tasks.append(_cleanup_task(stop_checker, "stop_checker"))
 
-        # Close pubsub connection
-        if pubsub:
-            cleanup_tasks.append(_cleanup_pubsub(pubsub, agent_run_id))
+        # Cleanup active run heartbeat task
+        if heartbeat and not heartbeat.done():
+            cleanup_tasks.append(_cleanup_task(heartbeat, "active_run_heartbeat"))
+
+        # Cancel the response loop if the run itself was cancelled
+        if consumer and not consumer.done():
+            cleanup_tasks.append(_cleanup_task(consumer, "response_consumer"))
+
+        # Leave the shared control subscription
+        if control_messages is not None:
+            cleanup_tasks.append(control_pubsub.unsubscribe(control_messages, instance_control_channel, global_control_channel))
 
         # Execute cleanup tasks concurrently
         if cleanup_tasks:
@@ -453,13 +1064,57 @@ async def _run_agent_background_async(
                 if isinstance(result, Exception):
                     logger.warning("Cleanup task {i} failed: {result}")
 
-        # Set TTL on the response list in Redis
-        await _cleanup_redis_response_list(agent_run_id)
+        if not lease_lost:
+            # Set TTL on the response list in Redis
+            await _cleanup_redis_response_list(agent_run_id)
+
+            # Remove the instance-specific active run key
+            await _cleanup_redis_instance_key(agent_run_id, instance_id)
+
+            # Free the run's place in its account's concurrency cap
+            await run_admission.release_run_slot(account_id, agent_run_id)
 
-        # Remove the instance-specific active run key
-        await _cleanup_redis_instance_key(agent_run_id, instance_id)
+        # Let the run be resumed right away if it was interrupted (on worker shutdown)
+        if lease_held and not lease_lost:
+            await run_checkpoint.release_lease(agent_run_id, lease_owner)
 
-        logger.info("Agent run background task fully completed for: {agent_run_id} (Instance: {instance_id}) with final status: {final_status}")
+        metrics_status = "taken_over" if lease_lost else "interrupted" if final_status == "running" else final_status
+        worker_metrics.agent_run_finished(metrics_status, (datetime.now(timezone.utc) - start_time).total_seconds())
+        logger.info(f"Agent run background task fully completed for: {agent_run_id} (Instance: {instance_id}) with final status: {final_status}")
+
+async def _finalize_agent_run(
+    client,
+    agent_run_id: str,
+    status: str,
+    error: Optional[str],
+    checkpointer: Optional[ResponseCheckpointer],
+    fallback_responses: Optional[List[dict]] = None
+) -> None:
+    """Write the final status of an agent run.
+
+    With checkpointing, the responses are already in agent_run_response_batches:
+    only the last batch is flushed and the run gets its status and response count.
+    Otherwise all responses are read back from Redis and stored on the run.
+
+    Args:
+        client: Database client
+        agent_run_id: ID of the agent run
+        status: Final status
+        error: Error message, if the run failed
+        checkpointer: The run's checkpointer, if responses are checkpointed
+        fallback_responses: Responses to store if they cannot be read from Redis
+    """
+    if checkpointer:
+        await checkpointer.close()
+        await update_agent_run_status(client, agent_run_id, status, error=error, response_count=checkpointer.persisted_count)
+        return
+
+    try:
+        all_responses = await run_stream.read_all_responses(agent_run_id, max_size_mb=8.0)
+    except Exception as fetch_err:
+        logger.error(f"Failed to fetch responses from Redis for {agent_run_id}: {fetch_err}")
+        all_responses = fallback_responses or []
+    await update_agent_run_status(client, agent_run_id, status, error=error, responses=all_responses)
 
 async def _cleanup_task(task: asyncio.Task, task_name: str):
     """Safely cleanup an asyncio task."""
@@ -471,60 +1126,71 @@ async def _cleanup_task(task: asyncio.Task, task_name: str):
     except Exception as e:
         logger.warning("Error during {task_name} cancellation: {e}")
 
-async def _cleanup_pubsub(pubsub, agent_run_id: str):
-    """Safely cleanup pubsub connection."""
-    try:
-        await pubsub.unsubscribe()
-        await pubsub.close()
-        logger.debug("Closed pubsub connection for {agent_run_id}")
-    except Exception as e:
-        logger.warning("Error closing pubsub for {agent_run_id}: {str(e)}")
-
 async def _cleanup_redis_response_list(agent_run_id: str):
-    """Set TTL on the Redis response list."""
-    response_list_key = "agent_run:{agent_run_id}:responses"
+    """Set TTL on the Redis response list (or stream)."""
+    response_key = run_stream.response_stream_key(agent_run_id) if run_stream.use_streams() else run_stream.response_list_key(agent_run_id)
     try:
-        await redis.expire(response_list_key, REDIS_RESPONSE_LIST_TTL)
-        logger.debug("Set TTL ({REDIS_RESPONSE_LIST_TTL}s) on response list: {response_list_key}")
+        await redis.expire(response_key, REDIS_RESPONSE_LIST_TTL)
+        logger.debug(f"Set TTL ({REDIS_RESPONSE_LIST_TTL}s) on response list: {response_key}")
     except Exception as e:
-        logger.warning("Failed to set TTL on response list {response_list_key}: {str(e)}")
+        logger.warning(f"Failed to set TTL on response list {response_key}: {str(e)}")
 
 async def _cleanup_redis_instance_key(agent_run_id: str, instance_id: str):
-    """Clean up the instance-specific Redis key for an agent run."""
+    """Clean up the instance-specific Redis key and index entries for an agent run."""
     if not instance_id:
         logger.warning("Instance ID not set, cannot clean up instance key.")
         return
-    key = "active_run:{instance_id}:{agent_run_id}"
-    logger.debug("Cleaning up Redis instance key: {key}")
+    key = run_stream.active_run_key(instance_id, agent_run_id)
+    logger.debug(f"Cleaning up Redis instance key: {key}")
     try:
-        await redis.delete(key)
-        logger.debug("Successfully cleaned up Redis key: {key}")
+        await run_stream.unregister_active_run(instance_id, agent_run_id)
+        logger.debug(f"Successfully cleaned up Redis key: {key}")
     except Exception as e:
-        logger.warning("Failed to clean up Redis key {key}: {str(e)}")
+        logger.warning(f"Failed to clean up Redis key {key}: {str(e)}")
 
 async def update_agent_run_status(
     client,
     agent_run_id: str,
     status: str,
     error: Optional[str] = None,
-    responses: Optional[List[dict]] = None
+    responses: Optional[List[dict]] = None,
+    response_count: Optional[int] = None
 ) -> bool:
-    """Update agent run status with enhanced error handling and retries."""
+    """Update agent run status with enhanced error handling and retries.
+
+    Args:
+        client: Database client
+        agent_run_id: ID of the agent run
+        status: New status; any status other than 'running' also sets completed_at
+        error: Error message to store
+        responses: Full response list to store (only when responses are not checkpointed)
+        response_count: Number of checkpointed responses to store
+
+    Returns:
+        True if the run was updated
+    """
     max_retries = 3
 
     for retry in range(max_retries):
         try:
+            now = datetime.now(timezone.utc).isoformat()
             update_data = {
                 "status": status,
-                "updated_at": datetime.now(timezone.utc).isoformat()
+                "updated_at": now
             }
 
+            if status != "running":
+                update_data["completed_at"] = now
+
             if error:
                 update_data["error"] = error
 
             if responses:
                 update_data["responses"] = responses
 
+            if response_count is not None:
+                update_data["response_count"] = response_count
+
             result = await client.table('agent_runs').update(update_data).eq("id", agent_run_id).execute()
 
             if result.data:
@@ -42,7 +42,7 @@ async def get_or_start_sandbox(sandbox_id: str):
     try:
         # Try to get the current sandbox
         try:
-            sandbox = daytona.get_current_sandbox(sandbox_id)
+            sandbox = await asyncio.to_thread(daytona.get_current_sandbox, sandbox_id)
             logger.debug("Found existing sandbox {sandbox_id}")
         except Exception as get_error:
             logger.error("Failed to get sandbox {sandbox_id}: {str(get_error)}")
@@ -56,7 +56,7 @@ async def get_or_start_sandbox(sandbox_id: str):
         if current_state in [WorkspaceState.ARCHIVED, WorkspaceState.STOPPED]:
             logger.info("Sandbox is in {current_state} state. Starting...")
             try:
-                daytona.start(sandbox)
+                await asyncio.to_thread(daytona.start, sandbox)
                 logger.info("Started sandbox {sandbox_id}, waiting for initialization...")
 
                 # Wait for the sandbox to be ready
@@ -70,7 +70,7 @@ async def get_or_start_sandbox(sandbox_id: str):
 
                     try:
                         # Refresh sandbox state
-                        sandbox = daytona.get_current_sandbox(sandbox_id)
+                        sandbox = await asyncio.to_thread(daytona.get_current_sandbox, sandbox_id)
                         if sandbox.instance.state == WorkspaceState.STARTED:
                             logger.info("Sandbox {sandbox_id} is now started after {elapsed_time}s")
                             break
@@ -83,7 +83,7 @@ async def get_or_start_sandbox(sandbox_id: str):
 
                 # Start supervisord in a session when restarting
                 try:
-                    start_supervisord_session(sandbox)
+                    await asyncio.to_thread(start_supervisord_session, sandbox)
                 except Exception as supervisord_error:
                     logger.warning("Failed to start supervisord session: {supervisord_error}")
                     # Continue anyway, supervisord failure shouldn't block the sandbox
@@ -96,7 +96,7 @@ async def get_or_start_sandbox(sandbox_id: str):
             logger.info("Sandbox {sandbox_id} is already running")
             # Ensure supervisord is running even for already started sandboxes
             try:
-                start_supervisord_session(sandbox)
+                await asyncio.to_thread(start_supervisord_session, sandbox)
                 logger.info("Ensured supervisord is running in sandbox {sandbox_id}")
             except Exception as supervisord_error:
                 logger.warning("Failed to start supervisord in running sandbox {sandbox_id}: {supervisord_error}")
@@ -199,14 +199,13 @@ async def calculate_monthly_usage(client, user_id: str) -> float:
 
     return total_seconds / 60  # Convert to minutes
 
-async def get_allowed_models_for_user(client, user_id: str):
+async def get_subscription_tier_name(user_id: str) -> str:
     """
-    Get the list of models allowed for a user based on their subscription tier.
+    Get the name of a user's subscription tier (a name from SUBSCRIPTION_TIERS).
 
     Returns:
-        List of model names allowed for the user's subscription tier.
+        The tier name, 'free' if the user has no subscription or an unknown price.
     """
-
     subscription = await get_user_subscription(user_id)
     tier_name = 'free'
 
@@ -222,6 +221,17 @@ async def get_allowed_models_for_user(client, user_id: str):
         if tier_info:
             tier_name = tier_info['name']
 
+    return tier_name
+
+async def get_allowed_models_for_user(client, user_id: str):
+    """
+    Get the list of models allowed for a user based on their subscription tier.
+
+    Returns:
+        List of model names allowed for the user's subscription tier.
+    """
+    tier_name = await get_subscription_tier_name(user_id)
+
     # Return allowed models for this tier
     return MODEL_ACCESS_TIERS.get(tier_name, MODEL_ACCESS_TIERS['free'])  # Default to free tier if unknown
 
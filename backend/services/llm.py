@@ -26,6 +26,8 @@ litellm.modify_params=True
 MAX_RETRIES = 3  # Increased retries for better reliability
 RATE_LIMIT_DELAY = 10  # Reduced from 30 to 10 seconds for faster recovery
 RETRY_DELAY = 0.5  # Slightly increased for network stability
+MAX_CACHE_BREAKPOINTS = 4  # Anthropic allows at most 4 cache_control blocks per request
+CACHE_BLOCK_MESSAGES = 16  # History breakpoints sit on boundaries of this many messages so they stay put across turns
 
 class LLMError(Exception):
     """Base exception for LLM-related errors."""
@@ -76,6 +78,82 @@ async def handle_error(error: Exception, attempt: int, max_attempts: int) -> Non
     logger.debug("Waiting {delay} seconds before retry...")
     await asyncio.sleep(delay)
 
+def _is_cacheable(message: Dict[str, Any]) -> bool:
+    """Check whether a message can carry a cache_control breakpoint."""
+    if message.get("role") not in ("system", "user", "assistant"):
+        return False
+    content = message.get("content")
+    if isinstance(content, str):
+        return bool(content.strip())
+    if isinstance(content, list):
+        return any(isinstance(block, dict) and block.get("type") == "text" and block.get("text") for block in content)
+    return False
+
+def plan_cache_breakpoints(messages: List[Dict[str, Any]], uncached_from_index: Optional[int] = None) -> List[int]:
+    """Choose the messages that get Anthropic prompt-cache breakpoints.
+
+    Breakpoints are placed on the longest prefix that stays the same across
+    turns: the system prompt, the end of the oldest unchanged history block
+    (a fixed CACHE_BLOCK_MESSAGES boundary, so it does not move every turn),
+    the start of the current turn and the last cacheable message. Messages
+    from uncached_from_index on (e.g. the temporary browser/image message) are
+    kept out of the cached prefix.
+
+    Args:
+        messages: Messages of the request
+        uncached_from_index: Index of the first message that must stay outside the cached prefix
+
+    Returns:
+        Sorted message indexes, at most MAX_CACHE_BREAKPOINTS
+    """
+    end = len(messages) if uncached_from_index is None else min(uncached_from_index, len(messages))
+
+    def nearest_cacheable(index: int, lower: int) -> Optional[int]:
+        for i in range(index, lower, -1):
+            if _is_cacheable(messages[i]):
+                return i
+        return None
+
+    breakpoints: List[int] = []
+    if end > 0 and messages[0].get("role") == "system" and _is_cacheable(messages[0]):
+        breakpoints.append(0)
+
+    lower = breakpoints[-1] if breakpoints else -1
+    last = nearest_cacheable(end - 1, lower)
+    if last is None:
+        return breakpoints
+
+    # Oldest unchanged history block
+    block_end = nearest_cacheable((last // CACHE_BLOCK_MESSAGES) * CACHE_BLOCK_MESSAGES - 1, lower)
+    if block_end is not None:
+        breakpoints.append(block_end)
+        lower = block_end
+
+    # Start of the current turn: stays put across auto-continues
+    for i in range(last - 1, lower, -1):
+        if messages[i].get("role") == "user" and _is_cacheable(messages[i]):
+            breakpoints.append(i)
+            break
+
+    breakpoints.append(last)
+    return sorted(set(breakpoints))[-MAX_CACHE_BREAKPOINTS:]
+
+def _with_cache_control(message: Dict[str, Any]) -> Dict[str, Any]:
+    """Return a copy of a message with cache_control on its last text block."""
+    message = dict(message)
+    content = message.get("content")
+    if isinstance(content, str):
+        message["content"] = [{"type": "text", "text": content, "cache_control": {"type": "ephemeral"}}]
+        return message
+
+    blocks = [dict(block) if isinstance(block, dict) else block for block in content]
+    for block in reversed(blocks):
+        if isinstance(block, dict) and block.get("type") == "text" and block.get("text"):
+            block["cache_control"] = {"type": "ephemeral"}
+            break
+    message["content"] = blocks
+    return message
+
 def prepare_params(
     messages: List[Dict[str, Any]],
     model_name: str,
@@ -90,7 +168,8 @@ def prepare_params(
     top_p: Optional[float] = None,
     model_id: Optional[str] = None,
     enable_thinking: Optional[bool] = False,
-    reasoning_effort: Optional[str] = 'low'
+    reasoning_effort: Optional[str] = 'low',
+    uncached_from_index: Optional[int] = None
 ) -> Dict[str, Any]:
     """Prepare parameters for the API call."""
     params = {
@@ -160,74 +239,17 @@ def prepare_params(
             params["model_id"] = "arn:aws:bedrock:us-west-2:935064898258:inference-profile/us.anthropic.claude-3-7-sonnet-20250219-v1:0"
             logger.debug("Auto-set model_id for Claude 3.7 Sonnet: {params['model_id']}")
 
-    # Apply Anthropic prompt caching (minimal implementation)
+    # Apply Anthropic prompt caching
     # Check model name *after* potential modifications (like adding bedrock/ prefix)
     effective_model_name = params.get("model", model_name) # Use model from params if set, else original
-    if "claude" in effective_model_name.lower() or "anthropic" in effective_model_name.lower():
-        messages = params["messages"] # Direct reference, modification affects params
-
-        # Ensure messages is a list
-        if not isinstance(messages, list):
-            return params # Return early if messages format is unexpected
-
-        # 1. Process the first message if it's a system prompt with string content
-        if messages and messages[0].get("role") == "system":
-            content = messages[0].get("content")
-            if isinstance(content, str):
-                # Wrap the string content in the required list structure
-                messages[0]["content"] = [
-                    {"type": "text", "text": content, "cache_control": {"type": "ephemeral"}}
-                ]
-            elif isinstance(content, list):
-                 # If content is already a list, check if the first text block needs cache_control
-                 for item in content:
-                     if isinstance(item, dict) and item.get("type") == "text":
-                         if "cache_control" not in item:
-                             item["cache_control"] = {"type": "ephemeral"}
-                             break # Apply to the first text block only for system prompt
-
-        # 2. Find and process relevant user and assistant messages
-        last_user_idx = -1
-        second_last_user_idx = -1
-        last_assistant_idx = -1
-
-        for i in range(len(messages) - 1, -1, -1):
-            role = messages[i].get("role")
-            if role == "user":
-                if last_user_idx == -1:
-                    last_user_idx = i
-                elif second_last_user_idx == -1:
-                    second_last_user_idx = i
-            elif role == "assistant":
-                if last_assistant_idx == -1:
-                    last_assistant_idx = i
-
-            # Stop searching if we've found all needed messages
-            if last_user_idx != -1 and second_last_user_idx != -1 and last_assistant_idx != -1:
-                 break
-
-        # Helper function to apply cache control
-        def apply_cache_control(message_idx: int, message_role: str):
-            if message_idx == -1:
-                return
-
-            message = messages[message_idx]
-            content = message.get("content")
-
-            if isinstance(content, str):
-                message["content"] = [
-                    {"type": "text", "text": content, "cache_control": {"type": "ephemeral"}}
-                ]
-            elif isinstance(content, list):
-                for item in content:
-                    if isinstance(item, dict) and item.get("type") == "text":
-                        if "cache_control" not in item:
-                           item["cache_control"] = {"type": "ephemeral"}
-
-        # Apply cache control to the identified messages
-        apply_cache_control(last_user_idx, "last user")
-        apply_cache_control(second_last_user_idx, "second last user")
-        apply_cache_control(last_assistant_idx, "last assistant")
+    if ("claude" in effective_model_name.lower() or "anthropic" in effective_model_name.lower()) and isinstance(params["messages"], list):
+        # Marked messages are copied so the caller's messages (e.g. the reused system prompt) are not modified
+        messages = list(params["messages"])
+        breakpoints = plan_cache_breakpoints(messages, uncached_from_index)
+        for index in breakpoints:
+            messages[index] = _with_cache_control(messages[index])
+        params["messages"] = messages
+        logger.debug(f"Placed prompt-cache breakpoints at messages {breakpoints} of {len(messages)}")
 
     # Add reasoning_effort for Anthropic models if enabled
     use_thinking = enable_thinking if enable_thinking is not None else False
@@ -255,7 +277,8 @@ async def make_llm_api_call(
     top_p: Optional[float] = None,
     model_id: Optional[str] = None,
     enable_thinking: Optional[bool] = False,
-    reasoning_effort: Optional[str] = 'low'
+    reasoning_effort: Optional[str] = 'low',
+    uncached_from_index: Optional[int] = None
 ) -> Union[Dict[str, Any], AsyncGenerator]:
     """
     Make an API call to a language model using LiteLLM.
@@ -275,6 +298,7 @@ async def make_llm_api_call(
         model_id: Optional ARN for Bedrock inference profiles
         enable_thinking: Whether to enable thinking
         reasoning_effort: Level of reasoning effort
+        uncached_from_index: Index of the first message to keep outside the prompt-cache prefix
 
     Returns:
         Union[Dict[str, Any], AsyncGenerator]: API response or stream
@@ -300,7 +324,8 @@ async def make_llm_api_call(
         top_p=top_p,
         model_id=model_id,
         enable_thinking=enable_thinking,
-        reasoning_effort=reasoning_effort
+        reasoning_effort=reasoning_effort,
+        uncached_from_index=uncached_from_index
     )
     last_error = None
     for attempt in range(MAX_RETRIES):
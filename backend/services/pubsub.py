@@ -0,0 +1,176 @@
+"""
+Process-wide Redis Pub/Sub multiplexer.
+
+SSE streams used to open their own Pub/Sub connections (one for responses, one
+for control signals) plus listener tasks. PubSubMultiplexer instead keeps a
+single PSUBSCRIBE connection per process and fans messages out to per-stream
+asyncio queues. Subscriptions are reference-counted per channel; the Redis
+connection is opened with the first subscriber and closed after the last one
+leaves.
+"""
+
+import asyncio
+import weakref
+from typing import Dict, Optional, Set, Tuple
+
+from services import redis
+from utils.logger import logger
+
+# Pattern covering every agent run channel (new_response and control)
+AGENT_RUN_CHANNEL_PATTERN = "agent_run:*"
+
+# Pattern covering only the control channels (global and per instance) of agent runs
+AGENT_RUN_CONTROL_CHANNEL_PATTERN = "agent_run:*:control*"
+
+# Channel value of the item put on every queue when the subscriber connection failed
+CONNECTION_LOST = None
+
+# Seconds to wait between reconnection attempts
+RECONNECT_DELAY = 1.0
+
+PubSubItem = Tuple[Optional[str], Optional[str]]
+
+
+class PubSubMultiplexer:
+    """Shares one pattern subscription between many local subscribers."""
+
+    def __init__(self, pattern: str):
+        """
+        Args:
+            pattern: Channel pattern to PSUBSCRIBE to; subscribed channels must match it
+        """
+        self.pattern = pattern
+        self._subscribers: Dict[str, Set[asyncio.Queue]] = {}
+        self._pubsub = None
+        self._reader_task: Optional[asyncio.Task] = None
+        self._lock = asyncio.Lock()
+
+    @property
+    def subscriber_count(self) -> int:
+        return len({queue for queues in self._subscribers.values() for queue in queues})
+
+    async def subscribe(self, *channels: str) -> "asyncio.Queue[PubSubItem]":
+        """Subscribe to channels.
+
+        Args:
+            channels: Channels to receive messages from
+
+        Returns:
+            A queue receiving (channel, data) tuples. (CONNECTION_LOST, None) is put
+            on it when the shared connection had to be re-established, since
+            messages may have been missed.
+        """
+        queue: asyncio.Queue = asyncio.Queue()
+        async with self._lock:
+            for channel in channels:
+                self._subscribers.setdefault(channel, set()).add(queue)
+            try:
+                await self._ensure_started()
+            except Exception:
+                self._remove(queue, channels)
+                raise
+        return queue
+
+    async def unsubscribe(self, queue: asyncio.Queue, *channels: str) -> None:
+        """Remove a subscriber; the connection is closed when no subscribers remain."""
+        async with self._lock:
+            self._remove(queue, channels)
+            if not self._subscribers:
+                await self._stop()
+
+    async def close(self) -> None:
+        """Drop all subscribers and close the connection."""
+        async with self._lock:
+            self._subscribers.clear()
+            await self._stop()
+
+    def _remove(self, queue: asyncio.Queue, channels) -> None:
+        for channel in channels:
+            queues = self._subscribers.get(channel)
+            if queues is None:
+                continue
+            queues.discard(queue)
+            if not queues:
+                del self._subscribers[channel]
+
+    async def _connect(self) -> None:
+        self._pubsub = await redis.create_pubsub()
+        await self._pubsub.psubscribe(self.pattern)
+        logger.debug(f"Subscribed to pattern {self.pattern}")
+
+    async def _ensure_started(self) -> None:
+        if self._reader_task and not self._reader_task.done():
+            return
+        await self._connect()
+        self._reader_task = asyncio.create_task(self._read_loop())
+
+    async def _stop(self) -> None:
+        if self._reader_task and not self._reader_task.done():
+            self._reader_task.cancel()
+            try:
+                await self._reader_task
+            except asyncio.CancelledError:
+                pass
+        self._reader_task = None
+        await self._close_pubsub()
+
+    async def _close_pubsub(self) -> None:
+        if self._pubsub is None:
+            return
+        pubsub, self._pubsub = self._pubsub, None
+        try:
+            await pubsub.punsubscribe(self.pattern)
+            await pubsub.close()
+        except Exception as e:
+            logger.warning(f"Error closing pubsub for pattern {self.pattern}: {e}")
+
+    def _dispatch(self, channel: Optional[str], data: Optional[str]) -> None:
+        if channel is CONNECTION_LOST:
+            targets = {queue for queues in self._subscribers.values() for queue in queues}
+        else:
+            targets = self._subscribers.get(channel, ())
+        for queue in targets:
+            queue.put_nowait((channel, data))
+
+    async def _read_loop(self) -> None:
+        while True:
+            try:
+                message = await self._pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Pubsub connection for pattern {self.pattern} failed: {e}")
+                await self._close_pubsub()
+                while True:
+                    await asyncio.sleep(RECONNECT_DELAY)
+                    try:
+                        await self._connect()
+                        break
+                    except Exception as reconnect_error:
+                        logger.warning(f"Failed to resubscribe to {self.pattern}: {reconnect_error}")
+                self._dispatch(CONNECTION_LOST, None)
+                continue
+
+            if not message or message.get("type") != "pmessage":
+                continue
+            data = message.get("data")
+            if isinstance(data, bytes):
+                data = data.decode('utf-8')
+            self._dispatch(message.get("channel"), data)
+
+
+# Shared by all SSE streams of this process
+agent_run_pubsub = PubSubMultiplexer(AGENT_RUN_CHANNEL_PATTERN)
+
+# Control multiplexers of the worker's event loops (one per Dramatiq worker thread,
+# plus the shared loop of concurrent runs)
+_control_pubsubs: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, PubSubMultiplexer]" = weakref.WeakKeyDictionary()
+
+
+def get_agent_run_control_pubsub() -> PubSubMultiplexer:
+    """Get the multiplexer the agent runs of the running event loop receive STOP signals through."""
+    loop = asyncio.get_running_loop()
+    multiplexer = _control_pubsubs.get(loop)
+    if multiplexer is None:
+        multiplexer = _control_pubsubs[loop] = PubSubMultiplexer(AGENT_RUN_CONTROL_CHANNEL_PATTERN)
+    return multiplexer
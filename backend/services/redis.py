@@ -1,9 +1,13 @@
 import redis.asyncio as redis
 import os
+import base64
+import zlib
 from dotenv import load_dotenv
 import asyncio
+import weakref
 from utils.logger import logger
-from typing import List, Any, Optional
+from utils.config import config
+from typing import Dict, List, Any, Optional, Tuple
 
 # Redis configuration
 redis_host = os.getenv('REDIS_HOST', 'localhost')
@@ -42,54 +46,57 @@ if redis_ssl:
     })
     logger.info("✅ SSL/TLS enabled for Redis connection (Upstash mode)")
 
-client: Optional[redis.Redis] = redis.Redis(**redis_config)
-
-# Connection state
-_initialized = False
-_init_lock = asyncio.Lock()
+# One client (and connection pool) per event loop: asyncio connections cannot be
+# shared between loops, and Dramatiq worker threads each run their own loop
+_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, redis.Redis]" = weakref.WeakKeyDictionary()
+_init_locks: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, asyncio.Lock]" = weakref.WeakKeyDictionary()
 
 # Constants
 REDIS_KEY_TTL = 3600 * 24  # 24 hour TTL as safety mechanism
 
+# Payload compression. Values above REDIS_COMPRESSION_MIN_BYTES are stored as a
+# marker prefix followed by the base64 of the compressed UTF-8 text (the client
+# decodes responses, so stored values must stay text). JSON payloads never start
+# with the NUL character, so plain values cannot be mistaken for compressed ones.
+COMPRESSED_ZLIB_PREFIX = "\x00zlib:"
+ZLIB_LEVEL = 1  # Fastest level; JSON still shrinks several-fold
+
 
 def initialize():
     """Initialize Redis connection synchronously."""
-    global client, _initialized
-    if not _initialized:
-        logger.info("Initializing Redis connection")
-        # Client is already created above
-        _initialized = True
+    logger.info("Initializing Redis connection")
 
 
 async def initialize_async():
-    """Initialize Redis connection asynchronously with retry logic."""
-    global client, _initialized
+    """Initialize the running event loop's Redis connection with retry logic."""
+    loop = asyncio.get_running_loop()
+    init_lock = _init_locks.setdefault(loop, asyncio.Lock())
 
-    async with _init_lock:
-        if not _initialized:
+    async with init_lock:
+        if loop not in _clients:
             logger.info("🔄 Initializing Redis connection...")
             initialize()
+            loop_client = redis.Redis(**redis_config)
 
             # Retry logic for connection with exponential backoff
             max_retries = 5  # Increased retries
             for attempt in range(max_retries):
                 try:
                     logger.info(f"📡 Attempting Redis connection (attempt {attempt + 1}/{max_retries})")
-                    await client.ping()
+                    await loop_client.ping()
                     logger.info("✅ Successfully connected to Redis")
-                    _initialized = True
+                    _clients[loop] = loop_client
                     
                     # Test basic operations
                     test_key = "health_check"
-                    await client.set(test_key, "ok", ex=10)
-                    result = await client.get(test_key)
+                    await loop_client.set(test_key, "ok", ex=10)
+                    result = await loop_client.get(test_key)
                     if result == "ok":
                         logger.info("✅ Redis read/write operations verified")
-                        await client.delete(test_key)
+                        await loop_client.delete(test_key)
                     else:
                         logger.warning("⚠️ Redis read/write verification failed")
-                    
-                    return client
+                    break
                 except Exception as e:
                     logger.error(f"❌ Redis connection attempt {attempt + 1} failed: {e}")
                     if attempt < max_retries - 1:
@@ -98,30 +105,82 @@ async def initialize_async():
                         await asyncio.sleep(wait_time)
                     else:
                         logger.error("💥 All Redis connection attempts failed")
-                        client = None
-                        _initialized = False
+                        await loop_client.aclose()
                         raise Exception(f"Failed to connect to Redis after {max_retries} attempts: {e}")
 
-    return client
+    return _clients[loop]
 
 
 async def close():
-    """Close Redis connection."""
-    global client, _initialized
-    if client:
+    """Close the running event loop's Redis connection."""
+    loop_client = _clients.pop(asyncio.get_running_loop(), None)
+    if loop_client:
         logger.info("Closing Redis connection")
-        await client.aclose()
-        client = None
-        _initialized = False
+        await loop_client.aclose()
         logger.info("Redis connection closed")
 
 
 async def get_client():
-    """Get the Redis client, initializing if necessary."""
-    global client, _initialized
-    if client is None or not _initialized:
-        await initialize_async()
-    return client
+    """Get the running event loop's Redis client, initializing if necessary."""
+    loop_client = _clients.get(asyncio.get_running_loop())
+    if loop_client is None:
+        loop_client = await initialize_async()
+    return loop_client
+
+
+# Payload encoding
+def is_compressed(value: Any) -> bool:
+    """Whether a stored value carries a compression marker."""
+    return isinstance(value, str) and value.startswith(COMPRESSED_ZLIB_PREFIX)
+
+
+def encode_value(value: str) -> str:
+    """Compress a value for storage if it is large enough to benefit.
+
+    Args:
+        value: Text to store
+
+    Returns:
+        The value to store: compressed with a marker prefix, or unchanged if it is
+        small, already encoded, or would not get smaller
+    """
+    min_bytes = config.REDIS_COMPRESSION_MIN_BYTES
+    if not min_bytes or not isinstance(value, str) or len(value) < min_bytes or is_compressed(value):
+        return value
+    data = value.encode('utf-8')
+    if len(data) < min_bytes:
+        return value
+    encoded = COMPRESSED_ZLIB_PREFIX + base64.b64encode(zlib.compress(data, ZLIB_LEVEL)).decode('ascii')
+    return encoded if len(encoded) < len(data) else value
+
+
+def decode_value(value: Any) -> Any:
+    """Reverse encode_value; values without a compression marker are returned as-is."""
+    if not is_compressed(value):
+        return value
+    try:
+        return zlib.decompress(base64.b64decode(value[len(COMPRESSED_ZLIB_PREFIX):])).decode('utf-8')
+    except Exception as e:
+        logger.error(f"Failed to decompress Redis value: {e}")
+        return value
+
+
+def _decode_entries(entries: List[Tuple[str, Dict[str, str]]]) -> List[Tuple[str, Dict[str, str]]]:
+    return [(entry_id, {field: decode_value(value) for field, value in fields.items()}) for entry_id, fields in entries]
+
+
+def get_pool_stats() -> Dict[str, int]:
+    """Connection counts of the connection pools of every event loop's client.
+
+    Returns:
+        Connections created (idle + in use), in use, and idle
+    """
+    in_use = idle = 0
+    for loop_client in list(_clients.values()):
+        pool = loop_client.connection_pool
+        in_use += len(getattr(pool, '_in_use_connections', ()))
+        idle += len(getattr(pool, '_available_connections', ()))
+    return {"created": in_use + idle, "in_use": in_use, "idle": idle}
 
 
 # Basic Redis operations
@@ -189,15 +248,15 @@ async def publish_with_retry(channel: str, message: str, max_retries: int = 3):
 
 # List operations
 async def rpush(key: str, *values: Any):
-    """Append one or more values to a list."""
+    """Append one or more values to a list, compressing large ones."""
     redis_client = await get_client()
-    return await redis_client.rpush(key, *values)
+    return await redis_client.rpush(key, *(encode_value(value) for value in values))
 
 
 async def lrange(key: str, start: int, end: int) -> List[str]:
-    """Get a range of elements from a list."""
+    """Get a range of elements from a list, decompressing compressed ones."""
     redis_client = await get_client()
-    return await redis_client.lrange(key, start, end)
+    return [decode_value(value) for value in await redis_client.lrange(key, start, end)]
 
 
 async def llen(key: str) -> int:
@@ -206,6 +265,35 @@ async def llen(key: str) -> int:
     return await redis_client.llen(key)
 
 
+async def ltrim(key: str, start: int, end: int):
+    """Keep only the elements of a list between start and end (inclusive)."""
+    redis_client = await get_client()
+    return await redis_client.ltrim(key, start, end)
+
+
+async def rpush_and_publish(key: str, value: str, channel: str, message: str, ttl: Optional[int] = None) -> int:
+    """Append a value to a list and publish a notification in a single round trip.
+
+    Args:
+        key: List to append to
+        value: Value to append (compressed if large; pass encode_value's result to know the stored size)
+        channel: Channel to publish the notification on
+        message: Notification message
+        ttl: If given, also (re)set the list's time to live in seconds
+
+    Returns:
+        The length of the list after the append
+    """
+    redis_client = await get_client()
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.rpush(key, encode_value(value))
+        pipe.publish(channel, message)
+        if ttl:
+            pipe.expire(key, ttl)
+        results = await pipe.execute()
+    return results[0]
+
+
 # Key management
 async def expire(key: str, time: int):
     """Set a key's time to live in seconds."""
@@ -219,8 +307,39 @@ async def keys(pattern: str) -> List[str]:
     return await redis_client.keys(pattern)
 
 
+async def scan_keys(pattern: str, count: int = 1000) -> List[str]:
+    """Get keys matching a pattern with SCAN, which does not block Redis like KEYS."""
+    redis_client = await get_client()
+    return [key async for key in redis_client.scan_iter(match=pattern, count=count)]
+
+
+async def eval_script(script: str, keys: List[str], args: List[Any]) -> Any:
+    """Run a Lua script atomically.
+
+    Args:
+        script: Lua source
+        keys: Keys the script accesses (KEYS)
+        args: Script arguments (ARGV)
+
+    Returns:
+        The script's return value
+    """
+    redis_client = await get_client()
+    return await redis_client.eval(script, len(keys), *keys, *args)
+
+
+# Set and hash operations
+async def smembers(key: str) -> List[str]:
+    """Get all members of a set."""
+    redis_client = await get_client()
+    return list(await redis_client.smembers(key))
+
+
 async def lrange_chunked(key: str, start: int, end: int, max_size_mb: float = 8.0) -> List[str]:
-    """Get a range of elements from a list with size limit to prevent Upstash 10MB request limit."""
+    """Get a range of elements from a list with size limit to prevent Upstash 10MB request limit.
+
+    The limit applies to the stored (possibly compressed) size; values are returned decompressed.
+    """
     redis_client = await get_client()
     max_size_bytes = int(max_size_mb * 1024 * 1024)  # Convert MB to bytes
 
@@ -238,7 +357,7 @@ async def lrange_chunked(key: str, start: int, end: int, max_size_mb: float = 8.
     current_pos = start
     total_size = 0
 
-    logger.debug("Fetching Redis list {key} from {start} to {end} with {max_size_mb}MB limit")
+    logger.debug(f"Fetching Redis list {key} from {start} to {end} with {max_size_mb}MB limit")
 
     while current_pos <= end:
         chunk_end = min(current_pos + chunk_size - 1, end)
@@ -253,10 +372,10 @@ async def lrange_chunked(key: str, start: int, end: int, max_size_mb: float = 8.
 
             # Check if adding this chunk would exceed the limit
             if total_size + chunk_size_bytes > max_size_bytes and all_results:
-                logger.warning("Redis list {key}: Stopping at position {current_pos} to avoid {max_size_mb}MB limit (current: {total_size / 1024 / 1024:.1f}MB)")
+                logger.warning(f"Redis list {key}: Stopping at position {current_pos} to avoid {max_size_mb}MB limit (current: {total_size / 1024 / 1024:.1f}MB)")
                 break
 
-            all_results.extend(chunk_data)
+            all_results.extend(decode_value(item) for item in chunk_data)
             total_size += chunk_size_bytes
             current_pos = chunk_end + 1
 
@@ -268,10 +387,10 @@ async def lrange_chunked(key: str, start: int, end: int, max_size_mb: float = 8.
                 chunk_size = optimal_chunk_size
 
         except Exception as e:
-            logger.error("Error fetching chunk {current_pos}-{chunk_end} from Redis list {key}: {e}")
+            logger.error(f"Error fetching chunk {current_pos}-{chunk_end} from Redis list {key}: {e}")
             break
 
-    logger.debug("Fetched {len(all_results)} items from Redis list {key} (total size: {total_size / 1024 / 1024:.1f}MB)")
+    logger.debug(f"Fetched {len(all_results)} items from Redis list {key} (total size: {total_size / 1024 / 1024:.1f}MB)")
     return all_results
 
 
@@ -288,6 +407,99 @@ async def lrange_latest(key: str, max_count: int = 100, max_size_mb: float = 8.0
     # Calculate start position for latest items
     start_pos = max(0, list_length - max_count)
 
-    logger.debug("Fetching latest {max_count} items from Redis list {key} (total length: {list_length})")
+    logger.debug(f"Fetching latest {max_count} items from Redis list {key} (total length: {list_length})")
 
     return await lrange_chunked(key, start_pos, -1, max_size_mb)
+
+
+# Stream operations
+async def xadd(key: str, fields: Dict[str, str], maxlen: Optional[int] = None, ttl: Optional[int] = None) -> str:
+    """Append an entry to a stream, trimming it to about maxlen entries.
+
+    Args:
+        key: Stream key
+        fields: Entry fields (large values are compressed)
+        maxlen: Approximate maximum stream length (no trimming if None)
+        ttl: If given, also (re)set the stream's time to live in seconds
+
+    Returns:
+        The ID of the new entry
+    """
+    redis_client = await get_client()
+    fields = {field: encode_value(value) for field, value in fields.items()}
+    if not ttl:
+        return await redis_client.xadd(key, fields, maxlen=maxlen, approximate=True)
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.xadd(key, fields, maxlen=maxlen, approximate=True)
+        pipe.expire(key, ttl)
+        results = await pipe.execute()
+    return results[0]
+
+
+async def xread(streams: Dict[str, str], count: Optional[int] = None, block: Optional[int] = None) -> List[Tuple[str, Dict[str, str]]]:
+    """Read entries newer than the given IDs, optionally blocking up to block milliseconds.
+
+    Args:
+        streams: Stream key -> last seen entry ID ('0-0' for the start)
+        count: Maximum number of entries per stream
+        block: Milliseconds to wait for new entries (None returns immediately)
+
+    Returns:
+        (entry ID, fields) tuples of all streams, in order per stream
+    """
+    redis_client = await get_client()
+    result = await redis_client.xread(streams, count=count, block=block)
+    entries = []
+    for _, stream_entries in result or []:
+        entries.extend(_decode_entries(stream_entries))
+    return entries
+
+
+async def xrange(key: str, min: str = "-", max: str = "+", count: Optional[int] = None) -> List[Tuple[str, Dict[str, str]]]:
+    """Get stream entries between two IDs (inclusive)."""
+    redis_client = await get_client()
+    return _decode_entries(await redis_client.xrange(key, min=min, max=max, count=count))
+
+
+async def xrevrange(key: str, max: str = "+", min: str = "-", count: Optional[int] = None) -> List[Tuple[str, Dict[str, str]]]:
+    """Get stream entries between two IDs (inclusive), newest first."""
+    redis_client = await get_client()
+    return _decode_entries(await redis_client.xrevrange(key, max=max, min=min, count=count))
+
+
+async def xdel(key: str, *entry_ids: str) -> int:
+    """Delete entries from a stream; returns the number deleted."""
+    redis_client = await get_client()
+    return await redis_client.xdel(key, *entry_ids)
+
+
+async def xrange_chunked(key: str, max_size_mb: float = 8.0, chunk_size: int = 200) -> List[Tuple[str, Dict[str, str]]]:
+    """Get all entries of a stream in chunks, stopping before max_size_mb (of stored data) is exceeded."""
+    redis_client = await get_client()
+    max_size_bytes = int(max_size_mb * 1024 * 1024)
+    all_results = []
+    total_size = 0
+    start = "-"
+
+    while True:
+        try:
+            chunk = await redis_client.xrange(key, min=start, max="+", count=chunk_size)
+        except Exception as e:
+            logger.error(f"Error fetching entries after {start} from Redis stream {key}: {e}")
+            break
+        if not chunk:
+            break
+
+        chunk_size_bytes = sum(len(value.encode('utf-8')) for _, fields in chunk for value in fields.values())
+        if total_size + chunk_size_bytes > max_size_bytes and all_results:
+            logger.warning(f"Redis stream {key}: Stopping at entry {chunk[0][0]} to avoid {max_size_mb}MB limit (current: {total_size / 1024 / 1024:.1f}MB)")
+            break
+
+        all_results.extend(_decode_entries(chunk))
+        total_size += chunk_size_bytes
+        if len(chunk) < chunk_size:
+            break
+        # Exclusive range start after the last entry read
+        start = "(" + chunk[-1][0]
+
+    return all_results
@@ -0,0 +1,179 @@
+"""
+Queue routing and admission control for agent runs.
+
+Runs of paying accounts go to a separate Dramatiq queue whose actor has a higher
+priority, so a burst of free-tier runs cannot delay them; workers consume both
+queues (or can be dedicated to one with `dramatiq --queues`). Before a run is
+enqueued the API checks:
+
+- the account's concurrency cap (ACCOUNT_MAX_CONCURRENT_RUNS), kept in a Redis
+  sorted set of the account's running run IDs, updated atomically by a script;
+- the depth of the target queue (AGENT_RUN_MAX_QUEUE_DEPTH), read from the
+  broker's keys, so load can be shed instead of piling up.
+
+Queue depth and the wait of the oldest waiting run are also reported back so the
+API can tell the client that its run is queued.
+"""
+
+import json
+import time
+from typing import Any, Dict, Optional
+
+from services import redis
+from services.billing import get_subscription_tier_name
+from utils.config import config
+from utils.logger import logger
+
+# Dramatiq queues; free-tier runs keep using the default queue
+DEFAULT_QUEUE_NAME = "default"
+PRIORITY_QUEUE_NAME = "agent_runs_priority"
+AGENT_RUN_QUEUES = (PRIORITY_QUEUE_NAME, DEFAULT_QUEUE_NAME)
+
+# Actor priorities per queue; Dramatiq processes lower values first
+QUEUE_ACTOR_PRIORITIES = {PRIORITY_QUEUE_NAME: 0, DEFAULT_QUEUE_NAME: 10}
+
+FREE_TIER_NAME = "free"
+
+# Key prefix of the Dramatiq Redis broker
+BROKER_NAMESPACE = "dramatiq"
+
+# Seconds an account's subscription tier is cached
+TIER_CACHE_TTL = 300
+
+# Seconds after which a run is dropped from its account's running set unless its
+# worker's heartbeat (every 5 minutes) has refreshed it: its worker is gone
+ACCOUNT_RUN_MAX_AGE = 900
+
+# KEYS[1]: account's running set; ARGV: stale-before timestamp, now, run ID, cap, key TTL
+# Returns the number of running runs and whether the run was admitted
+_ACQUIRE_SLOT_SCRIPT = """
+redis.call('zremrangebyscore', KEYS[1], '-inf', ARGV[1])
+if redis.call('zscore', KEYS[1], ARGV[3]) then
+    return {redis.call('zcard', KEYS[1]), 1}
+end
+local running = redis.call('zcard', KEYS[1])
+local cap = tonumber(ARGV[4])
+if cap > 0 and running >= cap then
+    return {running, 0}
+end
+redis.call('zadd', KEYS[1], ARGV[2], ARGV[3])
+redis.call('expire', KEYS[1], ARGV[5])
+return {running + 1, 1}
+"""
+
+
+def account_runs_key(account_id: str) -> str:
+    return f"account_runs:{account_id}"
+
+
+def subscription_tier_key(account_id: str) -> str:
+    return f"subscription_tier:{account_id}"
+
+
+def queue_for_tier(tier_name: str) -> str:
+    """Get the queue runs of a subscription tier are sent to."""
+    return DEFAULT_QUEUE_NAME if tier_name == FREE_TIER_NAME else PRIORITY_QUEUE_NAME
+
+
+async def get_account_tier(account_id: str) -> str:
+    """Get an account's subscription tier name, cached in Redis for TIER_CACHE_TTL seconds."""
+    try:
+        cached = await redis.get(subscription_tier_key(account_id))
+        if cached:
+            return cached
+    except Exception as e:
+        logger.warning(f"Failed to read cached subscription tier for {account_id}: {e}")
+
+    try:
+        tier_name = await get_subscription_tier_name(account_id)
+    except Exception as e:
+        logger.error(f"Failed to get subscription tier for {account_id}, using the free tier queue: {e}")
+        return FREE_TIER_NAME
+
+    try:
+        await redis.set(subscription_tier_key(account_id), tier_name, ex=TIER_CACHE_TTL)
+    except Exception as e:
+        logger.warning(f"Failed to cache subscription tier for {account_id}: {e}")
+    return tier_name
+
+
+async def acquire_run_slot(account_id: str, agent_run_id: str) -> Dict[str, Any]:
+    """Count a run against its account's concurrency cap.
+
+    Args:
+        account_id: Account starting the run
+        agent_run_id: ID of the new run
+
+    Returns:
+        {"admitted": bool, "running": runs of the account counting this one if admitted,
+         "limit": the cap (0 = unlimited)}
+    """
+    limit = config.ACCOUNT_MAX_CONCURRENT_RUNS
+    now = time.time()
+    running, admitted = await redis.eval_script(
+        _ACQUIRE_SLOT_SCRIPT,
+        [account_runs_key(account_id)],
+        [now - ACCOUNT_RUN_MAX_AGE, now, agent_run_id, limit, ACCOUNT_RUN_MAX_AGE],
+    )
+    return {"admitted": bool(admitted), "running": int(running), "limit": limit}
+
+
+async def refresh_run_slot(account_id: Optional[str], agent_run_id: str) -> None:
+    """Keep a running run in its account's running set (called from the run's heartbeat)."""
+    if not account_id:
+        return
+    try:
+        redis_client = await redis.get_client()
+        async with redis_client.pipeline(transaction=False) as pipe:
+            pipe.zadd(account_runs_key(account_id), {agent_run_id: time.time()}, xx=True)
+            pipe.expire(account_runs_key(account_id), ACCOUNT_RUN_MAX_AGE)
+            await pipe.execute()
+    except Exception as e:
+        logger.warning(f"Failed to refresh run slot of {agent_run_id} for account {account_id}: {e}")
+
+
+async def release_run_slot(account_id: Optional[str], agent_run_id: str) -> None:
+    """Remove a finished run from its account's running set."""
+    if not account_id:
+        return
+    try:
+        redis_client = await redis.get_client()
+        await redis_client.zrem(account_runs_key(account_id), agent_run_id)
+    except Exception as e:
+        logger.warning(f"Failed to release run slot of {agent_run_id} for account {account_id}: {e}")
+
+
+async def get_queue_stats(queue_name: str) -> Dict[str, Any]:
+    """Get the backlog of a Dramatiq queue.
+
+    Returns:
+        {"queue": name, "depth": messages waiting to be picked up,
+         "oldest_wait_seconds": how long the oldest of them has waited (0 if none)}
+    """
+    queue_key = f"{BROKER_NAMESPACE}:{queue_name}"
+    redis_client = await redis.get_client()
+    depth = await redis_client.llen(queue_key)
+    oldest_wait = 0.0
+    if depth:
+        # Messages are appended on enqueue and popped from the head, so the head is the oldest
+        oldest_id = await redis_client.lindex(queue_key, 0)
+        encoded = await redis_client.hget(f"{queue_key}.msgs", oldest_id) if oldest_id else None
+        if encoded:
+            try:
+                enqueued_ms = json.loads(encoded).get("message_timestamp")
+                if enqueued_ms:
+                    oldest_wait = max(0.0, time.time() - enqueued_ms / 1000)
+            except (json.JSONDecodeError, AttributeError, TypeError):
+                pass
+    return {"queue": queue_name, "depth": depth, "oldest_wait_seconds": round(oldest_wait, 1)}
+
+
+async def get_all_queue_stats() -> Dict[str, Dict[str, Any]]:
+    """Get get_queue_stats for every agent run queue."""
+    return {queue_name: await get_queue_stats(queue_name) for queue_name in AGENT_RUN_QUEUES}
+
+
+def queue_is_full(stats: Dict[str, Any]) -> bool:
+    """Whether a queue has reached AGENT_RUN_MAX_QUEUE_DEPTH."""
+    max_depth = config.AGENT_RUN_MAX_QUEUE_DEPTH
+    return max_depth > 0 and stats["depth"] >= max_depth
@@ -0,0 +1,230 @@
+"""
+Durable checkpoints and worker leases for agent runs.
+
+A worker executing a run holds a lease on it in Redis (agent_run_lease:{id}),
+refreshed by the run's heartbeat, and writes a checkpoint to
+agent_runs.checkpoint after every completed tool cycle: the iteration count,
+the auto-continue count, the last persisted message, how many responses were
+stored (in the database and in Redis) and the parameters the run was started
+with.
+
+When a worker dies mid-run (a redeploy, an OOM kill) its lease expires while
+the run is still 'running' in the database. Workers periodically look for such
+runs, claim them on the lease key so only one of them re-enqueues the run, and
+the run continues from its checkpoint: messages and responses of the
+interrupted cycle are rolled back and run_agent rebuilds its state from the
+thread.
+
+Once the run is re-enqueued the claim names its queued message and lives as long
+as a message may wait in a queue. If that message disappears without the run
+taking its lease (it was lost with the broker's data), the next scan drops the
+claim and re-enqueues the run again.
+"""
+
+import os
+import socket
+import uuid
+from datetime import datetime, timezone
+from typing import Any, Dict, Optional
+
+from services import redis, run_admission
+from utils.logger import logger
+
+# Seconds a run's lease lives without a heartbeat
+RUN_LEASE_TTL = 60
+
+# Seconds between lease refreshes while a run executes
+RUN_LEASE_REFRESH_INTERVAL = 20
+
+# Seconds an orphan stays claimed until the claiming worker has re-enqueued it
+ORPHAN_CLAIM_TTL = 60
+
+# Seconds a re-enqueued orphan stays claimed while its message waits in a queue
+QUEUED_CLAIM_TTL = redis.REDIS_KEY_TTL
+
+# Lease values set by claim_orphan start with this; the resumed run replaces them
+CLAIM_PREFIX = "claim:"
+
+# Message types written by a tool cycle; removed when an interrupted cycle is rolled back
+CYCLE_MESSAGE_TYPES = ["assistant", "tool", "status"]
+
+# Identifies this worker process in lease values
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+# KEYS[1]: lease key; ARGV: owner, TTL, claim prefix
+# Takes the lease unless another execution holds it (claims by the orphan scan can be taken over)
+_ACQUIRE_LEASE_SCRIPT = """
+local current = redis.call('get', KEYS[1])
+if current and current ~= ARGV[1] and string.sub(current, 1, string.len(ARGV[3])) ~= ARGV[3] then
+    return 0
+end
+redis.call('set', KEYS[1], ARGV[1], 'EX', ARGV[2])
+return 1
+"""
+
+# KEYS[1]: lease key; ARGV: owner, TTL
+_REFRESH_LEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('expire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+# KEYS[1]: lease key; ARGV: current value, new value, TTL
+_REPLACE_LEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('set', KEYS[1], ARGV[2], 'EX', ARGV[3])
+end
+return nil
+"""
+
+# KEYS[1]: lease key; ARGV: owner
+_RELEASE_LEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+
+def run_lease_key(agent_run_id: str) -> str:
+    return f"agent_run_lease:{agent_run_id}"
+
+
+def new_lease_owner() -> str:
+    """Get a lease value unique to one execution of a run on this worker."""
+    return f"{WORKER_ID}:{uuid.uuid4().hex[:8]}"
+
+
+async def acquire_lease(agent_run_id: str, owner: str) -> bool:
+    """Take the lease of a run for an execution.
+
+    Returns:
+        False if another execution of the run holds the lease
+    """
+    acquired = await redis.eval_script(
+        _ACQUIRE_LEASE_SCRIPT, [run_lease_key(agent_run_id)], [owner, RUN_LEASE_TTL, CLAIM_PREFIX]
+    )
+    return bool(acquired)
+
+
+async def refresh_lease(agent_run_id: str, owner: str) -> bool:
+    """Extend a held lease; returns False if the lease was lost."""
+    refreshed = await redis.eval_script(_REFRESH_LEASE_SCRIPT, [run_lease_key(agent_run_id)], [owner, RUN_LEASE_TTL])
+    return bool(refreshed)
+
+
+async def release_lease(agent_run_id: str, owner: str) -> None:
+    """Drop a lease if it is still held by owner."""
+    try:
+        await redis.eval_script(_RELEASE_LEASE_SCRIPT, [run_lease_key(agent_run_id)], [owner])
+    except Exception as e:
+        logger.warning(f"Failed to release lease of agent run {agent_run_id}: {e}")
+
+
+async def claim_orphan(agent_run_id: str) -> Optional[str]:
+    """Claim a run whose lease expired, so only one worker re-enqueues it.
+
+    Returns:
+        The claim (the lease's value), or None if the run is already claimed
+    """
+    claim = f"{CLAIM_PREFIX}{WORKER_ID}"
+    redis_client = await redis.get_client()
+    claimed = await redis_client.set(run_lease_key(agent_run_id), claim, nx=True, ex=ORPHAN_CLAIM_TTL)
+    return claim if claimed else None
+
+
+async def mark_claim_queued(agent_run_id: str, claim: str, queue_name: str, message_id: str) -> None:
+    """Keep a run claimed while the message that resumes it waits in its queue.
+
+    Args:
+        agent_run_id: ID of the agent run
+        claim: Value returned by claim_orphan
+        queue_name: Queue the run was re-enqueued on
+        message_id: The broker's ID of the message (its redis_message_id option)
+    """
+    await redis.eval_script(
+        _REPLACE_LEASE_SCRIPT, [run_lease_key(agent_run_id)],
+        [claim, f"{CLAIM_PREFIX}{queue_name}:{message_id}", QUEUED_CLAIM_TTL]
+    )
+
+
+async def is_stale_claim(lease_value: Optional[str]) -> bool:
+    """Whether a lease value is the claim of a re-enqueued run whose message is no longer queued.
+
+    The resumed run replaces the claim with its lease as soon as it starts, so
+    a claim outliving its message means the message was lost.
+    """
+    if not lease_value or not lease_value.startswith(CLAIM_PREFIX):
+        return False
+    queue_name, _, message_id = lease_value[len(CLAIM_PREFIX):].rpartition(":")
+    if queue_name not in run_admission.AGENT_RUN_QUEUES:
+        # Still being re-enqueued by the worker that claimed it
+        return False
+    redis_client = await redis.get_client()
+    return not await redis_client.hexists(f"{run_admission.BROKER_NAMESPACE}:{queue_name}.msgs", message_id)
+
+
+def new_checkpoint(params: Dict[str, Any], last_message: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """Build the checkpoint of a run that has not completed a tool cycle yet.
+
+    Args:
+        params: Keyword arguments of the run actor, used to re-enqueue the run
+        last_message: message_id and created_at of the thread's newest message when the run started
+    """
+    return {
+        "params": params,
+        "iteration_count": 0,
+        "auto_continue_count": 0,
+        "last_message_id": last_message.get("message_id") if last_message else None,
+        "last_message_created_at": last_message.get("created_at") if last_message else None,
+        "response_count": 0,
+        "response_position": None,
+        "resume_count": 0,
+    }
+
+
+async def save_checkpoint(client, agent_run_id: str, checkpoint: Dict[str, Any]) -> bool:
+    """Store a run's checkpoint on its agent_runs row."""
+    checkpoint["updated_at"] = datetime.now(timezone.utc).isoformat()
+    try:
+        await client.table('agent_runs').update({"checkpoint": checkpoint}).eq('id', agent_run_id).execute()
+        return True
+    except Exception as e:
+        logger.error(f"Failed to save checkpoint of agent run {agent_run_id}: {e}")
+        return False
+
+
+async def load_checkpoint(client, agent_run_id: str) -> Optional[Dict[str, Any]]:
+    """Get the checkpoint of a run that is still running, or None (no checkpoint, or the run has ended)."""
+    result = await client.table('agent_runs').select('status, checkpoint').eq('id', agent_run_id).maybe_single().execute()
+    if not result or not result.data or result.data.get('status') != 'running':
+        return None
+    return result.data.get('checkpoint')
+
+
+async def rollback_interrupted_cycle(client, agent_run_id: str, thread_id: str, checkpoint: Dict[str, Any]) -> int:
+    """Delete the messages a run wrote after its last completed tool cycle.
+
+    A cycle interrupted by a worker crash can leave an assistant message whose
+    tool never ran; run_agent would take it as the end of the run. Removing the
+    cycle's messages lets the resumed run redo it. Only database timestamps are
+    compared: the last checkpointed message's created_at, or the run's own
+    created_at if the thread had no message yet.
+
+    Returns:
+        Number of messages deleted
+    """
+    since = checkpoint.get("last_message_created_at")
+    if not since:
+        result = await client.table('agent_runs').select('created_at').eq('id', agent_run_id).maybe_single().execute()
+        since = result.data.get('created_at') if result and result.data else None
+    if not since:
+        return 0
+    result = await client.table('messages').delete().eq('thread_id', thread_id).in_(
+        'type', CYCLE_MESSAGE_TYPES
+    ).gt('created_at', since).execute()
+    deleted = len(result.data or [])
+    if deleted:
+        logger.info(f"Rolled back {deleted} messages of an interrupted tool cycle in thread {thread_id}")
+    return deleted
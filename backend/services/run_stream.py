@@ -0,0 +1,254 @@
+"""
+Redis transport for agent run responses.
+
+The background worker writes every response of an agent run to Redis and SSE
+consumers read them back. Two transports are supported, selected with
+AGENT_STREAM_TRANSPORT so both can coexist during a migration (API and workers
+must use the same setting):
+
+- "list" (default): responses are appended to a LIST and announced with a
+  pub/sub "new" notification; consumers fetch new items by index.
+- "stream": responses are appended to a Redis Stream with XADD (trimmed to
+  about AGENT_STREAM_MAXLEN entries) and consumers XREAD BLOCK from the last
+  entry ID they saw. Control signals are written into the stream as well, so
+  consumers need no pub/sub subscription and no index bookkeeping.
+"""
+
+import json
+from typing import Any, Dict, List, Optional, Tuple
+
+from services import redis
+from utils.config import config
+from utils.logger import logger
+
+TRANSPORT_LIST = "list"
+TRANSPORT_STREAM = "stream"
+
+# Fields of a stream entry: a response or a control signal
+STREAM_DATA_FIELD = "data"
+STREAM_CONTROL_FIELD = "control"
+
+# Stream ID to read a stream from its first entry
+STREAM_START_ID = "0-0"
+
+# Control signals published when a run ends or is stopped
+CONTROL_SIGNALS = ("STOP", "END_STREAM", "ERROR")
+
+# Prefix of the response channel notification sent when a run's list is truncated
+# (followed by the new length); list consumers move their index back to it
+TRUNCATED_NOTIFICATION_PREFIX = "truncated:"
+
+
+def use_streams() -> bool:
+    """Whether agent run responses are carried by Redis Streams."""
+    return config.AGENT_STREAM_TRANSPORT == TRANSPORT_STREAM
+
+
+def response_list_key(agent_run_id: str) -> str:
+    return f"agent_run:{agent_run_id}:responses"
+
+
+def response_stream_key(agent_run_id: str) -> str:
+    return f"agent_run:{agent_run_id}:stream"
+
+
+def response_channel(agent_run_id: str) -> str:
+    return f"agent_run:{agent_run_id}:new_response"
+
+
+def control_channel(agent_run_id: str) -> str:
+    return f"agent_run:{agent_run_id}:control"
+
+
+def instance_control_channel(agent_run_id: str, instance_id: str) -> str:
+    return f"agent_run:{agent_run_id}:control:{instance_id}"
+
+
+def active_run_key(instance_id: str, agent_run_id: str) -> str:
+    return f"active_run:{instance_id}:{agent_run_id}"
+
+
+def instance_runs_key(instance_id: str) -> str:
+    return f"active_runs:{instance_id}"
+
+
+def active_run_owner_key(agent_run_id: str) -> str:
+    """Key holding the ID of the instance handling an agent run."""
+    return f"active_run_owner:{agent_run_id}"
+
+
+async def read_all_responses(agent_run_id: str, max_size_mb: float = 8.0) -> List[Dict[str, Any]]:
+    """Read the stored responses of an agent run, up to max_size_mb.
+
+    Args:
+        agent_run_id: ID of the agent run
+        max_size_mb: Maximum amount of data to read
+
+    Returns:
+        The run's responses in order (control entries of the stream transport are skipped)
+    """
+    if use_streams():
+        entries = await redis.xrange_chunked(response_stream_key(agent_run_id), max_size_mb=max_size_mb)
+        return [json.loads(fields[STREAM_DATA_FIELD]) for _, fields in entries if STREAM_DATA_FIELD in fields]
+
+    responses_json = await redis.lrange_chunked(response_list_key(agent_run_id), 0, -1, max_size_mb=max_size_mb)
+    return [json.loads(r) for r in responses_json]
+
+
+async def read_stream_entries(
+    agent_run_id: str,
+    last_id: str,
+    count: int = 100,
+    block_ms: Optional[int] = None
+) -> List[Tuple[str, Dict[str, str]]]:
+    """Read stream entries after last_id, waiting up to block_ms for new ones."""
+    return await redis.xread({response_stream_key(agent_run_id): last_id}, count=count, block=block_ms)
+
+
+async def get_response_position(agent_run_id: str) -> str:
+    """Get the position after a run's last stored response, to truncate back to later.
+
+    Returns:
+        The list's length, or the ID of the stream's last entry (STREAM_START_ID if it is empty)
+    """
+    if use_streams():
+        entries = await redis.xrevrange(response_stream_key(agent_run_id), count=1)
+        return entries[0][0] if entries else STREAM_START_ID
+    return str(await redis.llen(response_list_key(agent_run_id)))
+
+
+async def truncate_responses(agent_run_id: str, position: str) -> int:
+    """Remove the responses a run stored after a position from get_response_position.
+
+    List consumers are told the new length so their next read does not skip the
+    responses appended after the truncation.
+
+    Args:
+        agent_run_id: ID of the agent run
+        position: Position to truncate back to
+
+    Returns:
+        Number of entries removed
+    """
+    if use_streams():
+        key = response_stream_key(agent_run_id)
+        removed = 0
+        while True:
+            entries = await redis.xrange(key, min="(" + position, max="+", count=500)
+            if not entries:
+                return removed
+            removed += await redis.xdel(key, *(entry_id for entry_id, _ in entries))
+
+    key = response_list_key(agent_run_id)
+    keep = int(position)
+    length = await redis.llen(key)
+    if length <= keep:
+        return 0
+    if keep:
+        await redis.ltrim(key, 0, keep - 1)
+    else:
+        await redis.delete(key)
+    await redis.publish(response_channel(agent_run_id), f"{TRUNCATED_NOTIFICATION_PREFIX}{keep}")
+    return length - keep
+
+
+async def publish_control(agent_run_id: str, signal: str, instance_id: Optional[str] = None) -> None:
+    """Publish a control signal for an agent run.
+
+    The signal is always published on the control channel the worker listens to;
+    with the stream transport it is also appended to the response stream for SSE
+    consumers.
+
+    Args:
+        agent_run_id: ID of the agent run
+        signal: One of CONTROL_SIGNALS
+        instance_id: Publish on this instance's control channel instead of the global one
+    """
+    channel = instance_control_channel(agent_run_id, instance_id) if instance_id else control_channel(agent_run_id)
+    await redis.publish(channel, signal)
+    if use_streams() and not instance_id:
+        try:
+            await redis.xadd(response_stream_key(agent_run_id), {STREAM_CONTROL_FIELD: signal},
+                             maxlen=config.AGENT_STREAM_MAXLEN)
+        except Exception as e:
+            logger.warning(f"Failed to write control signal {signal} to stream for {agent_run_id}: {e}")
+
+
+# Active run index
+#
+# Each running agent run has an active_run:{instance}:{run} key with a TTL. Finding
+# runs by those keys needs KEYS/SCAN over the whole keyspace, so registrations are
+# also indexed in a SET of run IDs per instance and an active_run_owner:{run} key
+# holding the instance, updated in the same transaction as the key. The owner key
+# has the same TTL and heartbeat as the active key, so it expires with the run's
+# worker; SET members whose active key has expired are pruned when read.
+
+async def register_active_run(instance_id: str, agent_run_id: str, ttl: int = redis.REDIS_KEY_TTL) -> None:
+    """Mark an agent run as running on an instance and add it to the index."""
+    redis_client = await redis.get_client()
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.set(active_run_key(instance_id, agent_run_id), "running", ex=ttl)
+        pipe.sadd(instance_runs_key(instance_id), agent_run_id)
+        pipe.expire(instance_runs_key(instance_id), ttl)
+        pipe.set(active_run_owner_key(agent_run_id), instance_id, ex=ttl)
+        await pipe.execute()
+
+
+async def refresh_active_run(instance_id: str, agent_run_id: str, ttl: int = redis.REDIS_KEY_TTL) -> None:
+    """Extend the TTL of a run's active key, its owner key and its instance's index."""
+    redis_client = await redis.get_client()
+    async with redis_client.pipeline(transaction=False) as pipe:
+        pipe.expire(active_run_key(instance_id, agent_run_id), ttl)
+        pipe.expire(active_run_owner_key(agent_run_id), ttl)
+        pipe.expire(instance_runs_key(instance_id), ttl)
+        await pipe.execute()
+
+
+async def unregister_active_run(instance_id: str, agent_run_id: str) -> None:
+    """Remove an agent run's active key and its index entries."""
+    redis_client = await redis.get_client()
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.delete(active_run_key(instance_id, agent_run_id))
+        pipe.srem(instance_runs_key(instance_id), agent_run_id)
+        pipe.delete(active_run_owner_key(agent_run_id))
+        await pipe.execute()
+
+
+async def get_instance_runs(instance_id: str) -> List[str]:
+    """Get the IDs of the agent runs registered on an instance.
+
+    Members of the instance's index whose active key has expired (their worker
+    died without unregistering them) are removed from the index.
+    """
+    members = list(await redis.smembers(instance_runs_key(instance_id)))
+    run_ids = set()
+    if members:
+        redis_client = await redis.get_client()
+        async with redis_client.pipeline(transaction=False) as pipe:
+            for agent_run_id in members:
+                pipe.exists(active_run_key(instance_id, agent_run_id))
+            alive = await pipe.execute()
+        stale = [agent_run_id for agent_run_id, exists in zip(members, alive) if not exists]
+        if stale:
+            await redis_client.srem(instance_runs_key(instance_id), *stale)
+            logger.debug(f"Pruned {len(stale)} expired runs from the index of instance {instance_id}")
+        run_ids.update(agent_run_id for agent_run_id, exists in zip(members, alive) if exists)
+    if config.ACTIVE_RUN_SCAN_FALLBACK:
+        prefix_len = len(active_run_key(instance_id, ""))
+        run_ids.update(key[prefix_len:] for key in await redis.scan_keys(active_run_key(instance_id, "*")))
+    return list(run_ids)
+
+
+async def get_run_instances(agent_run_id: str) -> List[str]:
+    """Get the IDs of the instances an agent run is registered on."""
+    instance_ids = set()
+    owner = await redis.get(active_run_owner_key(agent_run_id))
+    if owner:
+        instance_ids.add(owner)
+    if config.ACTIVE_RUN_SCAN_FALLBACK:
+        # Key format: active_run:{instance_id}:{agent_run_id}
+        for key in await redis.scan_keys(active_run_key("*", agent_run_id)):
+            parts = key.split(":")
+            if len(parts) == 3:
+                instance_ids.add(parts[1])
+    return list(instance_ids)
@@ -2,6 +2,8 @@
 Centralized database connection management for AgentPress using Supabase.
 """
 
+import asyncio
+import weakref
 from typing import Optional
 from supabase import create_async_client, AsyncClient
 from utils.logger import logger
@@ -11,11 +13,15 @@ import uuid
 from datetime import datetime
 
 class DBConnection:
-    """Singleton database connection manager using Supabase."""
+    """Singleton database connection manager using Supabase.
+
+    Each event loop gets its own client, since the HTTP connections of an async
+    client cannot be shared between loops (Dramatiq worker threads each run their
+    own loop).
+    """
 
     _instance: Optional['DBConnection'] = None
-    _initialized = False
-    _client: Optional[AsyncClient] = None
+    _clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, AsyncClient]" = weakref.WeakKeyDictionary()
 
     def __new__(cls):
         if cls._instance is None:
@@ -27,8 +33,9 @@ class DBConnection:
         pass
 
     async def initialize(self):
-        """Initialize the database connection."""
-        if self._initialized:
+        """Initialize the database connection of the running event loop."""
+        loop = asyncio.get_running_loop()
+        if loop in self._clients:
             return
 
         try:
@@ -41,8 +48,7 @@ class DBConnection:
                 raise RuntimeError("SUPABASE_URL and a key (SERVICE_ROLE_KEY or ANON_KEY) environment variables must be set.")
 
             logger.debug("Initializing Supabase connection")
-            self._client = await create_async_client(supabase_url, supabase_key)
-            self._initialized = True
+            self._clients[loop] = await create_async_client(supabase_url, supabase_key)
             key_type = "SERVICE_ROLE_KEY" if config.SUPABASE_SERVICE_ROLE_KEY else "ANON_KEY"
             logger.debug("Database connection initialized with Supabase using {key_type}")
         except Exception as e:
@@ -51,23 +57,25 @@ class DBConnection:
 
     @classmethod
     async def disconnect(cls):
-        """Disconnect from the database."""
-        if cls._client:
+        """Disconnect the running event loop's client from the database."""
+        client = cls._clients.pop(asyncio.get_running_loop(), None)
+        if client:
             logger.info("Disconnecting from Supabase database")
-            await cls._client.close()
-            cls._initialized = False
+            await client.close()
             logger.info("Database disconnected successfully")
 
     @property
     async def client(self) -> AsyncClient:
         """Get the Supabase client instance."""
-        if not self._initialized:
+        client = self._clients.get(asyncio.get_running_loop())
+        if client is None:
             logger.debug("Supabase client not initialized, initializing now")
             await self.initialize()
-        if not self._client:
+            client = self._clients.get(asyncio.get_running_loop())
+        if not client:
             logger.error("Database client is None after initialization")
             raise RuntimeError("Database not initialized")
-        return self._client
+        return client
 
     async def upload_base64_image(self, base64_data: str, bucket_name: str = "browser-screenshots") -> str:
         """Upload a base64 encoded image to Supabase storage and return the URL.
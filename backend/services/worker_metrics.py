@@ -0,0 +1,239 @@
+"""
+Prometheus metrics of the Dramatiq workers.
+
+QueueMetrics stamps every message with its enqueue time (in the API process,
+which sends the runs) and, in the worker processes, records how long messages
+waited in their queue and how long they took to process, per actor and queue.
+Queue backlog, agent run durations and the Redis pool are sampled or recorded
+by run_agent_background.
+
+Each `dramatiq --processes N` worker process writes its metrics to a shared
+directory (prometheus_client multiprocess mode); a process forked by the
+Dramatiq CLI aggregates them and serves them on WORKER_METRICS_PORT.
+
+prometheus_client is imported only after the worker process has pointed it at
+that directory, so importing this module does not change how other processes
+use it.
+"""
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+from typing import Any, Dict, Optional
+
+import dramatiq
+from dramatiq.common import q_name
+
+from utils.config import config
+from utils.logger import logger
+
+# Message option holding the time a message was enqueued (ms since the epoch)
+ENQUEUED_AT_OPTION = "enqueued_at"
+
+# Address the metrics endpoint listens on
+METRICS_HTTP_HOST = "0.0.0.0"
+
+# Seconds; queue waits range from instant to many minutes, agent runs up to an hour
+WAIT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, float("inf"))
+DURATION_BUCKETS = (0.1, 0.5, 1, 5, 10, 30, 60, 120, 300, 600, 1200, 1800, 3600, float("inf"))
+
+_metrics: Optional[Dict[str, Any]] = None
+
+
+def _current_millis() -> int:
+    return int(time.time() * 1000)
+
+
+def metrics_dir() -> str:
+    """Directory the processes of this worker share their metrics in.
+
+    Worker processes and the exposition server are children of the same Dramatiq
+    CLI process, so its PID keeps every worker start in a fresh directory.
+    """
+    base_dir = config.WORKER_METRICS_DIR or os.path.join(tempfile.gettempdir(), "worker-metrics")
+    return os.path.join(base_dir, str(os.getppid()))
+
+
+def setup_metrics() -> None:
+    """Create this process's metrics in multiprocess mode."""
+    global _metrics
+    if _metrics is not None:
+        return
+    path = metrics_dir()
+    os.makedirs(path, exist_ok=True)
+    os.environ["PROMETHEUS_MULTIPROC_DIR"] = path
+
+    import prometheus_client as prom
+    from prometheus_client import values
+
+    # In case prometheus_client was imported before the directory was set
+    values.ValueClass = values.get_value_class()
+
+    _metrics = {
+        "messages": prom.Counter(
+            "dramatiq_messages_total", "Messages processed, by outcome.",
+            ["queue_name", "actor_name", "outcome"]
+        ),
+        "in_progress": prom.Gauge(
+            "dramatiq_messages_in_progress", "Messages being processed.",
+            ["queue_name", "actor_name"], multiprocess_mode="livesum"
+        ),
+        "wait": prom.Histogram(
+            "dramatiq_message_wait_seconds", "Time from enqueue until a worker started processing the message.",
+            ["queue_name", "actor_name"], buckets=WAIT_BUCKETS
+        ),
+        "processing": prom.Histogram(
+            "dramatiq_message_processing_seconds", "Time spent processing a message.",
+            ["queue_name", "actor_name"], buckets=DURATION_BUCKETS
+        ),
+        "queue_depth": prom.Gauge(
+            "dramatiq_queue_depth", "Messages waiting in a queue.",
+            ["queue_name"], multiprocess_mode="livemax"
+        ),
+        "queue_oldest_wait": prom.Gauge(
+            "dramatiq_queue_oldest_wait_seconds", "How long the oldest waiting message of a queue has waited.",
+            ["queue_name"], multiprocess_mode="livemax"
+        ),
+        "agent_runs": prom.Gauge(
+            "agent_runs_active", "Agent runs executing on the worker.", multiprocess_mode="livesum"
+        ),
+        "agent_run_duration": prom.Histogram(
+            "agent_run_duration_seconds", "Duration of agent runs, by final status.",
+            ["status"], buckets=DURATION_BUCKETS
+        ),
+        "redis_pool": prom.Gauge(
+            "worker_redis_pool_connections", "Connections of a worker process's Redis pool, by state.",
+            ["state"], multiprocess_mode="livesum"
+        ),
+    }
+    logger.debug(f"Worker metrics set up in {path}")
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # The process exists but belongs to another user
+        return True
+    return True
+
+
+def _remove_stale_metrics_dirs(base_dir: str) -> None:
+    """Drop the metrics of earlier worker starts.
+
+    Directories are named after the PID of their Dramatiq CLI process; those of
+    CLIs still running (other workers sharing WORKER_METRICS_DIR) are kept.
+    """
+    for entry in os.listdir(base_dir):
+        if not entry.isdigit() or int(entry) == os.getppid() or _pid_alive(int(entry)):
+            continue
+        shutil.rmtree(os.path.join(base_dir, entry), ignore_errors=True)
+
+
+def run_exposition_server() -> None:
+    """Serve the metrics of all worker processes on WORKER_METRICS_PORT (run as a Dramatiq fork)."""
+    from prometheus_client import CollectorRegistry, multiprocess, start_http_server
+
+    path = metrics_dir()
+    os.makedirs(path, exist_ok=True)
+    _remove_stale_metrics_dirs(os.path.dirname(path))
+
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry, path=path)
+    _, server_thread = start_http_server(config.WORKER_METRICS_PORT, addr=METRICS_HTTP_HOST, registry=registry)
+    logger.info(f"Serving worker metrics on {METRICS_HTTP_HOST}:{config.WORKER_METRICS_PORT}")
+    server_thread.join()
+
+
+def record_queue_stats(all_stats: Dict[str, Dict[str, Any]]) -> None:
+    """Record queue backlogs from run_admission.get_all_queue_stats."""
+    if _metrics is None:
+        return
+    for queue_name, stats in all_stats.items():
+        _metrics["queue_depth"].labels(queue_name).set(stats["depth"])
+        _metrics["queue_oldest_wait"].labels(queue_name).set(stats["oldest_wait_seconds"])
+
+
+def record_redis_pool_stats(pool_stats: Dict[str, int]) -> None:
+    """Record the connections of this process's Redis pool (services.redis.get_pool_stats)."""
+    if _metrics is None:
+        return
+    for state in ("in_use", "idle"):
+        _metrics["redis_pool"].labels(state).set(pool_stats.get(state, 0))
+
+
+def agent_run_started() -> None:
+    if _metrics is not None:
+        _metrics["agent_runs"].inc()
+
+
+def agent_run_finished(status: str, duration: float) -> None:
+    if _metrics is not None:
+        _metrics["agent_runs"].dec()
+        _metrics["agent_run_duration"].labels(status).observe(duration)
+
+
+class QueueMetrics(dramatiq.Middleware):
+    """Records enqueue-to-start latency and processing time of messages per actor and queue.
+
+    With AGENT_RUNS_PER_WORKER > 0 the agent run actor returns once the run has
+    started, so its processing time is the wait for a slot; the run itself is
+    measured by agent_run_duration_seconds.
+    """
+
+    def __init__(self):
+        self._start_times: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def forks(self):
+        return [run_exposition_server] if config.WORKER_METRICS_PORT else []
+
+    def before_enqueue(self, broker, message, delay):
+        message.options[ENQUEUED_AT_OPTION] = _current_millis() + (delay or 0)
+
+    def after_process_boot(self, broker):
+        if not config.WORKER_METRICS_PORT:
+            return
+        try:
+            setup_metrics()
+        except Exception as e:
+            logger.warning(f"Failed to set up worker metrics: {e}")
+
+    def after_worker_shutdown(self, broker, worker):
+        if _metrics is None:
+            return
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(os.getpid())
+
+    def before_process_message(self, broker, message):
+        if _metrics is None:
+            return
+        labels = (q_name(message.queue_name), message.actor_name)
+        enqueued_at = message.options.get(ENQUEUED_AT_OPTION) or message.message_timestamp
+        _metrics["wait"].labels(*labels).observe(max(0, _current_millis() - enqueued_at) / 1000)
+        _metrics["in_progress"].labels(*labels).inc()
+        with self._lock:
+            self._start_times[message.message_id] = time.monotonic()
+
+    def after_process_message(self, broker, message, *, result=None, exception=None):
+        self._finish(message, "failed" if exception is not None else "succeeded")
+
+    def after_skip_message(self, broker, message):
+        self._finish(message, "skipped")
+
+    def _finish(self, message, outcome: str) -> None:
+        if _metrics is None:
+            return
+        with self._lock:
+            started = self._start_times.pop(message.message_id, None)
+        labels = (q_name(message.queue_name), message.actor_name)
+        _metrics["messages"].labels(*labels, outcome).inc()
+        if started is None:
+            return
+        _metrics["in_progress"].labels(*labels).dec()
+        _metrics["processing"].labels(*labels).observe(time.monotonic() - started)
@@ -0,0 +1,27 @@
+BEGIN;
+
+-- Merge per-model token counts into messages.metadata->token_counts.
+-- p_counts maps message_id -> {tokenizer_key: token_count}; existing counts for
+-- other tokenizers are preserved.
+CREATE OR REPLACE FUNCTION merge_message_token_counts(p_counts JSONB)
+RETURNS VOID
+SECURITY DEFINER
+SET search_path = public, pg_temp
+LANGUAGE plpgsql
+AS $$
+BEGIN
+    UPDATE public.messages m
+    SET metadata = COALESCE(m.metadata, '{}'::jsonb) || jsonb_build_object(
+            'token_counts',
+            COALESCE(m.metadata->'token_counts', '{}'::jsonb) || c.value
+        )
+    FROM jsonb_each(p_counts) AS c(key, value)
+    WHERE m.message_id = c.key::uuid;
+END;
+$$;
+
+-- Runs with its owner's rights, so only the backend may call it
+REVOKE EXECUTE ON FUNCTION merge_message_token_counts(JSONB) FROM PUBLIC, anon, authenticated;
+GRANT EXECUTE ON FUNCTION merge_message_token_counts(JSONB) TO service_role;
+
+COMMIT;
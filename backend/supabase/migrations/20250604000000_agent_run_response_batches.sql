@@ -0,0 +1,39 @@
+BEGIN;
+
+-- Responses of an agent run, checkpointed in append-only batches while the run
+-- is in progress. Replaces the single write of agent_runs.responses at the end
+-- of a run.
+CREATE TABLE IF NOT EXISTS agent_run_response_batches (
+    agent_run_id UUID NOT NULL REFERENCES agent_runs(id) ON DELETE CASCADE,
+    batch_index INTEGER NOT NULL,
+    first_response_index INTEGER NOT NULL,
+    responses JSONB NOT NULL DEFAULT '[]'::jsonb,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT TIMEZONE('utc'::text, NOW()) NOT NULL,
+    PRIMARY KEY (agent_run_id, batch_index)
+);
+
+ALTER TABLE agent_run_response_batches ENABLE ROW LEVEL SECURITY;
+
+CREATE POLICY agent_run_response_batches_select_policy ON agent_run_response_batches
+    FOR SELECT
+    USING (
+        EXISTS (
+            SELECT 1 FROM agent_runs
+            JOIN threads ON threads.thread_id = agent_runs.thread_id
+            LEFT JOIN projects ON threads.project_id = projects.project_id
+            WHERE agent_runs.id = agent_run_response_batches.agent_run_id
+            AND (
+                projects.is_public = TRUE OR
+                basejump.has_role_on_account(threads.account_id) = true OR
+                basejump.has_role_on_account(projects.account_id) = true
+            )
+        )
+    );
+
+-- Summary written when the run finishes
+ALTER TABLE agent_runs ADD COLUMN IF NOT EXISTS response_count INTEGER;
+
+COMMENT ON TABLE agent_run_response_batches IS 'Responses of agent runs, written in batches during the run';
+COMMENT ON COLUMN agent_runs.response_count IS 'Number of responses checkpointed to agent_run_response_batches';
+
+COMMIT;
@@ -0,0 +1,14 @@
+BEGIN;
+
+-- Progress of a running agent run (completed tool cycles, last persisted
+-- message, start parameters), written by the worker after every tool cycle so
+-- another worker can resume the run if its worker dies.
+ALTER TABLE agent_runs ADD COLUMN IF NOT EXISTS checkpoint JSONB;
+
+-- Workers look for running runs with a checkpoint whose lease has expired
+CREATE INDEX IF NOT EXISTS idx_agent_runs_running_checkpointed ON agent_runs(started_at)
+    WHERE status = 'running' AND checkpoint IS NOT NULL;
+
+COMMENT ON COLUMN agent_runs.checkpoint IS 'Resume state of the run: iteration and auto-continue counts, last persisted message and start parameters';
+
+COMMIT;
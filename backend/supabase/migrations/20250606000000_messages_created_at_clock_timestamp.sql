@@ -0,0 +1,10 @@
+BEGIN;
+
+-- Status messages are inserted in batches by the agent worker without a
+-- created_at of their own. NOW() is fixed for the whole transaction, so every
+-- row of a batch would get the same timestamp; clock_timestamp() is evaluated
+-- per row, keeping the batch in insertion order on the database's clock.
+ALTER TABLE messages ALTER COLUMN created_at SET DEFAULT TIMEZONE('utc'::text, clock_timestamp());
+ALTER TABLE messages ALTER COLUMN updated_at SET DEFAULT TIMEZONE('utc'::text, clock_timestamp());
+
+COMMIT;
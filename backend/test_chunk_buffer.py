@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""
+Tests for the append-only ChunkBuffer used to accumulate streamed assistant content.
+"""
+
+import pytest
+
+from agentpress.utils.chunk_buffer import ChunkBuffer
+
+CHUNKS = ["Hello", ", ", "", "world", "! <ask>", "Done?", "</a", "sk>"]
+TEXT = "".join(CHUNKS)
+
+
+def make_buffer(chunks=CHUNKS) -> ChunkBuffer:
+    buffer = ChunkBuffer()
+    for chunk in chunks:
+        buffer.append(chunk)
+    return buffer
+
+
+def test_empty_buffer():
+    buffer = ChunkBuffer()
+    assert not buffer
+    assert len(buffer) == 0
+    assert buffer.getvalue() == ""
+    assert buffer.tail(10) == ""
+
+
+def test_getvalue_joins_all_chunks():
+    buffer = make_buffer()
+    assert buffer
+    assert len(buffer) == len(TEXT)
+    assert buffer.getvalue() == TEXT
+    # Joining is cached and appends after it are kept
+    assert buffer.getvalue() == TEXT
+    buffer.append(" Yes.")
+    assert buffer.getvalue() == TEXT + " Yes."
+    assert len(buffer) == len(TEXT) + len(" Yes.")
+
+
+@pytest.mark.parametrize("max_chars", range(0, len(TEXT) + 5))
+def test_tail_matches_end_of_text(max_chars):
+    buffer = make_buffer()
+    expected = TEXT[-max_chars:] if max_chars else ""
+    assert buffer.tail(max_chars) == expected
+
+
+def test_tail_spans_several_chunks():
+    buffer = make_buffer()
+    # "</a" and "sk>" are separate chunks, and "Done?" precedes them
+    assert buffer.tail(len("</ask>")) == "</ask>"
+    assert buffer.tail(len("Done?</ask>")) == "Done?</ask>"
+    assert buffer.tail(len("<ask>Done?</ask>")) == "<ask>Done?</ask>"
+
+
+def test_tail_after_getvalue():
+    buffer = make_buffer()
+    buffer.getvalue()
+    buffer.append("!")
+    assert buffer.tail(7) == "</ask>!"
+
+
+def test_negative_tail_is_empty():
+    assert make_buffer().tail(-1) == ""
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+"""
+Tests for the compact forms of large tool results.
+"""
+
+from agentpress.utils.compaction import (
+    COMPACT_HEAD_CHARS,
+    COMPACT_MIN_CHARS,
+    COMPACT_TAIL_CHARS,
+    LATEST_RESULT_MAX_CHARS,
+    build_compact_metadata,
+    cap_latest_tool_content,
+    compact_tool_content,
+)
+
+MESSAGE_ID = "5b0f3c1e-0000-4000-8000-000000000001"
+EXPAND_POINTER = f'use the expand-message tool with message_id "{MESSAGE_ID}"'
+
+
+def test_compact_keeps_head_and_tail():
+    content = "H" * COMPACT_HEAD_CHARS + "M" * 5000 + "T" * COMPACT_TAIL_CHARS
+    compact = compact_tool_content(content, MESSAGE_ID)
+
+    assert compact.startswith("H" * COMPACT_HEAD_CHARS + "\n\n... (5000 characters truncated) ...\n\n")
+    assert "M" not in compact
+    assert ("T" * COMPACT_TAIL_CHARS + "\n\nThis message is too long") in compact
+    assert compact.endswith(EXPAND_POINTER + " to see the full message")
+
+
+def test_compact_of_short_content_keeps_it_whole():
+    content = "x" * (COMPACT_HEAD_CHARS + COMPACT_TAIL_CHARS)
+    compact = compact_tool_content(content, MESSAGE_ID)
+
+    assert compact.startswith(content + "\n\n")
+    assert "truncated" not in compact
+    assert EXPAND_POINTER in compact
+
+
+def test_cap_latest_tool_content():
+    capped = cap_latest_tool_content("a" * LATEST_RESULT_MAX_CHARS + "b" * 10)
+    assert capped == "a" * LATEST_RESULT_MAX_CHARS + "\n\nThis message is too long, repeat relevant information in your response to remember it"
+
+    short = cap_latest_tool_content("result")
+    assert short.startswith("result\n\n")
+
+
+def test_build_compact_metadata_only_for_large_string_content():
+    assert build_compact_metadata({"role": "user", "content": "x" * COMPACT_MIN_CHARS}, MESSAGE_ID) is None
+    assert build_compact_metadata({"role": "tool", "content": [{"type": "text"}]}, MESSAGE_ID) is None
+
+    content = "x" * (COMPACT_MIN_CHARS + 1)
+    entry = build_compact_metadata({"role": "user", "content": content}, MESSAGE_ID)
+    assert entry == {"content": compact_tool_content(content, MESSAGE_ID)}
+    assert len(entry["content"]) < len(content)
@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""
+Tests for the choice of the messages covered by a thread summary.
+
+The rows of the thread are given directly; the summary itself is not generated.
+"""
+
+import pytest
+
+from agentpress.context_manager import (
+    SUMMARIZED_UNTIL_KEY,
+    SUMMARIZED_UNTIL_MESSAGE_ID_KEY,
+    SUMMARY_KEEP_RECENT_MESSAGES,
+    ContextManager,
+)
+
+THREAD_ID = "thread-1"
+
+
+def make_rows(roles):
+    return [
+        {
+            'message_id': f"m{index}",
+            'type': role,
+            'content': {'role': role, 'content': f"message {index}"},
+            'created_at': f"2025-01-01T00:00:{index:02d}+00:00",
+        }
+        for index, role in enumerate(roles)
+    ]
+
+
+async def summarize(monkeypatch, rows, previous_summary=None):
+    """Run summarize_thread over rows; returns (result, messages summarized, stored summary kwargs)."""
+    context_manager = ContextManager()
+    summarized = []
+    stored = []
+
+    async def get_rows(thread_id):
+        return previous_summary, rows
+
+    async def create_summary(thread_id, messages, model):
+        summarized.extend(messages)
+        return {'role': 'user', 'content': "summary"}
+
+    async def add_message(**kwargs):
+        stored.append(kwargs)
+
+    monkeypatch.setattr(context_manager, "_get_rows_since_last_summary", get_rows)
+    monkeypatch.setattr(context_manager, "create_summary", create_summary)
+    result = await context_manager.summarize_thread(THREAD_ID, add_message, token_count=1234)
+    return result, summarized, stored
+
+
+@pytest.mark.asyncio
+async def test_recent_messages_are_kept_verbatim(monkeypatch):
+    rows = make_rows(["user", "assistant"] * 6)
+    result, summarized, stored = await summarize(monkeypatch, rows)
+
+    assert result
+    assert summarized == [row['content'] for row in rows[:-SUMMARY_KEEP_RECENT_MESSAGES]]
+    boundary = rows[-SUMMARY_KEEP_RECENT_MESSAGES - 1]
+    assert stored[0]['type'] == "summary"
+    assert stored[0]['metadata'] == {
+        "token_count": 1234,
+        SUMMARIZED_UNTIL_KEY: boundary['created_at'],
+        SUMMARIZED_UNTIL_MESSAGE_ID_KEY: boundary['message_id'],
+    }
+
+
+@pytest.mark.asyncio
+async def test_boundary_does_not_separate_tool_results_from_their_call(monkeypatch):
+    # The kept tail would start on the two tool results of message 5
+    roles = ["user", "assistant", "user", "assistant", "user", "assistant", "tool", "tool", "assistant", "user", "assistant", "user"]
+    rows = make_rows(roles)
+    assert rows[-SUMMARY_KEEP_RECENT_MESSAGES]['type'] == "tool"
+
+    result, summarized, stored = await summarize(monkeypatch, rows)
+
+    assert result
+    assert len(summarized) == 5
+    assert stored[0]['metadata'][SUMMARIZED_UNTIL_MESSAGE_ID_KEY] == "m4"
+
+
+@pytest.mark.asyncio
+async def test_previous_summary_is_carried_forward(monkeypatch):
+    previous = {'message_id': "s0", 'content': {'role': 'user', 'content': "earlier summary"}, 'metadata': {}, 'created_at': "2024-12-31T00:00:00+00:00"}
+    rows = make_rows(["user", "assistant"] * 5)
+
+    result, summarized, _ = await summarize(monkeypatch, rows, previous_summary=previous)
+
+    assert result
+    assert summarized[0] == previous['content']
+    assert summarized[1:] == [row['content'] for row in rows[:-SUMMARY_KEEP_RECENT_MESSAGES]]
+
+
+@pytest.mark.asyncio
+async def test_too_few_messages_are_not_summarized(monkeypatch):
+    result, summarized, stored = await summarize(monkeypatch, make_rows(["user", "assistant"] * 4))
+
+    assert not result
+    assert not summarized and not stored
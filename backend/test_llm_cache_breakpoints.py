@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""
+Tests for the placement of Anthropic prompt-cache breakpoints.
+"""
+
+import random
+
+import pytest
+
+from services.llm import CACHE_BLOCK_MESSAGES, MAX_CACHE_BREAKPOINTS, _is_cacheable, plan_cache_breakpoints
+
+
+def conversation(length: int):
+    """A system prompt followed by alternating user and assistant messages."""
+    messages = [{"role": "system", "content": "You are a helpful agent."}]
+    for index in range(1, length + 1):
+        role = "user" if index % 2 else "assistant"
+        messages.append({"role": role, "content": f"message {index}"})
+    return messages
+
+
+def random_messages(rng: random.Random):
+    messages = [{"role": "system", "content": "system"}] if rng.random() < 0.8 else []
+    for _ in range(rng.randint(0, 60)):
+        role = rng.choice(["user", "assistant", "tool"])
+        content = rng.choice(["text", "", [{"type": "text", "text": "block"}], [{"type": "image_url", "image_url": {"url": "x"}}]])
+        messages.append({"role": role, "content": content})
+    return messages
+
+
+def test_short_conversation():
+    messages = conversation(3)
+    # System prompt, start of the current turn and the last message
+    assert plan_cache_breakpoints(messages) == [0, 1, 3]
+
+
+def test_uncached_tail_is_excluded():
+    messages = conversation(3)
+    messages.insert(3, {"role": "user", "content": "temporary browser state"})
+    assert plan_cache_breakpoints(messages, uncached_from_index=3) == [0, 1, 2]
+
+
+def test_history_breakpoint_stays_put_across_turns():
+    first = plan_cache_breakpoints(conversation(20))
+    later = plan_cache_breakpoints(conversation(27))
+    assert CACHE_BLOCK_MESSAGES - 1 in first
+    assert CACHE_BLOCK_MESSAGES - 1 in later
+
+
+@pytest.mark.parametrize("seed", range(200))
+def test_breakpoint_limits(seed):
+    rng = random.Random(seed)
+    messages = random_messages(rng)
+    uncached_from_index = rng.choice([None, rng.randint(0, len(messages) + 1)])
+
+    breakpoints = plan_cache_breakpoints(messages, uncached_from_index)
+
+    assert len(breakpoints) <= MAX_CACHE_BREAKPOINTS
+    assert breakpoints == sorted(set(breakpoints))
+    if uncached_from_index is not None:
+        assert all(index < uncached_from_index for index in breakpoints)
+    assert all(_is_cacheable(messages[index]) for index in breakpoints)
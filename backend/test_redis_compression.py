@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""
+Tests for the compression of large values stored in Redis.
+"""
+
+import json
+import random
+import string
+
+import pytest
+
+from services.redis import COMPRESSED_ZLIB_PREFIX, decode_value, encode_value, is_compressed
+from utils.config import config
+
+MIN_BYTES = 1024
+
+
+@pytest.fixture(autouse=True)
+def compression_threshold(monkeypatch):
+    monkeypatch.setattr(config, "REDIS_COMPRESSION_MIN_BYTES", MIN_BYTES)
+
+
+def large_response() -> str:
+    chunk = {"type": "assistant", "content": json.dumps({"role": "assistant", "content": "Hello wörld 👋 " * 200})}
+    return json.dumps(chunk)
+
+
+def test_large_value_round_trip():
+    value = large_response()
+    encoded = encode_value(value)
+
+    assert is_compressed(encoded)
+    assert encoded.startswith(COMPRESSED_ZLIB_PREFIX)
+    assert len(encoded) < len(value.encode('utf-8'))
+    assert decode_value(encoded) == value
+    # Encoding is idempotent
+    assert encode_value(encoded) == encoded
+
+
+def test_values_under_the_threshold_are_stored_unchanged():
+    value = "x" * (MIN_BYTES - 1)
+    assert encode_value(value) == value
+    assert decode_value(value) == value
+
+
+def test_incompressible_values_are_stored_unchanged():
+    rng = random.Random(0)
+    value = "".join(rng.choice(string.ascii_letters + string.digits) for _ in range(4 * MIN_BYTES))
+    assert encode_value(value) == value
+
+
+def test_compression_disabled(monkeypatch):
+    monkeypatch.setattr(config, "REDIS_COMPRESSION_MIN_BYTES", 0)
+    value = large_response()
+    assert encode_value(value) == value
+
+
+def test_legacy_uncompressed_values_decode_as_is():
+    value = large_response()
+    assert decode_value(value) == value
+    assert decode_value(None) is None
+    assert decode_value("running") == "running"
+
+
+def test_corrupt_compressed_value_is_returned_as_is():
+    value = COMPRESSED_ZLIB_PREFIX + "not base64 zlib data"
+    assert decode_value(value) == value
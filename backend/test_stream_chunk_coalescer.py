@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+"""
+Tests for the coalescing of streamed content chunks before they are written to Redis.
+"""
+
+import asyncio
+import json
+
+import pytest
+
+from run_agent_background import StreamChunkCoalescer
+
+
+class RecordingWriter:
+    """Stands in for RedisWriteManager and records the written responses."""
+
+    response_list_key = "agent_run:test:responses"
+
+    def __init__(self):
+        self.written = []
+
+    async def write_response(self, response_json: str) -> None:
+        self.written.append(json.loads(response_json))
+
+
+def content_chunk(sequence: int, text: str, thread_run_id: str = "run-1") -> dict:
+    return {
+        "sequence": sequence,
+        "message_id": None, "thread_id": "thread-1", "type": "assistant",
+        "is_llm_message": True,
+        "content": json.dumps({"role": "assistant", "content": text}),
+        "metadata": json.dumps({"stream_status": "chunk", "thread_run_id": thread_run_id}),
+        "created_at": f"t{sequence}", "updated_at": f"t{sequence}",
+    }
+
+
+def status_message(status_type: str) -> dict:
+    return {"type": "status", "content": json.dumps({"status_type": status_type}), "metadata": "{}"}
+
+
+def text_of(response: dict) -> str:
+    return json.loads(response["content"])["content"]
+
+
+@pytest.mark.asyncio
+async def test_consecutive_chunks_are_merged_on_flush():
+    writer = RecordingWriter()
+    coalescer = StreamChunkCoalescer(writer, window_ms=10000, max_bytes=1024)
+
+    for sequence, text in enumerate(["Hel", "lo, ", "wörld"]):
+        await coalescer.add(content_chunk(sequence, text))
+    assert writer.written == []
+
+    await coalescer.close()
+
+    assert len(writer.written) == 1
+    merged = writer.written[0]
+    assert text_of(merged) == "Hello, wörld"
+    # The merged chunk keeps the first sequence number and the last update time
+    assert merged["sequence"] == 0
+    assert merged["created_at"] == "t0" and merged["updated_at"] == "t2"
+    assert (coalescer.chunks_received, coalescer.chunks_written) == (3, 1)
+
+
+@pytest.mark.asyncio
+async def test_other_responses_flush_pending_chunks_first():
+    writer = RecordingWriter()
+    coalescer = StreamChunkCoalescer(writer, window_ms=10000, max_bytes=1024)
+
+    await coalescer.add(content_chunk(0, "a"))
+    await coalescer.add(content_chunk(1, "b"))
+    await coalescer.add(status_message("tool_started"))
+    await coalescer.add(content_chunk(2, "c"))
+    await coalescer.close()
+
+    assert [response["type"] for response in writer.written] == ["assistant", "status", "assistant"]
+    assert text_of(writer.written[0]) == "ab"
+    assert text_of(writer.written[2]) == "c"
+
+
+@pytest.mark.asyncio
+async def test_chunks_of_different_runs_are_not_merged():
+    writer = RecordingWriter()
+    coalescer = StreamChunkCoalescer(writer, window_ms=10000, max_bytes=1024)
+
+    await coalescer.add(content_chunk(0, "first", thread_run_id="run-1"))
+    await coalescer.add(content_chunk(1, "second", thread_run_id="run-2"))
+    await coalescer.close()
+
+    assert [text_of(response) for response in writer.written] == ["first", "second"]
+
+
+@pytest.mark.asyncio
+async def test_max_bytes_flushes_immediately():
+    writer = RecordingWriter()
+    coalescer = StreamChunkCoalescer(writer, window_ms=10000, max_bytes=8)
+
+    await coalescer.add(content_chunk(0, "1234"))
+    assert writer.written == []
+    await coalescer.add(content_chunk(1, "5678"))
+
+    assert [text_of(response) for response in writer.written] == ["12345678"]
+    await coalescer.close()
+    assert len(writer.written) == 1
+
+
+@pytest.mark.asyncio
+async def test_window_elapsing_flushes():
+    writer = RecordingWriter()
+    coalescer = StreamChunkCoalescer(writer, window_ms=20, max_bytes=1024)
+
+    await coalescer.add(content_chunk(0, "a"))
+    await coalescer.add(content_chunk(1, "b"))
+    await asyncio.sleep(0.1)
+
+    assert [text_of(response) for response in writer.written] == ["ab"]
+    await coalescer.close()
+    assert len(writer.written) == 1
+
+
+@pytest.mark.asyncio
+async def test_zero_window_writes_through():
+    writer = RecordingWriter()
+    coalescer = StreamChunkCoalescer(writer, window_ms=0, max_bytes=1024)
+
+    await coalescer.add(content_chunk(0, "a"))
+    await coalescer.add(content_chunk(1, "b"))
+
+    assert [text_of(response) for response in writer.written] == ["a", "b"]
+    await coalescer.close()
+
+
+@pytest.mark.asyncio
+async def test_cancel_drops_the_timer_without_writing():
+    writer = RecordingWriter()
+    coalescer = StreamChunkCoalescer(writer, window_ms=20, max_bytes=1024)
+
+    await coalescer.add(content_chunk(0, "a"))
+    coalescer.cancel()
+    await asyncio.sleep(0.1)
+
+    assert writer.written == []
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""
+Tests for the write-behind of status messages in ThreadManager.
+
+The database is replaced by an in-memory table that records rows in the order
+their inserts complete, which is the order the database timestamps them in.
+"""
+
+import asyncio
+import uuid
+
+import pytest
+
+from agentpress.thread_manager import ThreadManager
+from utils.config import config
+
+THREAD_ID = "thread-1"
+
+
+class FakeInsert:
+    def __init__(self, table: "FakeMessagesTable", rows):
+        self.table = table
+        self.rows = rows if isinstance(rows, list) else [rows]
+
+    async def execute(self):
+        # Batches of several rows are slow; a single-row insert completes at once
+        if len(self.rows) > 1 or self.rows[0]['type'] == 'status':
+            await asyncio.sleep(self.table.batch_delay)
+        stored = []
+        for row in self.rows:
+            stored_row = {**row, 'message_id': row.get('message_id') or str(uuid.uuid4())}
+            stored_row['created_at'] = len(self.table.rows)
+            self.table.rows.append(stored_row)
+            stored.append(stored_row)
+        return type("Result", (), {"data": stored})()
+
+
+class FakeMessagesTable:
+    def __init__(self, batch_delay: float):
+        self.batch_delay = batch_delay
+        self.rows = []
+
+    def insert(self, rows, returning=None):
+        return FakeInsert(self, rows)
+
+
+class FakeClient:
+    def __init__(self, table: FakeMessagesTable):
+        self._table = table
+
+    def table(self, name: str):
+        assert name == 'messages'
+        return self._table
+
+
+class FakeDB:
+    def __init__(self, client: FakeClient):
+        self._client = client
+
+    @property
+    async def client(self):
+        return self._client
+
+
+def make_thread_manager(batch_delay: float = 0.05):
+    table = FakeMessagesTable(batch_delay)
+    thread_manager = ThreadManager()
+    thread_manager.db = FakeDB(FakeClient(table))
+    return thread_manager, table
+
+
+@pytest.mark.asyncio
+async def test_llm_message_waits_for_in_flight_flush(monkeypatch):
+    """An LLM message added while queued status rows are being flushed is stored after them."""
+    monkeypatch.setattr(config, "MESSAGE_WRITE_BEHIND_ENABLED", True)
+    thread_manager, table = make_thread_manager()
+
+    await thread_manager.add_message(THREAD_ID, "status", {"status_type": "thinking"})
+    await thread_manager.add_message(THREAD_ID, "status", {"status_type": "tool_started"})
+
+    # The flush takes the queue and is now waiting on its slow insert
+    flush = asyncio.create_task(thread_manager.flush_pending_messages())
+    await asyncio.sleep(0)
+    assert not thread_manager._pending_message_rows
+
+    await thread_manager.add_message(THREAD_ID, "assistant", {"role": "assistant", "content": "done"}, is_llm_message=True)
+    await flush
+
+    assert [row['type'] for row in table.rows] == ["status", "status", "assistant"]
+
+
+@pytest.mark.asyncio
+async def test_llm_message_flushes_queued_rows_first(monkeypatch):
+    """Queued status rows are inserted before a following LLM message."""
+    monkeypatch.setattr(config, "MESSAGE_WRITE_BEHIND_ENABLED", True)
+    thread_manager, table = make_thread_manager(batch_delay=0)
+
+    status = await thread_manager.add_message(THREAD_ID, "status", {"status_type": "thinking"})
+    assert status['message_id'] and not table.rows
+
+    await thread_manager.add_message(THREAD_ID, "assistant", {"role": "assistant", "content": "hi"}, is_llm_message=True)
+
+    assert [row['type'] for row in table.rows] == ["status", "assistant"]
+    assert table.rows[0]['message_id'] == status['message_id']
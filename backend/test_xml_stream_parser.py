@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+Tests for the incremental XML tool call parser.
+
+A response fed to StreamingXMLChunkParser in deltas split at random boundaries
+must yield the same chunks as extracting them from the whole response.
+"""
+
+import random
+
+import pytest
+
+from agentpress.xml_stream_parser import StreamingXMLChunkParser, extract_xml_chunks
+
+LEGACY_TAG_NAMES = ["create-file", "ask", "execute-command"]
+
+FUNCTION_CALLS_CHUNK = (
+    '<function_calls>\n'
+    '<invoke name="create_file">\n'
+    '<parameter name="file_path">notes.md</parameter>\n'
+    # Parameter values are opaque: these tags must not close the block
+    '<parameter name="file_contents"># Notes\n</invoke></function_calls>\n<create-file>\n<param</parameter>\n'
+    '</invoke>\n'
+    '<invoke name="execute_command">\n'
+    '<parameter name="command">echo "<ask>"</parameter>\n'
+    '<parameter name="blocking"/>\n'
+    '</invoke>\n'
+    '</function_calls>'
+)
+
+NESTED_LEGACY_CHUNK = (
+    '<create-file file_path="example.xml">\n'
+    '<create-file>nested</create-file>\n'
+    '<create-files>not a tool tag</create-files>\n'
+    '</create-file>'
+)
+
+ASK_CHUNK = '<ask attachments="a.png">Does this <b>look</b> right?</ask>'
+
+RESPONSE = (
+    "Let me write the notes first. <asking> is not a tool, neither is <div>.\n"
+    + FUNCTION_CALLS_CHUNK
+    + "\nNow an example file.\n"
+    + NESTED_LEGACY_CHUNK
+    + "\n<execute-command-log>ignored</execute-command-log> <"
+    + ASK_CHUNK
+    + "\nTrailing text with an unfinished <execute-command>ls"
+)
+
+EXPECTED_CHUNKS = [FUNCTION_CALLS_CHUNK, NESTED_LEGACY_CHUNK, ASK_CHUNK]
+
+
+def split_randomly(text: str, rng: random.Random, max_delta: int):
+    """Split text into deltas of random lengths between 1 and max_delta."""
+    deltas = []
+    pos = 0
+    while pos < len(text):
+        size = rng.randint(1, max_delta)
+        deltas.append(text[pos:pos + size])
+        pos += size
+    return deltas
+
+
+def feed_all(deltas, legacy_tag_names=LEGACY_TAG_NAMES):
+    parser = StreamingXMLChunkParser(legacy_tag_names)
+    chunks = []
+    for delta in deltas:
+        chunks.extend(parser.feed(delta))
+    return chunks, parser
+
+
+def test_extract_whole_response():
+    assert extract_xml_chunks(RESPONSE, LEGACY_TAG_NAMES) == EXPECTED_CHUNKS
+
+
+@pytest.mark.parametrize("seed", range(50))
+@pytest.mark.parametrize("max_delta", [1, 3, 16, 200])
+def test_random_delta_boundaries_match_extraction(seed, max_delta):
+    rng = random.Random(seed * 1000 + max_delta)
+    chunks, parser = feed_all(split_randomly(RESPONSE, rng, max_delta))
+
+    assert chunks == extract_xml_chunks(RESPONSE, LEGACY_TAG_NAMES)
+    # The unfinished legacy tag at the end is still open
+    assert parser.in_chunk
+    assert parser.pending == "<execute-command>ls"
+
+
+def test_every_single_split_point():
+    expected = extract_xml_chunks(RESPONSE, LEGACY_TAG_NAMES)
+    for split in range(len(RESPONSE) + 1):
+        chunks, _ = feed_all([RESPONSE[:split], RESPONSE[split:]])
+        assert chunks == expected, f"split at {split}"
+
+
+def test_legacy_tags_need_registration():
+    chunks, _ = feed_all([RESPONSE], legacy_tag_names=[])
+    assert chunks == [FUNCTION_CALLS_CHUNK]
+
+
+def test_chunks_are_emitted_when_their_closing_tag_arrives():
+    parser = StreamingXMLChunkParser(LEGACY_TAG_NAMES)
+    head, tail = ASK_CHUNK[:-3], ASK_CHUNK[-3:]
+
+    assert parser.feed("text " + head) == []
+    assert parser.in_chunk
+    assert parser.feed(tail) == [ASK_CHUNK]
+    assert not parser.in_chunk
+    assert parser.pending == ""
+
+
+def test_reset_discards_partial_chunk():
+    parser = StreamingXMLChunkParser(LEGACY_TAG_NAMES)
+    parser.feed(FUNCTION_CALLS_CHUNK[:40])
+    parser.reset()
+
+    assert not parser.in_chunk
+    assert parser.feed(ASK_CHUNK) == [ASK_CHUNK]
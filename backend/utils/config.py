@@ -167,6 +167,39 @@ class Configuration:
     LANGFUSE_SECRET_KEY: Optional[str] = None
     LANGFUSE_HOST: str = "https://cloud.langfuse.com"
 
+    # Context management configuration
+    CONTEXT_BACKGROUND_SUMMARIZATION: bool = True
+    CONTEXT_SUMMARY_TRIGGER_PERCENT: int = 70  # % of the token threshold that starts a background summary
+    TOKEN_ESTIMATOR_ENABLED: bool = True
+    TOKEN_EXACT_COUNT_MARGIN_PERCENT: int = 10  # Estimates within this % of a limit are counted exactly
+    CONTEXT_RETRIEVAL_ENABLED: bool = False  # Add passages of compacted tool results relevant to the latest turn
+    CONTEXT_RETRIEVAL_TOKEN_BUDGET: int = 4000
+
+    # Agent run streaming configuration
+    AGENT_STREAM_TRANSPORT: str = "list"  # "list" (LIST + pub/sub) or "stream" (Redis Streams); API and workers must match
+    AGENT_STREAM_MAXLEN: int = 20000  # Approximate cap on entries kept per run with the stream transport
+    AGENT_STREAM_BLOCK_MS: int = 5000  # How long an SSE consumer blocks in XREAD before re-checking the run
+    STREAM_COALESCE_WINDOW_MS: int = 40  # Merge streamed content chunks over this window before writing to Redis (0 = off)
+    STREAM_COALESCE_MAX_BYTES: int = 4096  # Flush merged content early once it reaches this size
+    REDIS_COMPRESSION_MIN_BYTES: int = 1024  # Store Redis response payloads at least this large compressed (0 = off)
+    ACTIVE_RUN_SCAN_FALLBACK: bool = False  # Also SCAN for active run keys set before the run index existed (migration only)
+    AGENT_RUN_CHECKPOINT_ENABLED: bool = True  # Persist responses in batches during the run instead of all at the end
+    AGENT_RUN_CHECKPOINT_INTERVAL_MS: int = 2000
+    AGENT_RUN_CHECKPOINT_MAX_BATCH: int = 200
+    AGENT_RUN_CHECKPOINT_MAX_RETRIES: int = 3  # Failed flushes before a batch is split and responses that cannot be stored are dropped
+    AGENT_RUNS_PER_WORKER: int = 0  # Concurrent runs multiplexed on a worker process's event loop (0 = one run per worker thread)
+    ACCOUNT_MAX_CONCURRENT_RUNS: int = 0  # Agent runs an account may have running at once (0 = unlimited)
+    AGENT_RUN_MAX_QUEUE_DEPTH: int = 0  # Reject new runs while their queue holds this many waiting runs (0 = no limit)
+    AGENT_RUN_RESUME_ENABLED: bool = True  # Checkpoint runs and let other workers resume runs whose worker died
+    AGENT_RUN_MAX_RESUMES: int = 3  # Times a run is resumed before it is marked failed
+    AGENT_RUN_ORPHAN_SCAN_INTERVAL: int = 60  # Seconds between worker scans for runs whose lease expired
+    WORKER_METRICS_PORT: int = 9191  # Port of the Prometheus metrics endpoint of Dramatiq workers (0 = off)
+    WORKER_METRICS_DIR: str = ""  # Directory worker processes share metrics in (default: under the temp dir; metrics of dead workers are cleared on start)
+    MESSAGE_WRITE_BEHIND_ENABLED: bool = True  # Batch inserts of status messages instead of writing each one synchronously
+    MESSAGE_WRITE_BEHIND_INTERVAL_MS: int = 250
+    MESSAGE_WRITE_BEHIND_MAX_BATCH: int = 50
+    MESSAGE_WRITE_BEHIND_MAX_RETRIES: int = 3  # Failed flushes before a batch is split and rows that cannot be inserted are dropped
+
     @property
     def STRIPE_PRODUCT_ID(self) -> str:
         if self.ENV_MODE == EnvMode.STAGING: